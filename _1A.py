@@ -276,8 +276,7 @@ def rfcd(make_ntwk, P, STORE, STORE_UNC=None, plot=True):
     if plot:
         axs.append(fig.add_subplot(gs[1, 0]))
 
-    t_mask = (P.t_start <= rsp.ts) & (rsp.ts < P.t_end)
-    fr = rsp.spks[t_mask, :].sum(0) / (P.t_end - P.t_start)
+    fr = rsp.frs(P.t_start, P.t_end)
     bins = np.histogram(fr)[1]
     
     if plot:
@@ -298,11 +297,7 @@ def rfcd(make_ntwk, P, STORE, STORE_UNC=None, plot=True):
 
     t_bins = np.arange(P.t_start, P.t_end + P.t_bin_size, P.t_bin_size)
 
-    spk_cts = []
-    for t_bin_start, t_bin_end in zip(t_bins[:-1], t_bins[1:]):
-        t_bin_mask = (t_bin_start <= rsp.ts) & (rsp.ts < t_bin_end)
-        spks_t_bin = rsp.spks[t_bin_mask, :]
-        spk_cts.append(spks_t_bin.sum(0))
+    spk_cts = rsp.binned_spk_cts(t_bins)
 
     corrs = np.corrcoef(spk_cts, rowvar=False)
     corrs = corrs[np.triu_indices(P.n, 1)]
@@ -393,14 +388,7 @@ def run_e_leak_change_smlns(make_ntwk, nrns, e_leaks, P, STORE, rsp_0=None):
 def get_frs(rsp, P):
     """Get firing rate distribution over cells."""
     
-    t_wdw = (P.t_start, P.stm_off)
-    
-    t_mask = (t_wdw[0] <= rsp.ts) & (rsp.ts < t_wdw[1])
-    spks = rsp.spks[t_mask, :]
-    
-    fr = spks.sum(0) / (t_wdw[1] - t_wdw[0])
-    
-    return fr
+    return rsp.frs(P.t_start, P.stm_off)
 
 
 def dual_raster(ax, rsp_0, rsp_1, nrns_shown=None, nrns_changed=None):
@@ -13,6 +13,7 @@ from aux import load, save
 from aux import load_time_file
 from aux import downsample_spks, downsample_ma
 from disp import set_font_size
+from ntwk_rec import to_spk_events
 
 
 def ntwk(
@@ -52,10 +53,15 @@ def ntwk(
     alert = lambda m: print(m) if verbose else None
     alert('\n')
     
-    # load response file
+    # load response file (only the needed parts of result containers,
+    # whose traces are memory-mapped)
     if isinstance(rslt, str):
         alert('Loading activity file "{}"...'.format(rslt))
-        rslt = load(rslt)
+        if rslt.rstrip('/').lower().endswith('.rslt'):
+            rslt = load(
+                rslt, keys=['ts', 'vs', 'spks', 'ntwk/e_l', 'ntwk/v_th'])
+        else:
+            rslt = load(rslt)
         alert('Loaded.\n')
     
     e_l = rslt.ntwk.e_l
@@ -63,7 +69,7 @@ def ntwk(
     
     ts = rslt.ts
     vs = rslt.vs
-    spks = rslt.spks
+    spks = to_spk_events(rslt.spks)
     
     n = vs.shape[1]
     dt = np.mean(np.diff(rslt.ts))
@@ -116,7 +122,7 @@ def ntwk(
     
     ts = ts[t_mask]
     vs = vs[t_mask]
-    spks = spks[t_mask]
+    spks = spks.window(*np.searchsorted(rslt.ts, epoch)).dense()
     
     # downsample data if necessary
     if fps < fs:
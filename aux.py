@@ -24,14 +24,21 @@ class Generic(GenericFlexible):
         
 # FILE I/O
 
-def save(save_file, obj):
+def save(save_file, obj, **kwargs):
     """
-    Save a python object to a file using np.save.
+    Save a python object to a file using np.save, or, if save_file has a
+    .rslt extension, into a columnar result container (see ntwk_io.py).
     
-    :param save_file: path to save file (should have .npy extension)
+    :param save_file: path to save file (should have .npy or .rslt
+        extension)
     :param obj: python object to save
+    :param kwargs: args of ntwk_io.save (for .rslt containers)
     :return: path to saved file
     """
+    if save_file.lower().endswith('.rslt'):
+        import ntwk_io
+        return ntwk_io.save(save_file, obj, **kwargs)
+    
     if len(save_file) < 4 or save_file[-4:].lower() != '.npy':
         raise ValueError('Saved file must end with ".npy" extension.')
         
@@ -48,17 +55,27 @@ def save(save_file, obj):
     return save_file
 
 
-def load(load_file):
+def load(load_file, **kwargs):
     """
-    Load a python object using np.load.
+    Load a python object using np.load, or from a columnar result container
+    if load_file has a .rslt extension, optionally only parts of it (see
+    ntwk_io.RsltFile.load), e.g.:
+    
+        load('rslt.rslt', keys=['ts', 'spks'], steps=(1000, 2000))
     
     :param load_file: path to file containing object
+    :param kwargs: args of ntwk_io.load (keys, steps, nrns, mmap; for .rslt
+        containers)
     :return: loaded python object
     """
+    if load_file.rstrip('/').lower().endswith('.rslt'):
+        import ntwk_io
+        return ntwk_io.load(load_file.rstrip('/'), **kwargs)
+    
     if load_file[-4:].lower() != '.npy':
         raise ValueError('Load file must end with ".npy"')
         
-    return np.load(load_file)[0]
+    return np.load(load_file, allow_pickle=True)[0]
 
 
 def save_time_file(save_file, ts):
@@ -1,20 +1,51 @@
 """
 Basic database functions.
+
+The database is the postgres db specified in "LOCAL.py", unless a url is
+given explicitly, via the SMLN_DB_URL env var, or as DB_URL in "LOCAL.py"
+(e.g., "sqlite:///rslts.db" for a local file-backed stand-in, so that
+searches can run offline).
 """
-from sqlalchemy import create_engine
+import atexit
+import os
+import time
+import traceback
+
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy.exc import DBAPIError
 from sqlalchemy.orm import sessionmaker
 
 from .d_models import Base
 
-import LOCAL as L
+try:
+    import LOCAL as L
+except ImportError:
+    L = None
+
+
+# engines made in this process, keyed by url
+ENGINES = {}
+
+# (table, column) pairs added to d_models.py after their tables were first
+# created, which create_all does not add to existing tables (see migrate)
+MIGRATIONS = [
+    ('smln_rslt', 'profile'),
+]
 
 
-def make_session():
+def db_url(url=None):
     """
-    Connect to the database and return a new session object for that database.
-    
-    :return: session object
+    Return url of database to connect to (see module docstring).
     """
+    if url is not None:
+        return url
+
+    if os.environ.get('SMLN_DB_URL'):
+        return os.environ['SMLN_DB_URL']
+
+    if getattr(L, 'DB_URL', None):
+        return L.DB_URL
+
     # build connection url from input
     try:
         user = L.POSTGRES_USER
@@ -24,16 +55,208 @@ def make_session():
         raise NameError(
             'Specify user, pw, and db in "LOCAL.py".')
 
-    url = 'postgres://{}:{}@localhost:5432/{}'.format(user, pw, db)
+    return 'postgresql://{}:{}@localhost:5432/{}'.format(user, pw, db)
+
+
+def make_engine(url=None):
+    """
+    Return engine (with its connection pool) connected to the database,
+    making it and creating all tables defined in d_models.py only the first
+    time it is requested in this process.
+
+    :return: engine object
+    """
+    url = db_url(url)
+    key = (os.getpid(), url)
+
+    if key not in ENGINES:
+        # make and connect an engine
+        engine = create_engine(url)
+        engine.connect().close()
+
+        # create all tables defined in d_models.py and add new columns to
+        # existing ones
+        Base.metadata.create_all(engine)
+        migrate(engine)
+
+        ENGINES[key] = engine
+
+    return ENGINES[key]
+
+
+def migrate(engine):
+    """
+    Add the columns in MIGRATIONS that existing tables lack, e.g., run
+
+        ALTER TABLE smln_rslt ADD COLUMN profile JSONB
+
+    on dbs made before smln_rslt had a profile column.
+    """
+    def columns(table):
+        return [col['name'] for col in inspect(engine).get_columns(table)]
+
+    for table, column in MIGRATIONS:
+        if column in columns(table):
+            continue
+
+        col_type = Base.metadata.tables[table].c[column].type.compile(
+            dialect=engine.dialect)
+
+        try:
+            with engine.begin() as cxn:
+                cxn.execute(text('ALTER TABLE {} ADD COLUMN {} {}'.format(
+                    table, column, col_type)))
+        except DBAPIError:
+            # column may have been added by another process meanwhile
+            if column not in columns(table):
+                raise
+
+
+def make_session(url=None):
+    """
+    Connect to the database and return a new session object for that database.
+
+    :return: session object
+    """
+    return sessionmaker(bind=make_engine(url))()
+
+
+class RsltWriter(object):
+    """
+    Buffered writer of rows (d_models objects) to the database, which
+    inserts them in one transaction once "batch" rows are buffered or
+    "interval" s have passed since the last flush (checked when rows are
+    added), and when closed or at exit.
+
+    Buffered rows keep their ids None until flushed. Flush errors are not
+    raised: if inserting a batch fails, its rows are inserted one by one,
+    and rows that still fail stay buffered and are retried on the next
+    flush. Rows that fail twice are dropped (and kept in "dropped").
+
+    Rows may be added with a tag (e.g., the idx of the sample they belong
+    to). Once all rows added with a tag are inserted, on_saved(tag) is
+    called, or, if any of them was dropped, on_failed(tag, err) is called
+    with the traceback of the last error.
+
+    :param url: database url (see db_url)
+    :param batch: number of buffered rows that triggers a flush
+    :param interval: time (s) since last flush after which adding a row
+        triggers a flush
+    :param on_saved: callback called with each tag whose rows were inserted
+    :param on_failed: callback called with each tag whose rows could not
+        all be inserted, and the traceback of the error
+    """
+
+    # number of failed inserts after which a row is dropped
+    MAX_FAILS = 2
+
+    def __init__(
+            self, url=None, batch=50, interval=60., on_saved=None,
+            on_failed=None):
+        """Constructor."""
+        self.session_maker = sessionmaker(
+            bind=make_engine(url), expire_on_commit=False)
+
+        self.batch = batch
+        self.interval = interval
+
+        self.on_saved = on_saved
+        self.on_failed = on_failed
+
+        # buffered [row, tag, number of failed inserts]
+        self.rows = []
+        self.dropped = []
+
+        # number of buffered rows and last error of each tag
+        self.n_pending = {}
+        self.errs = {}
+
+        self.t_flush = time.time()
+
+        atexit.register(self.close)
+
+    def add(self, row, tag=None):
+        """Buffer row (added with tag), flushing if due."""
+        self.rows.append([row, tag, 0])
+
+        if tag is not None:
+            self.n_pending[tag] = self.n_pending.get(tag, 0) + 1
+
+        if len(self.rows) >= self.batch \
+                or time.time() - self.t_flush >= self.interval:
+            self.flush()
+
+    def flush(self):
+        """Insert all buffered rows."""
+        entries, self.rows = self.rows, []
+
+        if entries and self.insert([row for row, _, _ in entries]) is None:
+            for _, tag, _ in entries:
+                self.settle(tag)
+
+        elif entries:
+            # isolate rows that cannot be inserted
+            for entry in entries:
+                err = self.insert([entry[0]])
+
+                if err is None:
+                    self.settle(entry[1])
+                    continue
+
+                entry[2] += 1
+
+                if entry[2] < self.MAX_FAILS:
+                    self.rows.append(entry)
+                else:
+                    self.dropped.append(entry[0])
+
+                    if entry[1] is not None:
+                        self.errs[entry[1]] = err
+
+                    self.settle(entry[1])
+
+        self.t_flush = time.time()
+
+    def insert(self, rows):
+        """
+        Insert rows in one transaction.
+
+        :return: traceback of error (None if rows were inserted)
+        """
+        session = self.session_maker()
+
+        try:
+            session.add_all(rows)
+            session.commit()
+        except Exception:
+            session.rollback()
+            return traceback.format_exc()
+        finally:
+            session.close()
+
+        return None
+
+    def settle(self, tag):
+        """Count one row of tag as inserted or dropped."""
+        if tag is None:
+            return
+
+        self.n_pending[tag] -= 1
+
+        if self.n_pending[tag] > 0:
+            return
 
-    # make and connect an engine
-    engine = create_engine(url)
-    engine.connect()
+        del self.n_pending[tag]
+        err = self.errs.pop(tag, None)
 
-    # create all tables defined in d_models.py
-    Base.metadata.create_all(engine)
+        if err is None and self.on_saved is not None:
+            self.on_saved(tag)
+        elif err is not None and self.on_failed is not None:
+            self.on_failed(tag, err)
 
-    # get a new session
-    session = sessionmaker(bind=engine)()
+    def close(self):
+        """Flush remaining rows (retrying failed ones until dropped)."""
+        while self.rows:
+            self.flush()
 
-    return session
+        atexit.unregister(self.close)
@@ -1,11 +1,14 @@
 from sqlalchemy import Column, ForeignKey
-from sqlalchemy import Boolean, DateTime, Float, Integer, String
+from sqlalchemy import Boolean, DateTime, Float, Integer, JSON, String
 from sqlalchemy.dialects.postgresql.json import JSONB
 from sqlalchemy.orm import relationship, backref
 from sqlalchemy.ext.declarative import declarative_base
 
 Base = declarative_base()
 
+# JSONB on postgres, plain JSON elsewhere (e.g., local sqlite stand-ins)
+JSON_ = JSON().with_variant(JSONB(), 'postgresql')
+
 
 class SmlnRslt(Base):
     
@@ -14,15 +17,16 @@ class SmlnRslt(Base):
     id = Column(Integer, primary_key=True)
     group = Column(String)
     
-    params = Column(JSONB)
-    s_params = Column(JSONB)
+    params = Column(JSON_)
+    s_params = Column(JSON_)
     apxn = Column(Boolean)
     
-    metrics = Column(JSONB)
+    metrics = Column(JSON_)
     success = Column(Boolean)
     
     prep_time = Column(Float)
     run_time = Column(Float)
+    profile = Column(JSON_)
     
     ntwk_file = Column(String)
     smln_included = Column(Boolean)
@@ -6,6 +6,7 @@ warnings.filterwarnings("ignore", category=UserWarning, module="matplotlib")
 
 from aux import load, save
 from aux import load_time_file
+from ntwk_rec import to_spk_events
 
 
 def print_red(text):
@@ -41,12 +42,16 @@ def spaced_colors(start, end, n):
 def raster(ax, ts, spks, order=None, **scatter_kwargs):
     """
     Make a raster plot of spiking activity.
+
+    :param spks: dense (time points x neurons) spk array or SpkEvents
     """
     if not len(ts) == len(spks):
         raise Exception('Arg "ts" must be same length as arg "spks".')
 
+    spks = to_spk_events(spks)
+    
     if order is not None:
-        spks = spks[:, order]
+        spks = spks.select(order)
     
     # get all (spk time, nrn) pair for each spike
     spk_tps, spk_nrns = spks.nonzero()
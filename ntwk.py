@@ -1,15 +1,19 @@
 from copy import deepcopy
 import numpy as np
-from scipy.sparse import csc_matrix
+from scipy.sparse import (
+    block_diag, coo_matrix, csc_matrix, csr_matrix, issparse, vstack)
 import os
 import time
 
 from aux import save
+from ntwk_inp import DriveSchedule, InpSource, JoinedInps
+from ntwk_rec import (
+    SpkEvents, get_rec_steps, make_recorder, rec_dtype, to_spk_events)
 
 
 # INITIALIZATION HELPERS
 
-def spks_forced_rand(ntwk, mask, itvl, freq, dt):
+def spks_forced_rand(ntwk, mask, itvl, freq, dt, sparse=False):
     """
     Sample a forced spike matrix from a Poisson distribution.
     
@@ -18,6 +22,8 @@ def spks_forced_rand(ntwk, mask, itvl, freq, dt):
     :param itvl: itvl to force spikes over
     :param freq: freq of forced spikes
     :param dt: simulation timestep
+    :param sparse: whether to return the forced spks as a DriveSchedule
+        (see ntwk_inp.py) instead of a dense array (same spks)
     """
     # generate spks inside itvl
     dur = itvl[1] - itvl[0]
@@ -25,12 +31,20 @@ def spks_forced_rand(ntwk, mask, itvl, freq, dt):
     if mask.dtype == 'bool':
         mask = mask.nonzero()[0]
     
-    spks_forced = np.zeros((int(dur/dt), ntwk.n), dtype=bool)
-    spks_forced[:, mask] = np.random.binomial(
-        1, freq*dt, (len(spks_forced), len(mask)))
+    n_buf = int(itvl[0]/dt)
+    spks_mask = np.random.binomial(1, freq*dt, (int(dur/dt), len(mask)))
+    
+    if sparse:
+        steps, cols = spks_mask.nonzero()
+        
+        return DriveSchedule(
+            n_buf + len(spks_mask), ntwk.n, steps + n_buf, mask[cols], 1)
+    
+    spks_forced = np.zeros((len(spks_mask), ntwk.n), dtype=bool)
+    spks_forced[:, mask] = spks_mask
     
     # buffer spks_forced to start at itvl[0]
-    buf = np.zeros((int(itvl[0]/dt), ntwk.n), dtype=bool)
+    buf = np.zeros((n_buf, ntwk.n), dtype=bool)
     
     return np.concatenate([buf, spks_forced])
 
@@ -56,8 +70,9 @@ def join_w(targs, srcs, ws):
             }
         }
         note: keys given as (targ, src)
+        blocks may be dense arrays or scipy.sparse matrices
     
-    :return: ws_full, a dict of full ws, one per synapse
+    :return: ws_full, a dict of full ws (csr matrices), one per synapse
     """
     # convert targs/srcs to dicts if given as arrays
     if not isinstance(targs, dict):
@@ -93,29 +108,184 @@ def join_w(targs, srcs, ws):
                     'Weight matrix for {}: ({}, {}) does not match '
                     'dimensionality specified by targ/src masks.')
         
+    # idxs of each cell class's members in the full matrices
+    targ_idxs = {targ: mask.nonzero()[0] for targ, mask in targs.items()}
+    src_idxs = {src: mask.nonzero()[0] for src, mask in srcs.items()}
+    
     # loop through synapse types
     dtype = list(list(ws.values())[0].values())[0].dtype
     ws_full = {}
     
     for syn, ws_ in ws.items():
         
-        w = np.zeros((n_targ, n_src), dtype=dtype)
+        rows = []
+        cols = []
+        vals = []
         
-        # loop through population pairs
+        # loop through population pairs, placing each block's nonzero
+        # entries at its populations' idxs
         for (targ, src), w_ in ws_.items():
             
-            # get mask of all cxns from src to targ
-            mask = np.outer(targs[targ], srcs[src])
+            w_ = coo_matrix(w_)
             
-            assert mask.sum() == w_.size
+            rows.append(targ_idxs[targ][w_.row])
+            cols.append(src_idxs[src][w_.col])
+            vals.append(w_.data.astype(dtype, copy=False))
             
-            w[mask] = w_.flatten()
+        w = coo_matrix(
+            (np.concatenate(vals), (np.concatenate(rows), np.concatenate(cols))),
+            shape=(n_targ, n_src), dtype=dtype).tocsr()
+        w.eliminate_zeros()
             
         ws_full[syn] = w
         
     return ws_full
 
 
+def stack_ws(ws, syns, masks=None, drop_empty=True):
+    """
+    Stack a syn-dict of weight matrices from one input source into a single
+    csc operator whose rows cover all synapse types, so that one sparse
+    product yields the inputs to every synapse type.
+    
+    :param ws: syn-dict of (n_targ, n_src) weight matrices
+    :param syns: ordered list of synapse types
+    :param masks: syn-dict of boolean masks of plastic weights, which are
+        excluded from the stacked operator (see PlasticSyns)
+    :param drop_empty: whether to drop synapse types whose (static) weights
+        are all zero
+    
+    :return: stacked csc matrix (row syn_ctr*n_targ + targ), list of
+        synapse types in stacked order
+    """
+    n_src = list(ws.values())[0].shape[1]
+    
+    ws_stacked = []
+    syns_stacked = []
+    
+    for syn in syns:
+        w = csc_matrix(ws[syn])
+        
+        if masks is not None:
+            w = drop_masked(w, masks[syn])
+        
+        if drop_empty and not w.count_nonzero():
+            continue
+            
+        ws_stacked.append(w)
+        syns_stacked.append(syn)
+    
+    if ws_stacked:
+        w_stacked = vstack(ws_stacked, format='csc')
+    else:
+        w_stacked = csc_matrix((0, n_src))
+        
+    return w_stacked, syns_stacked
+
+
+def count_syns(ws, syns):
+    """
+    Count (nonzero) synapses of all types from each src neuron of a
+    syn-dict of weight matrices, i.e., the synaptic events one spk of each
+    src neuron delivers.
+    """
+    w, _ = stack_ws(ws, syns, drop_empty=False)
+    w.eliminate_zeros()
+    
+    return np.diff(w.indptr)
+
+
+def drop_masked(w, mask):
+    """Return csc copy of w without the entries selected by a boolean mask."""
+    rows, cols = mask.nonzero()
+    
+    if not len(rows):
+        return csc_matrix(w)
+    
+    w = w.tocoo()
+    n_src = w.shape[1]
+    
+    keep = ~np.isin(
+        w.row.astype(np.int64)*n_src + w.col, rows.astype(np.int64)*n_src + cols)
+    
+    return csc_matrix(
+        (w.data[keep], (w.row[keep], w.col[keep])), shape=w.shape)
+
+
+def canonical_mask(mask):
+    """
+    Return (dense or sparse) boolean mask as a csr matrix with sorted
+    indices and no explicit False entries, so that its nonzero() lists
+    the selected elements in row-major order.
+    """
+    mask = csr_matrix(mask, dtype=bool)
+    mask.eliminate_zeros()
+    mask.sort_indices()
+    
+    return mask
+
+
+def to_dense(w, dtype):
+    """Return (dense or sparse) matrix as a dense array of type dtype."""
+    if issparse(w):
+        return w.toarray().astype(dtype, copy=False)
+    
+    return np.asarray(w, dtype=dtype)
+
+
+class PlasticSyns(object):
+    """
+    Index arrays of plastic synapses, whose weights (syn-dict of 1-D arrays
+    in row-major mask order, as in ws_plastic) are kept outside the static
+    weight matrices and whose inputs are added to theirs.
+    
+    :param masks: syn-dict of (n_targ, n_src) boolean masks of plastic weights
+    """
+    
+    def __init__(self, masks):
+        """Constructor."""
+        self.n = list(masks.values())[0].shape[0]
+        
+        self.targs = {}
+        self.srcs = {}
+        
+        for syn, mask in masks.items():
+            self.targs[syn], self.srcs[syn] = mask.nonzero()
+            
+        # synapse types with any plastic weights
+        self.syns = [syn for syn in masks if len(self.targs[syn])]
+        
+    def add_inps(self, inps, spks_up, ws):
+        """
+        Add inputs through plastic synapses to a syn-dict of inputs.
+        
+        :param inps: syn-dict of inputs (missing synapse types are zero)
+        :param spks_up: upstream spk vector
+        :param ws: syn-dict of plastic weights
+        
+        :return: updated syn-dict of inputs
+        """
+        for syn in self.syns:
+            inps_plastic = np.bincount(
+                self.targs[syn], weights=ws[syn]*spks_up[self.srcs[syn]],
+                minlength=self.n).astype(ws[syn].dtype, copy=False)
+            
+            if syn in inps:
+                inps[syn] = inps[syn] + inps_plastic
+            else:
+                inps[syn] = inps_plastic
+                
+        return inps
+
+
+def split_inps(inps, syns, n):
+    """
+    Split the output of a stacked weight operator (see stack_ws) into
+    a syn-dict of inputs.
+    """
+    return {syn: inps[ctr*n:(ctr+1)*n] for ctr, syn in enumerate(syns)}
+
+
 # NETWORK CLASS AND FUNCTIONS
 
 class LIFNtwk(object):
@@ -140,11 +310,14 @@ class LIFNtwk(object):
         synapse types, e.g., 'AMPA', 'NMDA', ...)
     :param ts_syn: synaptic time constants (dict)
     :param ws_rcr: recurrent synaptic weight matrices (dict with keys
-        naming synapse types)
-    :param ws_up: input synaptic weight matrices from upstream inputs (dict)
+        naming synapse types; dense or sparse)
+    :param ws_up: input synaptic weight matrices from upstream inputs (dict;
+        dense or sparse)
     :param plasticity: dict of plasticity params with the following keys:
-        'masks': synaptic dict of boolean arrays indicating which synapses in 
-            ws_up are plastic, i.e., which synapses correspond to ST->PC cxns
+        'masks': synaptic dict of boolean arrays (dense or sparse; stored
+            as csr) indicating
+            which synapses in ws_up are plastic, i.e., which synapses
+            correspond to ST->PC cxns
         'w_pc_st_maxs': synaptic dict of max values for plastic weights
         'T_W': timescale of activity-dependent plasticity
         'T_C': timescale of PC spike-counter auxiliary variable
@@ -152,14 +325,24 @@ class LIFNtwk(object):
         'B_C': slope of spike-count nonlinearity
     :param sparse: whether to convert weight matrices to sparse matrices for
         more efficient processing
+    :param dtype: float dtype (np.float64 or np.float32) of weights, params,
+        and smln state; np.float32 halves the memory and memory bandwidth of
+        smlns at the cost of rounding errors that can shift individual spks
+        by a time step, after which trajectories diverge (see
+        seq_replay.smln.check_dtype for a validation of smln metrics)
     """
     
     def __init__(self,
             t_m, e_l, v_th, v_reset, t_r,
             e_ahp=0, t_ahp=np.inf, w_ahp=0,
             es_syn=None, ts_syn=None, ws_up=None, ws_rcr=None, 
-            plasticity=None, sparse=True):
+            plasticity=None, sparse=True, dtype=np.float64):
         """Constructor."""
+        
+        self.dtype = np.dtype(dtype)
+        
+        if self.dtype not in (np.float32, np.float64):
+            raise ValueError('Arg "dtype" must be np.float32 or np.float64.')
 
         # validate arguments
         if es_syn is None:
@@ -179,12 +362,12 @@ class LIFNtwk(object):
         
         self.n = shape_rcr[1]
 
-        # fill in unspecified weight matrices with zeros
+        # fill in unspecified weight matrices with (empty sparse) zeros
         for syn in self.syns:
             if syn not in ws_rcr:
-                ws_rcr[syn] = np.zeros(shape_rcr)
+                ws_rcr[syn] = csc_matrix(shape_rcr)
             if syn not in ws_up:
-                ws_up[syn] = np.zeros(shape_up)
+                ws_up[syn] = csc_matrix(shape_up)
         
         # check syn. dicts have same keys
         if not set(es_syn) == set(ts_syn) == set(ws_rcr) == set(ws_up):
@@ -219,8 +402,8 @@ class LIFNtwk(object):
             if set(plasticity['masks']) != set(ws_up):
                 for syn in ws_up:
                     if syn not in plasticity['masks']:
-                        plasticity['masks'][syn] = np.zeros(
-                            (self.n, self.n_up), bool)
+                        plasticity['masks'][syn] = csr_matrix(
+                            (self.n, self.n_up), dtype=bool)
             # make sure plasticity matrices are boolean and same size as ws_up
             for w in plasticity['masks'].values():
                 if w.shape != (self.n, self.n_up):
@@ -231,6 +414,12 @@ class LIFNtwk(object):
                     raise TypeError(
                         'All matrices in "plasticity[\'masks\']" must be '
                         'logical arrays.')
+            # store masks as csr matrices, whose nonzero entries are listed
+            # in row-major order (the order of the plastic weights)
+            plasticity['masks'] = {
+                syn: canonical_mask(w)
+                for syn, w in plasticity['masks'].items()
+            }
             # make sure max weight values dict has correct synaptic keys
             if set(plasticity['w_pc_st_maxs']) != set(ws_up):
                 raise KeyError(
@@ -240,53 +429,206 @@ class LIFNtwk(object):
         # make sure v_reset is actually an array
         if isinstance(v_reset, (int, float, complex)):
             v_reset = v_reset * np.ones(self.n)
+        
+        # cast per-neuron params (scalars do not upcast arrays), except for
+        # refractory times, which are counted down in steps of dt, so that
+        # float32 rounding would change the number of refractory steps
+        def cast(x):
+            return x.astype(self.dtype) if isinstance(x, np.ndarray) else x
             
         # store network params
-        self.t_m = t_m
-        self.e_l = e_l
-        self.v_th = v_th
-        self.v_reset = v_reset
+        self.t_m = cast(t_m)
+        self.e_l = cast(e_l)
+        self.v_th = cast(v_th)
+        self.v_reset = cast(v_reset)
         self.t_r = t_r
-        self.e_ahp = e_ahp
-        self.t_ahp = t_ahp
-        self.w_ahp = w_ahp
+        self.e_ahp = cast(e_ahp)
+        self.t_ahp = cast(t_ahp)
+        self.w_ahp = cast(w_ahp)
         
-        self.es_syn = es_syn
-        self.ts_syn = ts_syn
+        self.es_syn = {syn: cast(e) for syn, e in es_syn.items()}
+        self.ts_syn = {syn: cast(t) for syn, t in ts_syn.items()}
         
         self.plasticity = plasticity
         if plasticity is not None:
             self.ns_plastic = {
-                syn: w.sum() for syn, w in plasticity['masks'].items()}
+                syn: int(w.sum()) for syn, w in plasticity['masks'].items()}
          
         if sparse:
-            ws_rcr = {syn: csc_matrix(w) for syn, w in ws_rcr.items()}
-            ws_up = {syn: csc_matrix(w) for syn, w in ws_up.items()}
+            ws_rcr = {
+                syn: csc_matrix(w, dtype=self.dtype) for syn, w in ws_rcr.items()}
+            ws_up = {
+                syn: csc_matrix(w, dtype=self.dtype) for syn, w in ws_up.items()}
+        else:
+            ws_rcr = {
+                syn: to_dense(w, self.dtype) for syn, w in ws_rcr.items()}
+            ws_up = {
+                syn: to_dense(w, self.dtype) for syn, w in ws_up.items()}
             
         self.ws_rcr = ws_rcr
         self.ws_up_init = ws_up
 
     def run(
             self, spks_up, dt, vs_0=None, gs_0=None, g_ahp_0=None, i_ext=None,
-            vs_forced=None, spks_forced=None, store=None, report_every=None):
+            vs_forced=None, spks_forced=None, store=None, report_every=None,
+            engine='numpy', propagation='matvec', integrator='euler',
+            dt_ref=None, rec_dir=None, rec_chunk=1000, state_0=None,
+            checkpoint_every=None, checkpoint_file=None, callback=None,
+            callback_every=1000, threads=None, profile=False):
         """
         Run a simulation of the network.
 
         :param spks_up: upstream spiking inputs (rows are time points, 
-            cols are neurons) (should be non-negative integers)
+            cols are neurons) (should be non-negative integers), or an
+            input source (see ntwk_inp.py) producing them block by block
+            as the smln proceeds
         :param dt: integration time step for dynamics simulation
         :param vs_0: initial vs
         :param gs_0: initial gs (dict of 1-D arrays)
         :param g_ahp_0: initial g_ahp (1-D array)
+        :param i_ext: external currents, either 1-D (one value per time
+            point) or 2-D (time points x neurons), or a DriveSchedule (see
+            ntwk_inp.py) of (time step, neuron, current) entries
         :param vs_forced: voltages to force at given time points (rows 
-            are time points, cols are neurons)
+            are time points, cols are neurons, NaN where not forced), or a
+            DriveSchedule of (time step, neuron, voltage) entries
         :param spks_forced: bool array of spikes to force at given time 
-            points (rows are time points, cols are neurons)
+            points (rows are time points, cols are neurons), or a
+            DriveSchedule whose nonzero entries are the forced spks
+        :param store: dict specifying dtype each variable ('vs', 'spks',
+            'gs', 'g_ahp', 'ws_plastic', 'cs') is recorded with (a type or a
+            string such as 'float32'; None to not record it); spks may be recorded as a dense bool array (bool) or
+            as compact SpkEvents ('events'); to record only part of a
+            variable, give a dict with its "dtype" and any of "nrns" (idxs,
+            bool mask, or cell type in self.types_rcr; for ws_plastic the
+            targ neurons of the weights), "steps", "ts", "wdws", and "every"
+            (see ntwk_rec.get_rec_steps); the recorded time steps and
+            neurons are returned in the response's rec_steps and rec_nrns
+        :param engine: 'numpy' to step through the simulation in python, or
+            'compiled' to run the fused, numba-compiled step kernel in
+            ntwk_jit.py (requires numba; matches 'numpy' up to floating
+            point summation order)
+        :param propagation: how recurrent spks are propagated by the 'numpy'
+            engine: 'matvec' to multiply recurrent weights by the full spk
+            vector, or 'event' to only gather the (csc) weight columns of the
+            neurons that spiked, so that cost scales with the number of spks
+            rather than with the number of synapses (results are identical;
+            the 'compiled' engine is always event-driven)
+        :param integrator: 'euler' for forward Euler, or 'exp' for
+            exponential Euler, which decays conductances, AHP, and spk-ctrs
+            exactly, relaxes membrane potentials exactly toward their
+            steady state given the mean conductances over each step, and
+            linearly interpolates threshold crossings within a step so that
+            refractory periods start at sub-step spk times; this remains
+            accurate at larger dt
+        :param dt_ref: time step at which conductance and external current
+            magnitudes are defined when integrator is 'exp' (i.e., a
+            conductance g corresponds to a rate g/dt_ref); set to the
+            Euler dt the weights were tuned at in order to change dt without
+            changing the model (defaults to dt)
+        :param rec_dir: directory to stream recorded traces into as .npy files
+            (e.g., "vs.npy", "gs_E.npy"), holding at most rec_chunk steps
+            of each trace in memory; traces are then returned as read-only
+            memory-mapped arrays (if None, traces are kept in memory)
+        :param rec_chunk: number of time steps of each trace to buffer in
+            memory between writes to rec_dir
+        :param state_0: NtwkState to resume the smln from (overrides vs_0,
+            gs_0, and g_ahp_0); the smln continues at the time step after
+            the one the state was captured at, using the same (full-length)
+            inputs, and only later time steps are recorded
+        :param checkpoint_every: number of time steps between captures of
+            the smln state (at chunk boundaries for the 'compiled' engine)
+        :param checkpoint_file: .npy file to save each captured state to
+            (see NtwkState.load)
+        :param callback: function called with the NtwkState after every
+            callback_every-th time step (with spk counts since the previous
+            call as its "spk_cts"); if it returns True the smln ends there
+            and the response is truncated after that time step
+        :param callback_every: number of time steps between callback calls
+        :param threads: number of threads the 'compiled' engine splits the
+            neurons of each time step across (synchronizing once per step on
+            the spk vector); results are identical for any number of threads
+            (None or 1 to run serially; at most numba's NUMBA_NUM_THREADS
+            threads are used)
+        :param profile: whether to time each phase of the smln loop and
+            count spks and synaptic events at each time step, returning them
+            as the response's "profile" (see NtwkProfile)
 
-        :return: network response object
+        :return: network response object (with final NtwkState as "state")
+        """
+        rsps = self.iter_run(
+            spks_up=spks_up, dt=dt, vs_0=vs_0, gs_0=gs_0, g_ahp_0=g_ahp_0,
+            i_ext=i_ext, vs_forced=vs_forced, spks_forced=spks_forced,
+            store=store, report_every=report_every, engine=engine,
+            propagation=propagation, integrator=integrator, dt_ref=dt_ref,
+            rec_dir=rec_dir, rec_chunk=rec_chunk, state_0=state_0,
+            checkpoint_every=checkpoint_every, checkpoint_file=checkpoint_file,
+            every=callback_every if callback is not None else None,
+            threads=threads, profile=profile)
+        
+        try:
+            state = next(rsps)
+            
+            while True:
+                state = rsps.send(callback(state))
+                
+        except StopIteration as e:
+            return e.value
+        
+    def iter_run(
+            self, spks_up, dt, vs_0=None, gs_0=None, g_ahp_0=None, i_ext=None,
+            vs_forced=None, spks_forced=None, store=None, report_every=None,
+            engine='numpy', propagation='matvec', integrator='euler',
+            dt_ref=None, rec_dir=None, rec_chunk=1000, state_0=None,
+            checkpoint_every=None, checkpoint_file=None, every=1000,
+            threads=None, profile=False):
         """
+        Generator running a simulation of the network (args as in run)
+        that yields the NtwkState after every every-th time step, with the
+        spk counts per neuron since the previous yield as its "spk_cts".
+        
+        Sending True into the generator (instead of calling next) ends the
+        smln after the last yielded state. The NtwkResponse (truncated after
+        the last completed time step) is the generator's return value, i.e.,
+        the "value" of the StopIteration it raises, e.g.:
+        
+            rsps = ntwk.iter_run(spks_up, dt, every=100)
+            
+            try:
+                state = next(rsps)
+                while True:
+                    state = rsps.send(state.spk_cts.sum() > 1000)
+            except StopIteration as e:
+                rsp = e.value
+        
+        :param every: number of time steps between yielded states (None to
+            run to the end without yielding)
+        """
+        if engine not in ('numpy', 'compiled'):
+            raise ValueError('Arg "engine" must be "numpy" or "compiled".')
+        if propagation not in ('matvec', 'event'):
+            raise ValueError('Arg "propagation" must be "matvec" or "event".')
+        if integrator not in ('euler', 'exp'):
+            raise ValueError('Arg "integrator" must be "euler" or "exp".')
+        if threads is not None and threads > 1 and engine != 'compiled':
+            raise ValueError('Arg "threads" requires engine "compiled".')
+        if dt_ref is None:
+            dt_ref = dt
 
+        # phase timer (see NtwkProfile)
+        timer = PhaseTimer(profile)
+        
         # validate arguments
+        if state_0 is not None:
+            state_0.check(self, dt)
+            
+            vs_0 = state_0.vs
+            gs_0 = state_0.gs
+            g_ahp_0 = state_0.g_ahp
+            start = state_0.step + 1
+        else:
+            start = 1
+            
         if vs_0 is None:
             vs_0 = self.e_l * np.ones(self.n)
         if gs_0 is None:
@@ -299,8 +641,9 @@ class LIFNtwk(object):
         if spks_forced is None:
             spks_forced = np.zeros((0, self.n), dtype=bool)
         
-        if type(spks_up) != np.ndarray or spks_up.ndim != 2:
-            raise TypeError('"inps_upstream" must be a 2D array.')
+        if not isinstance(spks_up, InpSource) and (
+                type(spks_up) != np.ndarray or spks_up.ndim != 2):
+            raise TypeError('"inps_upstream" must be a 2D array or InpSource.')
 
         if not spks_up.shape[1] == self.n_up:
             raise ValueError(
@@ -320,45 +663,89 @@ class LIFNtwk(object):
 
         if store is None:
             store = {}
+        else:
+            store = dict(store)
         
         if 'vs' not in store:
-            store['vs'] = np.float64
+            store['vs'] = self.dtype.type
         if 'spks' not in store:
             store['spks'] = bool
         if 'gs' not in store:
-            store['gs'] = np.float64
+            store['gs'] = self.dtype.type
         if 'g_ahp' not in store:
             store['g_ahp'] = store['gs']
         if 'ws_plastic' not in store:
-            store['ws_plastic'] = np.float64
+            store['ws_plastic'] = self.dtype.type
         if 'cs' not in store:
             store['cs'] = store['ws_plastic']
+        
+        # separate dtypes from selections of time steps and neurons to record
+        sels = {}
+        
+        for key, val in store.items():
+            if isinstance(val, dict):
+                sels[key] = dict(val)
+                store[key] = sels[key].pop(
+                    'dtype', bool if key == 'spks' else self.dtype.type)
+                
+        # dtypes may be given as types or strings (e.g., 'float32')
+        store = {key: rec_dtype(val) for key, val in store.items()}
            
         for key, val in store.items():
             
             if key == 'vs':
-                assert val in (None, float, np.float16, np.float64)
+                assert val in (None, float, np.float16, np.float32, np.float64)
             elif key == 'gs':
-                assert val in (None, float, np.float16, np.float64)
+                assert val in (None, float, np.float16, np.float32, np.float64)
             elif key == 'g_ahp':
-                assert val in (None, float, np.float16, np.float64)
+                assert val in (None, float, np.float16, np.float32, np.float64)
             elif key == 'ws_plastic':
-                assert val in (None, float, np.float16, np.float64)
+                assert val in (None, float, np.float16, np.float32, np.float64)
             elif key == 'spks':
-                assert val in (None, bool)
+                assert val in (None, bool, 'events')
             
         # prepare smln
         ts = np.arange(len(spks_up)) * dt
+        
+        # get time steps and neurons to record for each variable
+        rec_steps = {}
+        rec_nrns = {}
+        
+        for key, sel in sels.items():
+            if 'nrns' in sel:
+                rec_nrns[key] = self.get_nrns(sel.pop('nrns'))
+            
+            steps = get_rec_steps(sel, len(ts), dt)
+            if steps is not None:
+                rec_steps[key] = steps
+                
+        # only record time steps after state_0
+        if state_0 is not None:
+            for key in [key for key, val in store.items() if val is not None]:
+                steps = rec_steps.get(key, np.arange(len(ts)))
+                rec_steps[key] = steps[steps >= start]
                   
         # initialize membrane potentials, conductances, and refractory counters
-        vs_prev = vs_0.copy()
+        dtype = self.dtype
+        
+        vs_prev = vs_0.astype(dtype)
         spks_prev = np.zeros(vs_0.shape, dtype=bool)
-        gs_prev = {syn: gs_0[syn].copy() for syn in self.syns}
-        g_ahp_prev = g_ahp_0.copy()
+        gs_prev = {syn: gs_0[syn].astype(dtype) for syn in self.syns}
+        g_ahp_prev = g_ahp_0.astype(dtype)
         rp_ctrs = np.zeros(self.n)
+        
+        if state_0 is not None:
+            spks_prev = state_0.spks.copy()
+            rp_ctrs = state_0.rp_ctrs.astype(float)
                   
-        # allocate space for slmn results and store initial values
-        sim_shape = (len(ts), self.n)
+        # make recorders for smln results and store initial values
+        def recorder(name, n, dtype, key, cols=None):
+            if cols is None:
+                cols = rec_nrns.get(key)
+                
+            return make_recorder(
+                name, len(ts), n, dtype, rec_dir=rec_dir, rec_chunk=rec_chunk,
+                steps=rec_steps.get(key), cols=cols)
         
         vs = None
         spks = None
@@ -366,35 +753,40 @@ class LIFNtwk(object):
         g_ahp = None
         
         if (i_ext is None):
-            i_ext = np.zeros(len(ts))
+            i_ext = np.zeros(len(ts), dtype=dtype)
+        elif not isinstance(i_ext, DriveSchedule):
+            i_ext = np.asarray(i_ext, dtype=dtype)
         
         if store['vs'] is not None:
-            vs = np.nan * np.zeros(sim_shape, dtype=store['vs'])
-            vs[0, :] = vs_prev.copy()
+            vs = recorder('vs', self.n, store['vs'], 'vs')
+            vs.write(0, vs_prev)
                   
         if store['spks'] is not None:
-            spks = np.zeros(sim_shape, dtype=bool)
-            spks[0, :] = spks_prev.copy()
+            spks = recorder('spks', self.n, store['spks'], 'spks')
+            spks.write(0, spks_prev)
                   
         if store['gs'] is not None:
             gs = {
-                syn: np.nan * np.zeros(sim_shape, dtype=store['gs'])
+                syn: recorder('gs_{}'.format(syn), self.n, store['gs'], 'gs')
                 for syn in self.syns
             }
                   
             for syn in self.syns:
-                gs[syn][0, :] = gs_0[syn].copy()
+                gs[syn].write(0, gs_0[syn])
                   
         if store['g_ahp'] is not None:
-            g_ahp = np.nan * np.zeros(sim_shape, dtype=store['g_ahp'])
-            g_ahp[0, :] = g_ahp_0.copy()
+            g_ahp = recorder('g_ahp', self.n, store['g_ahp'], 'g_ahp')
+            g_ahp.write(0, g_ahp_0)
         
         # initialize plasticity variables
         if self.plasticity is not None:
             
             # rename variables to make them more accessible
             masks_plastic = self.plasticity['masks']
-            w_pc_st_maxs = self.plasticity['w_pc_st_maxs']
+            w_pc_st_maxs = {
+                syn: np.asarray(w, dtype=dtype)
+                for syn, w in self.plasticity['w_pc_st_maxs'].items()
+            }
             t_w = self.plasticity['T_W']
             t_c = self.plasticity['T_C']
             c_s = self.plasticity['C_S']
@@ -402,16 +794,16 @@ class LIFNtwk(object):
             
             # set initial values for plasticity and spk ctr
             ws_plastic_prev = {
-                syn: self.ws_up_init[syn][mask]
+                syn: get_masked(self.ws_up_init[syn], mask).astype(dtype)
                 for syn, mask in masks_plastic.items()
             }
-            # correct for shitty sparse matrix handling...
-            for syn in self.syns:
-                temp = np.nan * np.zeros(ws_plastic_prev[syn].shape)
-                temp[:] = ws_plastic_prev[syn][:]
-                ws_plastic_prev[syn] = temp.flatten()
                 
-            cs_prev = np.zeros(self.n)
+            cs_prev = np.zeros(self.n, dtype=dtype)
+            
+            if state_0 is not None:
+                ws_plastic_prev = {
+                    syn: w.astype(dtype) for syn, w in state_0.ws_plastic.items()}
+                cs_prev = state_0.cs.astype(dtype)
             
             # allocate space for plasticity variables
             # NOTE: ws_plastic values are time-series of just the plastic weights
@@ -420,77 +812,258 @@ class LIFNtwk(object):
             cs = None
             
             if store['ws_plastic'] is not None:
-                dtype = store['ws_plastic']
+                
+                # select plastic weights onto selected targ neurons
+                if 'ws_plastic' in rec_nrns:
+                    rec_nrns['ws_plastic'] = {
+                        syn: np.isin(
+                            mask.nonzero()[0], rec_nrns['ws_plastic']
+                        ).nonzero()[0]
+                        for syn, mask in masks_plastic.items()
+                    }
+                    
                 ws_plastic = {
-                    syn: np.nan * np.zeros((len(ts), n_plastic), dtype=dtype)
+                    syn: recorder(
+                        'ws_plastic_{}'.format(syn), n_plastic,
+                        store['ws_plastic'], 'ws_plastic',
+                        cols=rec_nrns.get('ws_plastic', {}).get(syn))
                     for syn, n_plastic in self.ns_plastic.items()
                 }
                   
-                for syn, mask in masks_plastic.items():
-                    ws_plastic[syn][0] = self.ws_up_init[syn][mask].copy()
+                for syn in self.syns:
+                    ws_plastic[syn].write(0, ws_plastic_prev[syn])
                   
             if store['cs'] is not None:
-                cs = np.zeros(sim_shape, dtype=store['cs'])
-                cs[0] = 0
+                cs = recorder('cs', self.n, store['cs'], 'cs')
+                cs.write(0, cs_prev)
             
         else:
             masks_plastic = None
             ws_plastic = None
             cs = None
+            
+            cs_prev = None
+            ws_plastic_prev = None
         
-        # run simulation
-        ws_up = deepcopy(self.ws_up_init)
+        # capture smln state (and save it to checkpoint file)
+        last_checkpoint = start - 1
+        
+        def get_state(step, spk_cts=None):
+            return NtwkState(
+                step=step, dt=dt, vs=vs_prev, spks=spks_prev, gs=gs_prev,
+                g_ahp=g_ahp_prev, rp_ctrs=rp_ctrs, cs=cs_prev,
+                ws_plastic=ws_plastic_prev, spk_cts=spk_cts)
         
+        def checkpoint(step):
+            nonlocal last_checkpoint
+            if checkpoint_every is not None:
+                if step - last_checkpoint >= checkpoint_every:
+                    state = get_state(step)
+                    
+                    if checkpoint_file is not None:
+                        state.save(checkpoint_file)
+                        
+                    last_checkpoint = step
+            
+        # run simulation
         smln_start_time = time.time()
         last_update = time.time()
         
-        for step in range(1, len(ts)):
-
-            ## update dynamics
-            for syn in self.syns:
+        # last completed time step and spk counts since last yielded state
+        last_step = len(ts) - 1
+        spk_cts = np.zeros(self.n)
+        
+        # numbers of spks and synaptic events at each time step, and numbers
+        # of (nonzero) synapses from each upstream and recurrent neuron
+        if profile:
+            step_spks = np.zeros(len(ts), dtype=int)
+            step_events = np.zeros(len(ts), dtype=int)
+            
+            n_syns_up = count_syns(self.ws_up_init, self.syns)
+            n_syns_rcr = count_syns(self.ws_rcr, self.syns)
+        else:
+            step_spks = None
+            step_events = None
+        
+        if engine == 'compiled':
+            try:
+                from ntwk_jit import run_compiled
+            except ImportError:
+                raise ImportError(
+                    'Engine "compiled" requires the "numba" package.')
+                    
+            chunks = run_compiled(
+                self, spks_up=spks_up, dt=dt, i_ext=i_ext,
+                vs_forced=vs_forced, spks_forced=spks_forced,
+                vs_prev=vs_prev, spks_prev=spks_prev, gs_prev=gs_prev,
+                g_ahp_prev=g_ahp_prev, rp_ctrs=rp_ctrs, cs_prev=cs_prev,
+                ws_plastic_prev=ws_plastic_prev, vs=vs, spks=spks, gs=gs,
+                g_ahp=g_ahp, cs=cs, ws_plastic=ws_plastic, spk_cts=spk_cts,
+                integrator=integrator, dt_ref=dt_ref, start=start, every=every,
+                threads=threads, timer=timer, step_spks=step_spks,
+                step_events=step_events)
+            
+            for step in chunks:
+                checkpoint(step)
                 
-                # calculate new conductances for all synapse types
-                w_up = ws_up[syn]
-                w_rcr = self.ws_rcr[syn]
-                t_syn = self.ts_syn[syn]
-
-                # calculate upstream and recurrent inputs to conductances
-                inps_up = w_up.dot(spks_up[step])
-                inps_rcr = w_rcr.dot(spks_prev)
-
-                # decay conductances and add any positive inputs
-                dg = -(dt/t_syn) * gs_prev[syn] + inps_up + inps_rcr
-                gs_prev[syn] = gs_prev[syn] + dg
-             
-            # calculate new AHP inputs
-            inps_ahp = self.w_ahp * spks_prev
+                if report_every is not None:
+                    if time.time() > last_update + report_every:
+                        print('{0}/{1} steps completed after {2:.3f} s...'.format(
+                            step + 1, len(ts), time.time() - smln_start_time))
+                        
+                        last_update = time.time()
+                        
+                if every is not None and step % every == 0:
+                    if (yield get_state(step, spk_cts)):
+                        last_step = step
+                        break
+                    
+                    spk_cts[:] = 0
+                    
+                timer.lap('other')
             
-            # decay ahp conductance and add new inputs
-            dg_ahp = (-dt/self.t_ahp) * g_ahp_prev + inps_ahp
-            g_ahp_prev = g_ahp_prev + dg_ahp
-                  
-            # calculate current input resulting from synaptic conductances
-            ## note: conductances are relative, so is_g are in volts
-            is_g = [
-                gs_prev[syn] * (self.es_syn[syn] - vs_prev)
-                for syn in self.syns
-            ]
+            steps = range(0)
+        else:
+            steps = range(start, len(ts))
+            
+            # stack static weights into one operator per input source,
+            # dropping all-zero synapse types, and keep plastic ones apart
+            w_up, syns_up = stack_ws(self.ws_up_init, self.syns, masks_plastic)
+            w_rcr, syns_rcr = stack_ws(self.ws_rcr, self.syns)
+            
+            if self.plasticity is not None:
+                plastic = PlasticSyns(masks_plastic)
+                
+            no_inps = np.zeros(self.n, dtype=dtype)
+            
+            # get exact decay factors
+            if integrator == 'exp':
+                decays_syn = {}
+                avgs_syn = {}
+                
+                for syn in self.syns:
+                    decays_syn[syn], avgs_syn[syn] = exp_factors(
+                        dt, self.ts_syn[syn], dtype)
+                    
+                decay_ahp, avg_ahp = exp_factors(dt, self.t_ahp, dtype)
+                
+            timer.lap('setup')
+        
+        for step in steps:
             
-            # add in AHP current
-            is_g.append(g_ahp_prev * (self.e_ahp - vs_prev))
+            # calculate upstream and recurrent inputs to conductances
+            spks_up_step = spks_up[step].astype(dtype)
             
-            # get total input current
-            is_all = np.sum(is_g, axis=0) + i_ext[step]
+            inps_up = split_inps(w_up.dot(spks_up_step), syns_up, self.n)
             
-            # update membrane potential
-            dvs = -(dt/self.t_m) * (vs_prev - self.e_l) + is_all
-            vs_prev = vs_prev + dvs
+            if self.plasticity is not None:
+                inps_up = plastic.add_inps(
+                    inps_up, spks_up_step, ws_plastic_prev)
+                
+            timer.lap('inps_up')
             
-            # force refractory neurons to reset potential
-            vs_prev[rp_ctrs > 0] = self.v_reset[rp_ctrs > 0]
+            if propagation == 'event':
+                inps_rcr = propagate_spks(w_rcr, spks_prev.nonzero()[0])
+            else:
+                inps_rcr = w_rcr.dot(spks_prev)
+                
+            inps_rcr = split_inps(inps_rcr, syns_rcr, self.n)
+            
+            timer.lap('inps_rcr')
+            
+            if profile:
+                step_events[step] = n_syns_up.dot(spks_up[step]) \
+                    + n_syns_rcr[spks_prev].sum()
+
+            ## update dynamics
+            if integrator == 'euler':
+                
+                for syn in self.syns:
+                    
+                    # calculate new conductances for all synapse types
+                    t_syn = self.ts_syn[syn]
+
+                    # decay conductances and add any positive inputs
+                    dg = -(dt/t_syn) * gs_prev[syn] \
+                        + inps_up.get(syn, no_inps) + inps_rcr.get(syn, no_inps)
+                    gs_prev[syn] = gs_prev[syn] + dg
+                 
+                # calculate new AHP inputs
+                inps_ahp = self.w_ahp * spks_prev.astype(dtype)
+                
+                # decay ahp conductance and add new inputs
+                dg_ahp = (-dt/self.t_ahp) * g_ahp_prev + inps_ahp
+                g_ahp_prev = g_ahp_prev + dg_ahp
+                      
+                # calculate current input resulting from synaptic conductances
+                ## note: conductances are relative, so is_g are in volts
+                is_g = [
+                    gs_prev[syn] * (self.es_syn[syn] - vs_prev)
+                    for syn in self.syns
+                ]
+                
+                # add in AHP current
+                is_g.append(g_ahp_prev * (self.e_ahp - vs_prev))
+                
+                # get total input current
+                is_all = np.sum(is_g, axis=0)
+                
+                if isinstance(i_ext, DriveSchedule):
+                    i_ext.add_to(is_all, step)
+                else:
+                    is_all = is_all + i_ext[step]
+                
+                # update membrane potential
+                dvs = -(dt/self.t_m) * (vs_prev - self.e_l) + is_all
+                vs_prev = vs_prev + dvs
+                
+                # force refractory neurons to reset potential
+                vs_prev[rp_ctrs > 0] = self.v_reset[rp_ctrs > 0]
+                
+            else:
+                
+                # decay conductances exactly and add inputs
+                for syn in self.syns:
+                    gs_prev[syn] = decays_syn[syn] * gs_prev[syn] \
+                        + inps_up.get(syn, no_inps) + inps_rcr.get(syn, no_inps)
+                    
+                g_ahp_prev = decay_ahp * g_ahp_prev \
+                    + self.w_ahp * spks_prev.astype(dtype)
+                
+                # get mean conductances over step, converted to rates
+                gs_avg = [
+                    avgs_syn[syn] * gs_prev[syn] / dt_ref for syn in self.syns]
+                g_ahp_avg = avg_ahp * g_ahp_prev / dt_ref
+                
+                # get membrane rate constant and steady-state potential
+                a = 1/self.t_m + np.sum(gs_avg, axis=0) + g_ahp_avg
+                b = self.e_l/self.t_m + np.sum(
+                    [g * self.es_syn[syn] for g, syn in zip(gs_avg, self.syns)],
+                    axis=0) + g_ahp_avg * self.e_ahp
+                
+                if isinstance(i_ext, DriveSchedule):
+                    nrns, i_ext_step = i_ext.entries(step)
+                    np.add.at(b, nrns, i_ext_step / dt_ref)
+                else:
+                    b = b + i_ext[step] / dt_ref
+                    
+                vs_inf = b / a
+                
+                # relax toward steady state, starting from reset potential
+                # for neurons leaving refractory period within step
+                dts_free = np.clip(dt - rp_ctrs, 0, dt).astype(dtype)
+                vs_start = np.where(rp_ctrs > 0, self.v_reset, vs_prev)
+                vs_prev = vs_inf + (vs_start - vs_inf) * np.exp(-a * dts_free)
+                
+                # get time from interpolated threshold crossing to end of step
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    fracs = (self.v_th - vs_start) / (vs_prev - vs_start)
+                ts_since_spk = np.nan_to_num((1 - np.clip(fracs, 0, 1)) * dts_free)
             
             # force vs if desired
-            if step < len(vs_forced):
+            if isinstance(vs_forced, DriveSchedule):
+                vs_forced.set_in(vs_prev, step)
+            elif step < len(vs_forced):
                 mask = ~np.isnan(vs_forced[step])
                 vs_prev[mask] = vs_forced[step][mask]
             
@@ -498,66 +1071,84 @@ class LIFNtwk(object):
             spks_prev = vs_prev >= self.v_th
                   
             # force extra spks if desired
-            if step < len(spks_forced):
+            if isinstance(spks_forced, DriveSchedule):
+                spks_forced.set_in(spks_prev, step)
+            elif step < len(spks_forced):
                 spks_prev[spks_forced[step] == 1] = 1
                    
             # reset membrane potentials of spiking neurons
             vs_prev[spks_prev] = self.v_reset[spks_prev]
             
-            # set refractory counters for spiking neurons
-            rp_ctrs[spks_prev] = self.t_r[spks_prev]
-            # decrement refractory counters for all neurons
-            rp_ctrs -= dt
-            # adjust negative refractory counters up to zero
-            rp_ctrs[rp_ctrs < 0] = 0
+            if integrator == 'euler':
+                # set refractory counters for spiking neurons
+                rp_ctrs[spks_prev] = self.t_r[spks_prev]
+                # decrement refractory counters for all neurons
+                rp_ctrs -= dt
+                # adjust negative refractory counters up to zero
+                rp_ctrs[rp_ctrs < 0] = 0
+            else:
+                # decrement refractory counters, then set remaining
+                # refractory time for spiking neurons
+                rp_ctrs = np.maximum(rp_ctrs - dt, 0)
+                rp_ctrs[spks_prev] = np.maximum(
+                    self.t_r - ts_since_spk, 0)[spks_prev]
+            
+            if profile:
+                step_spks[step] = spks_prev.sum()
+                
+            timer.lap('dynamics')
             
             ## update plastic weights
             if self.plasticity is not None:
                 
                 # calculate and store updated spk-ctr
                 cs_prev = update_spk_ctr(
-                    spks=spks_prev, cs_prev=cs_prev, t_c=t_c, dt=dt)
+                    spks=spks_prev, cs_prev=cs_prev, t_c=t_c, dt=dt,
+                    integrator=integrator)
                 
                 # calculate new weight values for each syn type
                 for syn in self.syns:
                 
                     # reshape spk-ctr variable to align with updated weights
-                    cs_prev_syn = cs_prev[masks_plastic[syn].nonzero()[0]]
+                    cs_prev_syn = cs_prev[plastic.targs[syn]]
                     
                     # update weight values
                     ws_plastic_prev[syn] = update_plastic_weights(
                         cs=cs_prev_syn, ws_prev=ws_plastic_prev[syn],
                         c_s=c_s, b_c=b_c, t_w=t_w,
-                        w_pc_st_max=w_pc_st_maxs[syn], dt=dt)
-
-                # insert updated weights into ws_up
-                for syn, mask in masks_plastic.items():
-                    ws_up[syn][mask] = ws_plastic_prev[syn]
+                        w_pc_st_max=w_pc_st_maxs[syn], dt=dt,
+                        integrator=integrator)
+                    
+                timer.lap('plasticity')
                   
             # store vs
             if store['vs'] is not None:
-                vs[step] = vs_prev.copy()
+                vs.write(step, vs_prev)
             
             # store spks
             if store['spks'] is not None:
-                spks[step] = spks_prev.copy()
+                spks.write(step, spks_prev)
 
             # store conductances
             if store['gs'] is not None:
                 for syn in self.syns:
-                    gs[syn][step] = gs_prev[syn].copy()
+                    gs[syn].write(step, gs_prev[syn])
                   
             # store ahp conductance
             if store['g_ahp'] is not None:
-                g_ahp[step] = g_ahp_prev.copy()
+                g_ahp.write(step, g_ahp_prev)
 
             if self.plasticity is not None:
                 if store['ws_plastic'] is not None:
                     for syn in self.syns:
-                        ws_plastic[syn][step] = ws_plastic_prev[syn].copy()
+                        ws_plastic[syn].write(step, ws_plastic_prev[syn])
                   
                 if store['cs'] is not None:
-                    cs[step] = cs_prev.copy()
+                    cs.write(step, cs_prev)
+                    
+            timer.lap('record')
+            
+            checkpoint(step)
             
             if report_every is not None:
                 if time.time() > last_update + report_every:
@@ -566,7 +1157,65 @@ class LIFNtwk(object):
                         step + 1, len(ts), time.time() - smln_start_time))
                     
                     last_update = time.time()
+                    
+            if every is not None:
+                spk_cts += spks_prev
+                
+                if step % every == 0:
+                    if (yield get_state(step, spk_cts)):
+                        last_step = step
+                        break
+                    
+                    spk_cts[:] = 0
+                    
+            timer.lap('other')
         
+        # get recorded traces
+        if vs is not None:
+            vs = vs.finalize()
+        if spks is not None:
+            spks = spks.finalize()
+        if gs is not None:
+            gs = {syn: gs[syn].finalize() for syn in self.syns}
+        if g_ahp is not None:
+            g_ahp = g_ahp.finalize()
+        if cs is not None:
+            cs = cs.finalize()
+        if ws_plastic is not None:
+            ws_plastic = {syn: ws_plastic[syn].finalize() for syn in self.syns}
+        
+        # truncate traces after last completed time step
+        if last_step < len(ts) - 1:
+            
+            def truncate(x, key):
+                if x is None:
+                    return None
+                elif isinstance(x, SpkEvents):
+                    return x.window(0, last_step + 1)
+                elif key in rec_steps:
+                    return x[:(rec_steps[key] <= last_step).sum()]
+                else:
+                    return x[:last_step + 1]
+                
+            vs = truncate(vs, 'vs')
+            spks = truncate(spks, 'spks')
+            g_ahp = truncate(g_ahp, 'g_ahp')
+            cs = truncate(cs, 'cs')
+            
+            if gs is not None:
+                gs = {syn: truncate(gs[syn], 'gs') for syn in self.syns}
+            if ws_plastic is not None:
+                ws_plastic = {
+                    syn: truncate(ws_plastic[syn], 'ws_plastic')
+                    for syn in self.syns
+                }
+                
+            ts = ts[:last_step + 1]
+            rec_steps = {
+                key: steps[steps <= last_step]
+                for key, steps in rec_steps.items()
+            }
+            
         if self.plasticity is not None:
             if store['ws_plastic'] is None:
                 ws_plastic = {
@@ -574,31 +1223,501 @@ class LIFNtwk(object):
                     for syn in self.syns
                 }
                 
+        timer.lap('record')
+        
+        if profile:
+            profile = NtwkProfile(
+                engine=engine, times=timer.times,
+                step_spks=step_spks[:last_step + 1],
+                step_events=step_events[:last_step + 1], threads=threads)
+        else:
+            profile = None
+                
         # return NtwkResponse object
         return NtwkResponse(
             ts=ts, vs=vs, spks=spks, v_rest=self.e_l, v_th=self.v_th,
             gs=gs, g_ahp=g_ahp, ws_rcr=self.ws_rcr, ws_up=self.ws_up_init,
-            cs=cs, ws_plastic=ws_plastic, masks_plastic=masks_plastic)
+            cs=cs, ws_plastic=ws_plastic, masks_plastic=masks_plastic,
+            rec_steps=rec_steps, rec_nrns=rec_nrns,
+            state=get_state(last_step), profile=profile)
+    
+    def get_nrns(self, nrns):
+        """
+        Return idxs of neurons specified by idxs, a bool mask, or a cell
+        type (e.g., 'PC'; requires the ntwk to have a types_rcr array).
+        """
+        if isinstance(nrns, str):
+            if getattr(self, 'types_rcr', None) is None:
+                raise ValueError(
+                    'Selecting neurons by cell type requires ntwk to have '
+                    'attribute "types_rcr".')
+            return (np.asarray(self.types_rcr) == nrns).nonzero()[0]
+        
+        nrns = np.asarray(nrns)
+        
+        if nrns.dtype == bool:
+            if not nrns.shape == (self.n,):
+                raise ValueError(
+                    'Neuron mask must be 1-D array with one element per neuron.')
+            return nrns.nonzero()[0]
+        else:
+            return nrns.astype(int)
+
+
+class LIFNtwkEnsemble(object):
+    """
+    Ensemble of K LIF ntwks with identical sizes and synapse types (but
+    possibly different params, weights, and inputs) that are simulated in
+    a single shared time loop.
+    
+    The members are stacked into one LIFNtwk of K*N neurons with
+    block-diagonal weight matrices, so that the state (vs, gs, g_ahp,
+    rp_ctrs, cs, plastic weights) is held as a K x N array (flattened in
+    row-major order) and each step costs one sparse product per synapse type
+    for the whole ensemble. Since the blocks do not interact, each member's
+    response is identical to that of running it alone (up to floating
+    point summation order with engine='compiled').
+    
+    :param ntwks: list of LIFNtwk instances; plasticity must either be None
+        for all or given for all with identical "T_W", "T_C", "C_S", and "B_C"
+    """
+    
+    def __init__(self, ntwks):
+        """Constructor."""
+        
+        ntwks = list(ntwks)
+        
+        if not ntwks:
+            raise ValueError('Arg "ntwks" must contain at least one LIFNtwk.')
+        
+        ntwk_0 = ntwks[0]
+        
+        # check ensemble members are compatible
+        for ntwk in ntwks[1:]:
+            if (ntwk.n, ntwk.n_up) != (ntwk_0.n, ntwk_0.n_up):
+                raise ValueError(
+                    'All ensemble ntwks must have same "n" and "n_up".')
+            if set(ntwk.syns) != set(ntwk_0.syns):
+                raise ValueError(
+                    'All ensemble ntwks must have same synapse types.')
+            if ntwk.dtype != ntwk_0.dtype:
+                raise ValueError('All ensemble ntwks must have same dtype.')
+            if (ntwk.plasticity is None) != (ntwk_0.plasticity is None):
+                raise ValueError(
+                    'Plasticity must be specified for all or no ensemble ntwks.')
+            if ntwk.plasticity is not None:
+                for key in ['T_W', 'T_C', 'C_S', 'B_C']:
+                    if ntwk.plasticity[key] != ntwk_0.plasticity[key]:
+                        raise ValueError(
+                            'Plasticity param "{}" must be same for all '
+                            'ensemble ntwks.'.format(key))
+        
+        self.ntwks = ntwks
+        self.k = len(ntwks)
+        self.n = ntwk_0.n
+        self.n_up = ntwk_0.n_up
+        self.syns = ntwk_0.syns
+        
+        n = self.n
+        
+        # stack per-neuron params
+        def per_nrn(attr, syn=None):
+            xs = [getattr(ntwk, attr) for ntwk in ntwks]
+            if syn is not None:
+                xs = [x[syn] for x in xs]
+            return np.concatenate([np.broadcast_to(x, (n,)) for x in xs])
+        
+        # stack weight matrices block-diagonally
+        def stack_ws(attr):
+            return {
+                syn: block_diag(
+                    [getattr(ntwk, attr)[syn] for ntwk in ntwks], format='csc')
+                for syn in self.syns
+            }
+        
+        if ntwk_0.plasticity is not None:
+            
+            w_pc_st_maxs = {}
+            
+            for syn in self.syns:
+                w_pc_st_maxs[syn] = np.concatenate([
+                    np.broadcast_to(
+                        ntwk.plasticity['w_pc_st_maxs'][syn],
+                        (ntwk.ns_plastic[syn],))
+                    for ntwk in ntwks
+                ])
+                
+            plasticity = {
+                'masks': {
+                    syn: block_diag([
+                        ntwk.plasticity['masks'][syn] for ntwk in ntwks
+                    ], format='csr')
+                    for syn in self.syns
+                },
+                'w_pc_st_maxs': w_pc_st_maxs,
+                'T_W': ntwk_0.plasticity['T_W'],
+                'T_C': ntwk_0.plasticity['T_C'],
+                'C_S': ntwk_0.plasticity['C_S'],
+                'B_C': ntwk_0.plasticity['B_C'],
+            }
+        else:
+            plasticity = None
+            
+        self.ntwk = LIFNtwk(
+            t_m=per_nrn('t_m'),
+            e_l=per_nrn('e_l'),
+            v_th=per_nrn('v_th'),
+            v_reset=per_nrn('v_reset'),
+            t_r=per_nrn('t_r'),
+            e_ahp=per_nrn('e_ahp'),
+            t_ahp=per_nrn('t_ahp'),
+            w_ahp=per_nrn('w_ahp'),
+            es_syn={syn: per_nrn('es_syn', syn) for syn in self.syns},
+            ts_syn={syn: per_nrn('ts_syn', syn) for syn in self.syns},
+            ws_up=stack_ws('ws_up_init'),
+            ws_rcr=stack_ws('ws_rcr'),
+            plasticity=plasticity,
+            dtype=ntwk_0.dtype)
+        
+    def run(
+            self, spks_ups, dt, i_exts=None, vs_forced=None, spks_forced=None,
+            store=None, report_every=None, engine='numpy', integrator='euler',
+            dt_ref=None, rec_dir=None, rec_chunk=1000, state_0=None,
+            checkpoint_every=None, checkpoint_file=None, callback=None,
+            callback_every=1000, threads=None, profile=False):
+        """
+        Run simulations of all ensemble ntwks in one shared time loop.
+        
+        :param spks_ups: list of K upstream spiking input arrays or input
+            sources (all of same length), or 3D array with K as 2nd dim,
+            i.e., (T, K, n_up)
+        :param dt: integration time step
+        :param i_exts: list of K external current inputs, each either 1-D
+            (one value per time point) or 2-D (time points x neurons), or a
+            DriveSchedule
+        :param vs_forced: list of K forced voltage arrays or DriveSchedules
+            (see LIFNtwk.run)
+        :param spks_forced: list of K forced spk arrays or DriveSchedules
+            (see LIFNtwk.run)
+        :param store: as in LIFNtwk.run (neuron selections are applied to
+            each member)
+        :param report_every: as in LIFNtwk.run
+        :param engine: as in LIFNtwk.run
+        :param integrator: as in LIFNtwk.run
+        :param dt_ref: as in LIFNtwk.run
+        :param rec_dir: as in LIFNtwk.run (traces of all members are
+            streamed into the same files)
+        :param rec_chunk: as in LIFNtwk.run
+        :param state_0: list of K member NtwkStates, or NtwkState of the
+            stacked ntwk (e.g., as saved to checkpoint_file), to resume from
+        :param checkpoint_every: as in LIFNtwk.run
+        :param checkpoint_file: as in LIFNtwk.run (saves state of the
+            stacked ntwk)
+        :param callback: as in LIFNtwk.run (called with state of the
+            stacked ntwk; ends the smlns of all members)
+        :param callback_every: as in LIFNtwk.run
+        :param threads: as in LIFNtwk.run
+        :param profile: as in LIFNtwk.run (all members' responses get the
+            profile of the shared time loop, whose spk and synaptic event
+            counts are summed over members)
+        
+        :return: list of K network response objects
+        """
+        k = self.k
+        n = self.n
+        
+        # join member inputs along neuron dimension
+        if isinstance(spks_ups, np.ndarray) and spks_ups.ndim == 3:
+            spks_ups = [spks_ups[:, ctr] for ctr in range(spks_ups.shape[1])]
+            
+        if len(spks_ups) != k:
+            raise ValueError('Arg "spks_ups" must have one item per ntwk.')
+        
+        n_t = len(spks_ups[0])
+        
+        if not all([len(spks_up) == n_t for spks_up in spks_ups]):
+            raise ValueError(
+                'All items in "spks_ups" must have same number of time points.')
+            
+        if any([isinstance(spks_up, InpSource) for spks_up in spks_ups]):
+            spks_up = JoinedInps(spks_ups)
+        else:
+            spks_up = np.concatenate(spks_ups, axis=1)
+        
+        def join_sparse(xs, fill):
+            # join drive of members as one schedule if any is sparse
+            return DriveSchedule.join([
+                x if isinstance(x, DriveSchedule) else
+                DriveSchedule.from_dense(x, n, fill) if x is not None else
+                DriveSchedule(0, n, [], [], [])
+                for x in xs
+            ], n)
+        
+        def any_sparse(xs):
+            return any([isinstance(x, DriveSchedule) for x in xs])
+        
+        if i_exts is not None and any_sparse(i_exts):
+            i_ext = join_sparse(i_exts, 0.)
+        elif i_exts is not None:
+            i_ext = np.zeros((n_t, k*n))
+            for ctr, i_ext_ in enumerate(i_exts):
+                if i_ext_ is not None:
+                    i_ext_ = np.asarray(i_ext_)
+                    if i_ext_.ndim == 1:
+                        i_ext_ = i_ext_[:, None]
+                    i_ext[:, ctr*n:(ctr+1)*n] = i_ext_
+        else:
+            i_ext = None
+        
+        def join_forced(xs, fill, dtype):
+            # pad forced arrays to common length
+            xs = [x if x is not None else np.zeros((0, n)) for x in xs]
+            n_t_forced = max([len(x) for x in xs])
+            
+            x_joined = np.full((n_t_forced, k*n), fill, dtype=dtype)
+            for ctr, x in enumerate(xs):
+                x_joined[:len(x), ctr*n:(ctr+1)*n] = x
+                
+            return x_joined
+        
+        if vs_forced is not None and any_sparse(vs_forced):
+            vs_forced = join_sparse(vs_forced, np.nan)
+        elif vs_forced is not None:
+            vs_forced = join_forced(vs_forced, np.nan, float)
+            
+        if spks_forced is not None and any_sparse(spks_forced):
+            spks_forced = join_sparse(spks_forced, 0.)
+        elif spks_forced is not None:
+            spks_forced = join_forced(spks_forced, False, bool)
+            
+        if isinstance(state_0, (list, tuple)):
+            state_0 = NtwkState.join(state_0)
+        
+        # apply neuron selections to each member
+        if store is not None:
+            store = dict(store)
+            
+            for key, val in store.items():
+                if isinstance(val, dict) and 'nrns' in val:
+                    store[key] = dict(val)
+                    store[key]['nrns'] = np.concatenate([
+                        ntwk.get_nrns(val['nrns']) + ctr*n
+                        for ctr, ntwk in enumerate(self.ntwks)
+                    ])
+            
+        rsp = self.ntwk.run(
+            spks_up=spks_up, dt=dt, i_ext=i_ext, vs_forced=vs_forced,
+            spks_forced=spks_forced, store=store, report_every=report_every,
+            engine=engine, integrator=integrator, dt_ref=dt_ref,
+            rec_dir=rec_dir, rec_chunk=rec_chunk, state_0=state_0,
+            checkpoint_every=checkpoint_every, checkpoint_file=checkpoint_file,
+            callback=callback, callback_every=callback_every, threads=threads,
+            profile=profile)
+        
+        return self.split(rsp)
+    
+    def split(self, rsp):
+        """
+        Split a response of the stacked ntwk into one response per member.
+        """
+        n = self.n
+        rsps = []
+        
+        # offsets of each member's plastic weights
+        if self.ntwk.plasticity is not None:
+            offsets = {
+                syn: np.cumsum([0] + [ntwk.ns_plastic[syn] for ntwk in self.ntwks])
+                for syn in self.syns
+            }
+        
+        rec_nrns = rsp.rec_nrns or {}
+        
+        for ctr, ntwk in enumerate(self.ntwks):
+            
+            # get member's cols of each recorded trace
+            cols = {}
+            rec_nrns_ = {}
+            
+            for key in ['vs', 'spks', 'gs', 'g_ahp', 'cs']:
+                if key in rec_nrns:
+                    mask = rec_nrns[key] // n == ctr
+                    cols[key] = mask.nonzero()[0]
+                    rec_nrns_[key] = rec_nrns[key][mask] - ctr*n
+                else:
+                    cols[key] = slice(ctr*n, (ctr+1)*n)
+                    
+            if rsp.ws_plastic is not None:
+                cols['ws_plastic'] = {}
+                
+                for syn in self.syns:
+                    start, end = offsets[syn][ctr], offsets[syn][ctr+1]
+                    
+                    if 'ws_plastic' in rec_nrns:
+                        sel = rec_nrns['ws_plastic'][syn]
+                        mask = (start <= sel) & (sel < end)
+                        cols['ws_plastic'][syn] = mask.nonzero()[0]
+                        rec_nrns_.setdefault('ws_plastic', {})[syn] = \
+                            sel[mask] - start
+                    else:
+                        cols['ws_plastic'][syn] = slice(start, end)
+            
+            def get(x, cols_):
+                if x is None:
+                    return None
+                elif isinstance(x, SpkEvents):
+                    if isinstance(cols_, slice):
+                        cols_ = np.arange(cols_.start, cols_.stop)
+                    return x.select(cols_)
+                else:
+                    return x[:, cols_]
+            
+            if rsp.gs is not None:
+                gs = {syn: get(rsp.gs[syn], cols['gs']) for syn in self.syns}
+            else:
+                gs = None
+            
+            if rsp.ws_plastic is not None:
+                ws_plastic = {
+                    syn: get(rsp.ws_plastic[syn], cols['ws_plastic'][syn])
+                    for syn in self.syns
+                }
+                masks_plastic = ntwk.plasticity['masks']
+            else:
+                ws_plastic = None
+                masks_plastic = None
+            
+            # get member's final state
+            state = rsp.state
+            sl = slice(ctr*n, (ctr+1)*n)
+            
+            if state.ws_plastic is not None:
+                ws_plastic_state = {
+                    syn: state.ws_plastic[syn][
+                        offsets[syn][ctr]:offsets[syn][ctr+1]]
+                    for syn in self.syns
+                }
+            else:
+                ws_plastic_state = None
+                
+            state = NtwkState(
+                step=state.step, dt=state.dt, vs=state.vs[sl],
+                spks=state.spks[sl],
+                gs={syn: state.gs[syn][sl] for syn in self.syns},
+                g_ahp=state.g_ahp[sl], rp_ctrs=state.rp_ctrs[sl],
+                cs=state.cs[sl] if state.cs is not None else None,
+                ws_plastic=ws_plastic_state)
+            
+            rsps.append(NtwkResponse(
+                ts=rsp.ts, vs=get(rsp.vs, cols['vs']),
+                spks=get(rsp.spks, cols['spks']), v_rest=ntwk.e_l,
+                v_th=ntwk.v_th, gs=gs, g_ahp=get(rsp.g_ahp, cols['g_ahp']),
+                ws_rcr=ntwk.ws_rcr, ws_up=ntwk.ws_up_init,
+                cs=get(rsp.cs, cols['cs']), ws_plastic=ws_plastic,
+                masks_plastic=masks_plastic, rec_steps=rsp.rec_steps,
+                rec_nrns=rec_nrns_, state=state, profile=rsp.profile))
+            
+        return rsps
+
+
+def get_masked(w, mask):
+    """
+    Return 1-D array of the elements of a (dense or sparse) matrix selected
+    by a boolean mask, in row-major order.
+    """
+    rows, cols = mask.nonzero()
+    w_masked = w[rows, cols]
+    
+    if issparse(w_masked):
+        w_masked = w_masked.toarray()
+        
+    return np.array(w_masked, dtype=float).flatten()
+
+
+def set_masked(w, mask, vals):
+    """
+    Return csc copy of a (dense or sparse) matrix with the elements
+    selected by a boolean mask set to vals (in row-major order, as returned
+    by get_masked).
+    """
+    rows, cols = canonical_mask(mask).nonzero()
+    w = csc_matrix(w)
+    
+    w_set = csc_matrix(
+        (np.broadcast_to(vals, rows.shape).astype(w.dtype), (rows, cols)),
+        shape=w.shape)
+    
+    w = drop_masked(w, mask) + w_set
+    w.eliminate_zeros()
+    
+    return w
+
+
+def propagate_spks(w, spk_idxs):
+    """
+    Compute recurrent inputs w.dot(spks) by summing only the weight
+    columns of the spiking neurons.
+    
+    :param w: csc weight matrix (rows are targs, cols are srcs)
+    :param spk_idxs: idxs of src neurons that spiked
+    
+    :return: 1-D array of inputs to targ neurons
+    """
+    # get positions in w.data/w.indices of all cxns from spiking nrns
+    starts = w.indptr[spk_idxs]
+    lens = w.indptr[spk_idxs + 1] - starts
+    
+    if not lens.sum():
+        return np.zeros(w.shape[0], dtype=w.dtype)
+    
+    pos = np.repeat(starts - np.cumsum(lens) + lens, lens) \
+        + np.arange(lens.sum())
+    
+    # accumulate cxn weights onto targs (in same order as w.dot)
+    return np.bincount(
+        w.indices[pos], weights=w.data[pos], minlength=w.shape[0]
+    ).astype(w.dtype, copy=False)
+
+
+def exp_factors(dt, t, dtype=float):
+    """
+    Get factors for exact exponential decay with time constant t over a
+    time step dt (computed in double precision and cast to dtype).
+    
+    :return: decay factor exp(-dt/t), mean of exp(-s/t) over s in [0, dt]
+    """
+    t = np.asarray(t, dtype=float)
+    
+    decay = np.exp(-dt/t)
+    
+    with np.errstate(divide='ignore', invalid='ignore'):
+        avg = np.where(np.isinf(t), 1., -np.expm1(-dt/t) * t / dt)
+        
+    return decay.astype(dtype), avg.astype(dtype)
 
 
 def z(c, c_s, b_c):
     return 1 / (1 + np.exp(-(c - c_s)/b_c))
 
 
-def update_spk_ctr(spks, cs_prev, t_c, dt):
+def update_spk_ctr(spks, cs_prev, t_c, dt, integrator='euler'):
     """
     Update the spk-ctr auxiliary variable.
     :param spks: multi-unit spk vector from current time step
     :param cs_prev: spk-ctrs for all cells at previous time step
     :param t_c: spk-ctr time constant (see parameters.ipynb)
     :param dt: numerical integration time step
+    :param integrator: 'euler' or 'exp' (exact exponential decay)
     """
-    dc = -cs_prev * dt / t_c + spks.astype(float)
+    if integrator == 'exp':
+        return float(np.exp(-dt/t_c)) * cs_prev + spks.astype(cs_prev.dtype)
+    
+    dc = -cs_prev * dt / t_c + spks.astype(cs_prev.dtype)
 
     return cs_prev + dc
 
 
-def update_plastic_weights(cs, ws_prev, c_s, b_c, t_w, w_pc_st_max, dt):
+def update_plastic_weights(
+        cs, ws_prev, c_s, b_c, t_w, w_pc_st_max, dt, integrator='euler'):
     """
     Update the plastic cxns from ST to PC.
     
@@ -609,22 +1728,224 @@ def update_plastic_weights(cs, ws_prev, c_s, b_c, t_w, w_pc_st_max, dt):
     :param t_w: weight change timescale (see dynamics.ipynb)
     :param w_pc_st_max: syn-dict of maximum ST->PC weight values
     :param dt: numerical integration time step
+    :param integrator: 'euler' or 'exp' (exact relaxation toward w_pc_st_max
+        given spk-ctrs held fixed over step)
     """
     if cs.shape != ws_prev.shape:
         raise ValueError(
             'Spk-ctr "cs" and plastic weights "ws_prev" must have same shape.')
+    
+    if integrator == 'exp':
+        return w_pc_st_max \
+            - (w_pc_st_max - ws_prev) * np.exp(-z(cs, c_s, b_c) * dt / t_w)
         
     dw = z(cs, c_s, b_c) * (w_pc_st_max - ws_prev) * dt / t_w 
     return ws_prev + dw
 
 
+class NtwkState(object):
+    """
+    Full state of a ntwk smln after a given time step, from which
+    LIFNtwk.run can be resumed (see its "state_0" arg).
+    
+    :param step: time step the state was captured after
+    :param dt: integration time step of smln
+    :param vs: membrane potentials
+    :param spks: spks at time step
+    :param gs: syn-dict of conductances
+    :param g_ahp: ahp conductances
+    :param rp_ctrs: remaining refractory periods
+    :param cs: spk ctr variables (None if no plasticity)
+    :param ws_plastic: syn-dict of plastic weights (None if no plasticity)
+    :param spk_cts: spk counts per neuron since previous state yielded by
+        LIFNtwk.iter_run
+    """
+    
+    def __init__(
+            self, step, dt, vs, spks, gs, g_ahp, rp_ctrs, cs=None,
+            ws_plastic=None, spk_cts=None):
+        """Constructor (copies all state arrays)."""
+        self.step = step
+        self.dt = dt
+        self.vs = vs.copy()
+        self.spks = spks.copy()
+        self.gs = {syn: g.copy() for syn, g in gs.items()}
+        self.g_ahp = g_ahp.copy()
+        self.rp_ctrs = rp_ctrs.copy()
+        self.cs = cs.copy() if cs is not None else None
+        self.ws_plastic = {
+            syn: w.copy() for syn, w in ws_plastic.items()
+        } if ws_plastic is not None else None
+        self.spk_cts = spk_cts.copy() if spk_cts is not None else None
+        
+    def check(self, ntwk, dt):
+        """Make sure state can be used to resume a smln of ntwk."""
+        if not self.vs.shape == (ntwk.n,):
+            raise ValueError('State does not match number of neurons in ntwk.')
+        if set(self.gs) != set(ntwk.syns):
+            raise ValueError('State does not match synapse types of ntwk.')
+        if (self.ws_plastic is None) != (ntwk.plasticity is None):
+            raise ValueError('State does not match plasticity of ntwk.')
+        if self.dt != dt:
+            raise ValueError(
+                'State was captured with dt = {}, not {}.'.format(self.dt, dt))
+        
+    @classmethod
+    def join(cls, states):
+        """Join states of several ntwks along neuron dimension."""
+        def cat(xs):
+            return np.concatenate(xs) if xs[0] is not None else None
+        
+        state_0 = states[0]
+        
+        if len(set([state.step for state in states])) > 1:
+            raise ValueError('States must be captured at same time step.')
+            
+        if state_0.ws_plastic is not None:
+            ws_plastic = {
+                syn: cat([state.ws_plastic[syn] for state in states])
+                for syn in state_0.ws_plastic
+            }
+        else:
+            ws_plastic = None
+        
+        return cls(
+            step=state_0.step, dt=state_0.dt,
+            vs=cat([state.vs for state in states]),
+            spks=cat([state.spks for state in states]),
+            gs={
+                syn: cat([state.gs[syn] for state in states])
+                for syn in state_0.gs
+            },
+            g_ahp=cat([state.g_ahp for state in states]),
+            rp_ctrs=cat([state.rp_ctrs for state in states]),
+            cs=cat([state.cs for state in states]),
+            ws_plastic=ws_plastic)
+    
+    def save(self, save_file):
+        """
+        Save state to .npy file (written to a temporary file first so that
+        an interrupted save does not corrupt an existing checkpoint).
+        """
+        if save_file[-4:].lower() != '.npy':
+            raise ValueError('Saved file must end with ".npy" extension.')
+            
+        tmp_file = save_file[:-4] + '.tmp.npy'
+        
+        save(tmp_file, self.__dict__)
+        os.replace(tmp_file, save_file)
+        
+        return save_file
+    
+    @classmethod
+    def load(cls, load_file):
+        """Load state from .npy file."""
+        return cls(**np.load(load_file, allow_pickle=True)[0])
+
+
+class PhaseTimer(object):
+    """
+    Accumulate wall time into phases of a smln loop: each call of lap
+    adds the time since the previous call to the given phase.
+    
+    :param on: whether to time phases (if False, lap does nothing)
+    """
+    
+    def __init__(self, on=True):
+        """Constructor."""
+        self.on = on
+        self.times = {}
+        self.last = time.perf_counter()
+        
+    def lap(self, phase):
+        if not self.on:
+            return
+        
+        now = time.perf_counter()
+        self.times[phase] = self.times.get(phase, 0.) + now - self.last
+        self.last = now
+        
+
+class NtwkProfile(object):
+    """
+    Profiling record of a ntwk smln (see "profile" arg of LIFNtwk.run).
+    
+    Wall times are accumulated over the phases of the smln loop: 'setup'
+    (stacking weights, allocating recorders), 'inps_up' (upstream inputs,
+    incl. plastic synapses), 'inps_rcr' (recurrent inputs), 'dynamics'
+    (conductances, membrane potentials, spks, and resets), 'plasticity'
+    (spk-ctrs and plastic weights), 'record' (writing recorded traces), and
+    'other' (checkpoints, reports, and callbacks). The 'compiled' engine
+    fuses inputs, dynamics, and plasticity into 'kernel', its 'inps_up'
+    being only the drawing of inputs from input sources.
+    
+    :param engine: engine the smln was run with
+    :param times: dict of wall times (s) per phase
+    :param step_spks: number of spks at each time step
+    :param step_events: number of synaptic events (activations of a synapse
+        by an upstream or recurrent spk) delivered at each time step
+    :param threads: number of threads the smln was run with
+    """
+    
+    def __init__(self, engine, times, step_spks, step_events, threads=None):
+        """Constructor."""
+        self.engine = engine
+        self.times = dict(times)
+        self.step_spks = step_spks
+        self.step_events = step_events
+        self.threads = threads
+        
+    @property
+    def time(self):
+        return sum(self.times.values())
+    
+    @classmethod
+    def join(cls, profiles):
+        """
+        Join profiles of consecutive parts of a smln (e.g., a smln run up to
+        a state and its resumption from it; see join_rsps).
+        """
+        n_t = max([len(profile.step_spks) for profile in profiles])
+        
+        times = {}
+        step_spks = np.zeros(n_t, dtype=int)
+        step_events = np.zeros(n_t, dtype=int)
+        
+        for profile in profiles:
+            for phase, t in profile.times.items():
+                times[phase] = times.get(phase, 0.) + t
+                
+            step_spks[:len(profile.step_spks)] += profile.step_spks
+            step_events[:len(profile.step_events)] += profile.step_events
+            
+        return cls(
+            engine=profiles[-1].engine, times=times, step_spks=step_spks,
+            step_events=step_events, threads=profiles[-1].threads)
+    
+    def summary(self):
+        """Return JSON-serializable dict summarizing profile."""
+        n_events = int(self.step_events.sum())
+        
+        return {
+            'engine': self.engine,
+            'threads': self.threads,
+            'n_steps': len(self.step_spks),
+            'times': {phase: float(t) for phase, t in self.times.items()},
+            'time': float(self.time),
+            'n_spks': int(self.step_spks.sum()),
+            'n_syn_events': n_events,
+            'max_syn_events_per_step': int(self.step_events.max(initial=0)),
+            'syn_events_per_s': n_events / self.time if self.time else None,
+        }
+
+
 class NtwkResponse(object):
     """
     Class for storing network response parameters.
 
     :param ts: timestamp vector
     :param vs: membrane potentials
-    :param spks: spk times
+    :param spks: spk times (dense bool array or SpkEvents)
     :param gs: syn-dict of conductances
     :param ws_rcr: syn-dict of recurrent weight matrices
     :param ws_up: syn-dict upstream weight matrices
@@ -634,18 +1955,21 @@ class NtwkResponse(object):
     :param masks_plastic: syn-dict of masks specifying which weights the plastic
         ones correspond to
     :param pfcs: array of cell place field centers
+    :param rec_steps: dict of time step idxs recorded for each variable
+        (variables not in it were recorded at all time steps)
+    :param rec_nrns: dict of neuron idxs recorded for each variable
+        (syn-dict of plastic weight idxs for ws_plastic; variables not in
+        it were recorded for all neurons)
+    :param state: NtwkState at end of smln
+    :param profile: NtwkProfile of smln (if it was profiled)
     """
 
     def __init__(
             self, ts, vs, spks, v_rest, v_th, gs, g_ahp, ws_rcr, ws_up, 
             cell_types=None, cs=None, ws_plastic=None, masks_plastic=None,
-            pfcs=None):
+            pfcs=None, rec_steps=None, rec_nrns=None, state=None,
+            profile=None):
         """Constructor."""
-        # check args
-        if (cell_types is not None) and (len(cell_types) != vs.shape[1]):
-            raise ValueError(
-                'If "cell_types" is provided, all cells must have a type.')
-            
         self.ts = ts
         self.vs = vs
         self.spks = spks
@@ -660,18 +1984,33 @@ class NtwkResponse(object):
         self.ws_plastic = ws_plastic
         self.masks_plastic = masks_plastic
         self.pfcs = pfcs
+        self.rec_steps = rec_steps if rec_steps is not None else {}
+        self.rec_nrns = rec_nrns if rec_nrns is not None else {}
+        self.state = state
+        self.profile = profile
         
         self.dt = np.mean(np.diff(ts))
         self.fs = 1 / self.dt
+        
+        # check args
+        if (cell_types is not None) and (len(cell_types) != self.n):
+            raise ValueError(
+                'If "cell_types" is provided, all cells must have a type.')
 
-    def save(self, save_file, save_gs=False, save_ws=True, save_place_fields=True):
+    def save(
+            self, save_file, save_gs=False, save_ws=True,
+            save_place_fields=True, **kwargs):
         """
         Save network response to file.
 
-        :param save_file: path of file to save it to (do not include .db extension)
+        :param save_file: path of file to save it to (.npy for a pickled
+            file, or .rslt for a columnar result container from which
+            single traces, time windows, and neurons can be loaded without
+            reading the rest, see ntwk_io.py)
         :param save_gs: whether to save conductances
         :param save_ws: whether to save connectivity matrices
         :param save_positions: whether to save positions
+        :param kwargs: args of ntwk_io.save (e.g., compress)
         """
         data = {
             'ts': self.ts,
@@ -680,6 +2019,8 @@ class NtwkResponse(object):
             'v_rest': self.v_rest,
             'v_th': self.v_th,
             'cell_types': self.cell_types,
+            'rec_steps': self.rec_steps,
+            'rec_nrns': self.rec_nrns,
         }
 
         if save_gs:
@@ -698,9 +2039,166 @@ class NtwkResponse(object):
         data['dt'] = self.dt
         data['fs'] = self.fs
 
-        return save(save_file, data)
+        return save(save_file, data, **kwargs)
     
     @property
     def n(self):
-        """Number of neurons."""
+        """
+        Number of neurons of the ntwk (independent of which variables and
+        neurons were recorded).
+        """
+        if np.ndim(self.v_th) > 0:
+            return len(self.v_th)
+        if np.ndim(self.v_rest) > 0:
+            return len(self.v_rest)
+        if getattr(self, 'state', None) is not None:
+            return len(self.state.vs)
+        if self.spks is not None and 'spks' not in self.rec_nrns:
+            return self.spk_events.n
+        
         return self.vs.shape[1]
+
+    @property
+    def spk_events(self):
+        """Spks as SpkEvents (converted once if stored as dense array)."""
+        if getattr(self, '_spk_events', None) is None:
+            self._spk_events = to_spk_events(self.spks)
+
+        return self._spk_events
+    
+    def get_steps(self, ts):
+        """Return idxs of first time steps at or after times ts."""
+        return np.searchsorted(self.ts, ts)
+    
+    def spk_cts(self, start=None, end=None):
+        """
+        Return number of spks per neuron in time window [start, end) (the
+        full smln by default), visiting only the spks in it.
+        """
+        step_0 = 0 if start is None else self.get_steps(start)
+        step_1 = len(self.ts) if end is None else self.get_steps(end)
+        
+        return self.spk_events.counts(step_0, step_1)
+    
+    def frs(self, start=None, end=None):
+        """Return firing rate (Hz) per neuron in time window [start, end)."""
+        if start is None:
+            start = self.ts[0]
+        if end is None:
+            end = self.ts[-1] + self.dt
+            
+        return self.spk_cts(start, end) / (end - start)
+    
+    def first_spk_ts(self, start=None, end=None):
+        """
+        Return time of first spk per neuron in time window [start, end)
+        (NaN for neurons that did not spk in it).
+        """
+        step_0 = 0 if start is None else self.get_steps(start)
+        step_1 = len(self.ts) if end is None else self.get_steps(end)
+        
+        firsts = self.spk_events.first(step_0, step_1)
+        
+        ts = np.full(len(firsts), np.nan)
+        ts[firsts >= 0] = self.ts[firsts[firsts >= 0] + step_0]
+        
+        return ts
+    
+    def binned_spk_cts(self, t_bins):
+        """
+        Return (n_bins, n) array of spk counts per neuron in time bins
+        [t_bins[k], t_bins[k+1]).
+        """
+        return self.spk_events.binned(self.get_steps(t_bins))
+    
+    def spk_ts(self, nrn, start=None, end=None):
+        """Return spk times of neuron nrn in time window [start, end)."""
+        step_0 = 0 if start is None else self.get_steps(start)
+        step_1 = len(self.ts) if end is None else self.get_steps(end)
+        
+        return self.ts[self.spk_events.train(nrn, step_0, step_1)]
+    
+    def rec_idx(self, key, step):
+        """
+        Return row of recorded trace of a variable corresponding to a
+        time step (spks recorded as SpkEvents are indexed by time step).
+        """
+        steps = getattr(self, 'rec_steps', {}).get(key)
+        
+        if steps is None or (key == 'spks' and isinstance(self.spks, SpkEvents)):
+            return step
+        
+        idx = np.searchsorted(steps, step)
+        
+        if idx >= len(steps) or steps[idx] != step:
+            raise ValueError(
+                'Time step {} of "{}" was not recorded.'.format(step, key))
+        
+        return idx
+
+
+def join_rsps(rsp_0, rsp_1):
+    """
+    Join the response of a smln run up to a given state with the response
+    of the smln resumed from that state (see "state_0" arg of LIFNtwk.run).
+    Both should be recorded with the same "store" arg.
+    
+    :return: NtwkResponse covering the full smln
+    """
+    n_t = len(rsp_1.ts)
+    rec_steps = {}
+    
+    def join(x_0, x_1, key):
+        if x_1 is None:
+            return None
+        
+        if isinstance(x_1, SpkEvents):
+            return SpkEvents(
+                np.concatenate([x_0.t_idxs, x_1.t_idxs]),
+                np.concatenate([x_0.nrns, x_1.nrns]), n_t, x_1.n)
+        
+        steps = np.concatenate([
+            rsp_0.rec_steps.get(key, np.arange(len(rsp_0.ts))),
+            rsp_1.rec_steps[key],
+        ])
+        
+        if not np.array_equal(steps, np.arange(n_t)):
+            rec_steps[key] = steps
+        
+        return np.concatenate([x_0, x_1])
+    
+    vs = join(rsp_0.vs, rsp_1.vs, 'vs')
+    spks = join(rsp_0.spks, rsp_1.spks, 'spks')
+    g_ahp = join(rsp_0.g_ahp, rsp_1.g_ahp, 'g_ahp')
+    
+    if rsp_1.gs is not None:
+        gs = {syn: join(rsp_0.gs[syn], g, 'gs') for syn, g in rsp_1.gs.items()}
+    else:
+        gs = None
+    
+    if rsp_1.cs is not None:
+        cs = join(rsp_0.cs, rsp_1.cs, 'cs')
+    else:
+        cs = None
+    
+    # plastic weights are only final values if they were not recorded
+    if rsp_1.ws_plastic is not None and 'ws_plastic' in rsp_1.rec_steps:
+        ws_plastic = {
+            syn: join(rsp_0.ws_plastic[syn], w, 'ws_plastic')
+            for syn, w in rsp_1.ws_plastic.items()
+        }
+    else:
+        ws_plastic = rsp_1.ws_plastic
+        
+    if rsp_0.profile is not None and rsp_1.profile is not None:
+        profile = NtwkProfile.join([rsp_0.profile, rsp_1.profile])
+    else:
+        profile = None
+        
+    return NtwkResponse(
+        ts=rsp_1.ts, vs=vs, spks=spks, v_rest=rsp_1.v_rest, v_th=rsp_1.v_th,
+        gs=gs, g_ahp=g_ahp, ws_rcr=rsp_1.ws_rcr, ws_up=rsp_1.ws_up,
+        cell_types=rsp_1.cell_types, cs=cs, ws_plastic=ws_plastic,
+        masks_plastic=rsp_1.masks_plastic, pfcs=rsp_1.pfcs,
+        rec_steps=rec_steps, rec_nrns=rsp_1.rec_nrns, state=rsp_1.state,
+        profile=profile)
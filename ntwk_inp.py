@@ -0,0 +1,396 @@
+"""
+Upstream input sources and sparse external drive schedules for LIFNtwk.run.
+
+An input source stands in for a dense (T, n_up) upstream spk array but
+produces its rows block by block on demand, so that the full array is never
+held in memory. Blocks lie on a fixed grid of time steps and are generated
+independently of each other, so that any part of a source can be produced
+in any order (e.g., when resuming a smln from a checkpoint) and always has
+the same values. PoissonInps draws Poisson spk counts from per-neuron rate
+functions, seeding a separate RNG stream for each block; JoinedInps puts
+several sources (or arrays) side by side, e.g., for ensemble members.
+
+A DriveSchedule stands in for a dense (T, n) array of external currents,
+forced potentials, or forced spks, but only holds the (time step, neuron,
+value) entries at which there is any drive, so that each step of a smln
+only touches the neurons driven at that step.
+"""
+import numpy as np
+
+
+class InpSource(object):
+    """
+    Base class of upstream input sources, which produce (via make_block)
+    the rows of a (n_t, n) input array one block of time steps at a time.
+
+    Sources can be indexed like 2-D arrays: a time step returns its row,
+    and a slice of time steps returns a dense array.
+
+    :param n_t: number of time steps
+    :param n: number of inputs per time step
+    :param block: number of time steps per block
+    """
+
+    ndim = 2
+
+    def __init__(self, n_t, n, block=1000):
+        """Constructor."""
+        self.n_t = n_t
+        self.n = n
+        self.block = block
+
+        # most recently generated block and its first time step
+        self.cache = None
+        self.cache_start = None
+
+    @property
+    def shape(self):
+        return (self.n_t, self.n)
+
+    def __len__(self):
+        return self.n_t
+
+    def make_block(self, idx):
+        """
+        Return input rows of time steps idx*block to
+        min((idx+1)*block, n_t) - 1.
+        """
+        raise NotImplementedError
+
+    def get_block(self, idx):
+        """Return (cached) input rows of block idx."""
+        start = idx * self.block
+
+        if self.cache_start != start:
+            self.cache = self.make_block(idx)
+            self.cache_start = start
+
+        return self.cache
+
+    def rows(self, start, end):
+        """Return dense input rows of time steps start to end - 1."""
+        start = max(start, 0)
+        end = min(end, self.n_t)
+
+        if end <= start:
+            return np.zeros((0, self.n), dtype=int)
+
+        idxs = range(start // self.block, (end - 1) // self.block + 1)
+        offset = idxs[0] * self.block
+
+        if len(idxs) == 1:
+            block = self.get_block(idxs[0])
+        else:
+            block = np.concatenate([self.make_block(idx) for idx in idxs])
+
+        return block[start - offset:end - offset]
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, end, stride = key.indices(self.n_t)
+
+            if stride != 1:
+                raise ValueError('Input sources only support unit strides.')
+
+            return self.rows(start, end)
+
+        step = int(key)
+
+        if step < 0:
+            step += self.n_t
+        if not 0 <= step < self.n_t:
+            raise IndexError('Time step {} out of range.'.format(key))
+
+        return self.get_block(step // self.block)[step % self.block]
+
+    def head(self, n_t):
+        """
+        Return source with the first n_t time steps of this one (sharing
+        its blocks and random streams).
+        """
+        if n_t > self.n_t:
+            raise ValueError('Arg "n_t" exceeds number of time steps.')
+
+        head = object.__new__(type(self))
+        head.__dict__.update(self.__dict__)
+
+        head.n_t = n_t
+        head.cache = None
+        head.cache_start = None
+
+        return head
+
+    def dense(self):
+        """Return full (n_t, n) input array."""
+        return self.rows(0, self.n_t)
+
+
+class PoissonInps(InpSource):
+    """
+    Upstream input source drawing Poisson spk counts from per-neuron rate
+    functions.
+
+    Each component of the inputs is a tuple (cols, rate) or
+    (cols, rate, seed), where cols are the idxs (or a mask or slice) of the
+    inputs it drives and rate is a function mapping an array of time steps
+    to their spk rates (in Hz, broadcastable to (len(steps), len(cols))),
+    or None if there are no spks at those time steps; rate may also be a
+    constant. Spk counts of inputs driven by several components are summed.
+
+    Each component draws each block from its own RNG stream, seeded by
+    (seed, component idx, block idx), or by (component seed, block idx) if
+    a component seed is given, so that changing a component's rates or
+    seed leaves the spks of all other components unchanged, and changing
+    its rates at some time steps leaves its spks at earlier time steps of
+    the same block unchanged.
+
+    :param n_t: number of time steps
+    :param n: number of inputs
+    :param dt: integration time step
+    :param rates: list of components
+    :param seed: base seed (random if None)
+    :param block: number of time steps per block
+    """
+
+    def __init__(self, n_t, n, dt, rates, seed=None, block=1000):
+        """Constructor."""
+        super(PoissonInps, self).__init__(n_t, n, block)
+
+        self.dt = dt
+
+        if seed is None:
+            seed = np.random.randint(2**31)
+
+        self.seed = seed
+
+        self.rates = []
+
+        for ctr, rate in enumerate(rates):
+            if len(rate) == 2:
+                cols, rate = rate
+                seed_ = [seed, ctr]
+            else:
+                cols, rate, seed_ = rate
+                seed_ = [seed_]
+
+            cols = np.arange(n)[cols]
+
+            self.rates.append((cols, rate, seed_))
+
+    def make_block(self, idx):
+        steps = np.arange(idx*self.block, min((idx+1)*self.block, self.n_t))
+        spks = np.zeros((len(steps), self.n), dtype=int)
+
+        for cols, rate, seed in self.rates:
+            rs = rate(steps) if callable(rate) else rate
+
+            if rs is None:
+                continue
+
+            rng = np.random.default_rng(seed + [idx])
+            spks[:, cols] += rng.poisson(
+                np.broadcast_to(rs * self.dt, (len(steps), len(cols))))
+
+        return spks
+
+
+class JoinedInps(InpSource):
+    """
+    Upstream input source joining several sources (or dense arrays) of the
+    same length along the input dimension.
+
+    :param srcs: list of input sources or 2-D arrays
+    :param block: number of time steps per block
+    """
+
+    def __init__(self, srcs, block=1000):
+        """Constructor."""
+        n_t = len(srcs[0])
+
+        if not all([len(src) == n_t for src in srcs]):
+            raise ValueError('All sources must have same number of time points.')
+
+        super(JoinedInps, self).__init__(
+            n_t, sum([src.shape[1] for src in srcs]), block)
+
+        self.srcs = srcs
+
+    def make_block(self, idx):
+        start = idx * self.block
+        end = min(start + self.block, self.n_t)
+
+        return np.concatenate([src[start:end] for src in self.srcs], axis=1)
+
+
+class DriveSchedule(object):
+    """
+    Sparse schedule of external drive onto neurons (external currents,
+    forced potentials, or forced spks) in CSR form, i.e., the neurons and
+    values of the entries of time step k are indices[indptr[k]:indptr[k+1]]
+    and data[indptr[k]:indptr[k+1]].
+
+    Entries of a time step keep the order they are given in; currents of
+    several entries onto the same neuron sum, while for forced potentials
+    the last one wins. Forced spks are the entries with nonzero values.
+
+    :param n_t: number of time steps covered (there is no drive after)
+    :param n: number of neurons
+    :param steps: time step of each entry
+    :param nrns: neuron of each entry
+    :param vals: value of each entry (or one value for all)
+    """
+
+    def __init__(self, n_t, n, steps, nrns, vals):
+        """Constructor."""
+        steps = np.asarray(steps, dtype=int).ravel()
+        nrns = np.asarray(nrns, dtype=int).ravel()
+        vals = np.broadcast_to(np.asarray(vals, dtype=float), steps.shape)
+
+        if len(nrns) != len(steps):
+            raise ValueError('Args "steps" and "nrns" must have same length.')
+
+        if len(steps) and (steps.min() < 0 or steps.max() >= n_t):
+            raise ValueError('All entries must have time steps in [0, n_t).')
+        if len(nrns) and (nrns.min() < 0 or nrns.max() >= n):
+            raise ValueError('All entries must have neurons in [0, n).')
+
+        self.n_t = n_t
+        self.n = n
+
+        order = np.argsort(steps, kind='stable')
+
+        self.indptr = np.searchsorted(steps[order], np.arange(n_t + 1))
+        self.indices = nrns[order]
+        self.data = vals[order]
+
+    @classmethod
+    def from_itvls(cls, itvls, ts, n):
+        """
+        Build schedule from a list of (itvl, nrns, val) items, each driving
+        neurons nrns (idxs or bool mask) with val (one value for all or one
+        per neuron) at the time steps at which itvl[0] <= t < itvl[1].
+
+        :param itvls: list of (itvl, nrns, val) items
+        :param ts: time of each time step
+        :param n: number of neurons
+        """
+        ts = np.asarray(ts)
+
+        steps = []
+        nrns = []
+        vals = []
+
+        for itvl, nrns_, val in itvls:
+            nrns_ = np.arange(n)[nrns_]
+            steps_ = ((itvl[0] <= ts) & (ts < itvl[1])).nonzero()[0]
+
+            steps.append(np.repeat(steps_, len(nrns_)))
+            nrns.append(np.tile(nrns_, len(steps_)))
+            vals.append(np.tile(
+                np.broadcast_to(np.asarray(val, dtype=float), nrns_.shape),
+                len(steps_)))
+
+        if not itvls:
+            return cls(len(ts), n, [], [], [])
+
+        return cls(
+            len(ts), n, np.concatenate(steps), np.concatenate(nrns),
+            np.concatenate(vals))
+
+    @classmethod
+    def from_csr(cls, x):
+        """
+        Build schedule from a sparse (T, n) event matrix (e.g., a
+        scipy.sparse.csr_matrix) whose stored entries are the drive.
+        """
+        x = x.tocsr()
+
+        steps = np.repeat(np.arange(x.shape[0]), np.diff(x.indptr))
+
+        return cls(x.shape[0], x.shape[1], steps, x.indices, x.data)
+
+    @classmethod
+    def from_dense(cls, x, n, fill=0.):
+        """
+        Build schedule from a dense 1-D (same value for all neurons) or
+        (T, n) array, keeping its entries that are not fill (e.g., 0 for
+        currents or spks and NaN for forced potentials).
+        """
+        x = np.asarray(x, dtype=float)
+
+        if x.ndim == 1:
+            x = np.broadcast_to(x[:, None], (len(x), n))
+
+        if np.isnan(fill):
+            steps, nrns = (~np.isnan(x)).nonzero()
+        else:
+            steps, nrns = (x != fill).nonzero()
+
+        return cls(len(x), n, steps, nrns, x[steps, nrns])
+
+    @classmethod
+    def join(cls, schedules, n):
+        """
+        Join schedules of K ntwks of n neurons each into one schedule of the
+        (K*n) neurons of the stacked ntwk (see LIFNtwkEnsemble).
+        """
+        n_t = max([schedule.n_t for schedule in schedules])
+
+        steps = []
+        nrns = []
+        vals = []
+
+        for ctr, schedule in enumerate(schedules):
+            steps.append(np.repeat(
+                np.arange(schedule.n_t), np.diff(schedule.indptr)))
+            nrns.append(schedule.indices + ctr*n)
+            vals.append(schedule.data)
+
+        return cls(
+            n_t, len(schedules)*n, np.concatenate(steps),
+            np.concatenate(nrns), np.concatenate(vals))
+
+    def __len__(self):
+        return self.n_t
+
+    @property
+    def nnz(self):
+        return len(self.indices)
+
+    def entries(self, step):
+        """Return neurons and values of entries at time step "step"."""
+        if step >= self.n_t:
+            return self.indices[:0], self.data[:0]
+
+        sl = slice(self.indptr[step], self.indptr[step+1])
+
+        return self.indices[sl], self.data[sl]
+
+    def add_to(self, x, step):
+        """Add entries at time step "step" to vector x in place."""
+        nrns, vals = self.entries(step)
+        np.add.at(x, nrns, vals)
+
+    def set_in(self, x, step):
+        """Set entries at time step "step" in vector x in place."""
+        nrns, vals = self.entries(step)
+
+        if x.dtype == bool:
+            x[nrns[vals != 0]] = True
+        else:
+            x[nrns] = vals
+
+    def dense(self, fill=0., dtype=float):
+        """Return (n_t, n) array of schedule (fill where there is no drive)."""
+        x = np.full((self.n_t, self.n), fill, dtype=dtype)
+        steps = np.repeat(np.arange(self.n_t), np.diff(self.indptr))
+
+        if x.dtype == bool:
+            mask = self.data != 0
+            x[steps[mask], self.indices[mask]] = True
+        elif np.isnan(fill):
+            x[steps, self.indices] = self.data
+        else:
+            np.add.at(x, (steps, self.indices), self.data)
+
+        return x
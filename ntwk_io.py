@@ -0,0 +1,668 @@
+"""
+Columnar, chunked container format for smln results (e.g., NtwkResponse).
+
+Instead of pickling a whole object into a one-element .npy array (see
+aux.save), a result is saved as a directory (with a ".rslt" extension)
+holding each array as its own dataset next to a small JSON header that
+describes the object's structure:
+
+    <name>.rslt/
+        header.json             format, version, and tree of nodes
+        vs.npy                  dense array, memory-mappable
+        gs/E.npy                (nested dicts and objects are subdirs)
+        spks/t_idxs.npy         spk events (see ntwk_rec.SpkEvents)
+        spks/nrns.npy
+        spks/offsets.npy
+        ws_rcr/E/data.npy       sparse matrices as (row, col, data)
+        ws_rcr/E/rows.npy       triplets
+        ws_rcr/E/cols.npy
+        vs.chunks/000000.npz    compressed arrays as chunks of rows
+        objects/000000.npy      anything else (pickled, one per value)
+
+Uncompressed arrays are plain .npy files, whose data is aligned and which
+are loaded as read-only memory maps. Compressed arrays are split into
+chunks of rows along their first axis, so that reading a window of rows
+only decompresses the chunks it overlaps.
+
+Traces whose first axis is time (see TIME_KEYS) and second axis is neurons
+(see NRN_KEYS) can be read partially, i.e., only for a window of time steps
+and/or a subset of neurons (see RsltFile.load). Traces recorded only at
+some time steps or for some neurons (see the rec_steps and rec_nrns of
+NtwkResponse) keep these in rec/<key>/, onto which windows and neurons are
+mapped.
+"""
+import importlib
+import json
+import numpy as np
+import os
+import shutil
+from scipy.sparse import coo_matrix, issparse
+
+from aux import GenericFlexible
+from ntwk_rec import SpkEvents
+
+FORMAT = 'ntwk-rslt'
+VERSION = 2
+
+EXT = '.rslt'
+
+# top-level keys of traces with time as first axis and neurons as second
+TIME_KEYS = ('ts', 'vs', 'spks', 'gs', 'g_ahp', 'cs', 'ws_plastic')
+NRN_KEYS = ('vs', 'spks', 'gs', 'g_ahp', 'cs')
+
+
+def public_attrs(obj):
+    """Return dict of attributes of obj (except cached "_" ones)."""
+    return {k: v for k, v in vars(obj).items() if not k.startswith('_')}
+
+
+def make_object(cls, items):
+    """
+    Rebuild object of class cls ("module.Class", as recorded in the header)
+    from its saved attributes without calling its constructor, so that it
+    keeps its methods (e.g., those of NtwkResponse); objects whose class
+    cannot be imported are returned as aux.GenericFlexible.
+    """
+    try:
+        module, name = cls.rsplit('.', 1)
+        obj = object.__new__(getattr(importlib.import_module(module), name))
+    except (AttributeError, ImportError, TypeError, ValueError):
+        return GenericFlexible(**items)
+
+    obj.__dict__.update(items)
+
+    return obj
+
+
+class Writer(object):
+    """
+    Write the nodes of an object tree into a container directory.
+
+    :param root: path of container directory
+    :param compress: whether to compress arrays
+    :param chunk: number of rows per chunk of compressed arrays
+    """
+
+    def __init__(self, root, compress=False, chunk=1000):
+        """Constructor."""
+        self.root = root
+        self.compress = compress
+        self.chunk = chunk
+        self.n_objects = 0
+
+    def path(self, name):
+        path = os.path.join(self.root, name)
+
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+
+        return path
+
+    def array(self, name, x, time=False, nrn=False):
+        x = np.asarray(x)
+
+        node = {
+            'type': 'array',
+            'shape': list(x.shape),
+            'dtype': x.dtype.str,
+            'time': time,
+            'nrn': nrn,
+        }
+
+        if self.compress and x.ndim > 0:
+            node['file'] = name + '.chunks'
+            node['chunk'] = self.chunk
+
+            for ctr, start in enumerate(range(0, max(len(x), 1), self.chunk)):
+                np.savez_compressed(
+                    self.path(os.path.join(
+                        node['file'], '{:06d}.npz'.format(ctr))),
+                    x=x[start:start+self.chunk])
+        else:
+            node['file'] = name + '.npy'
+            np.save(self.path(node['file']), x)
+
+        return node
+
+    def value(self, name, x, time=False, nrn=False):
+        """Write x and return its node."""
+        if isinstance(x, (np.ndarray, np.generic)) and x.dtype != object \
+                and x.ndim > 0:
+            return self.array(name, x, time, nrn)
+
+        elif isinstance(x, SpkEvents):
+            node = {'type': 'events', 'n_t': x.n_t, 'n': x.n}
+
+            for key in ('t_idxs', 'nrns', 'offsets'):
+                node[key] = self.array(
+                    os.path.join(name, key), getattr(x, key))
+
+            return node
+
+        elif issparse(x):
+            coo = coo_matrix(x)
+
+            node = {
+                'type': 'sparse', 'format': x.format, 'shape': list(x.shape)}
+
+            for key, val in zip(
+                    ('rows', 'cols', 'data'), (coo.row, coo.col, coo.data)):
+                node[key] = self.array(os.path.join(name, key), val)
+
+            return node
+
+        elif isinstance(x, dict) and all([isinstance(k, str) for k in x]):
+            return {
+                'type': 'dict',
+                'items': {
+                    k: self.value(os.path.join(name, k), v, time, nrn)
+                    for k, v in x.items()
+                }
+            }
+
+        elif isinstance(x, (list, tuple)) and any(
+                [isinstance(v, (np.ndarray, dict)) or issparse(v) for v in x]):
+            return {
+                'type': type(x).__name__,
+                'items': [
+                    self.value(os.path.join(name, str(ctr)), v)
+                    for ctr, v in enumerate(x)
+                ]
+            }
+
+        elif hasattr(x, '__dict__') and not isinstance(x, type) \
+                and not callable(x):
+            node = self.value(name, public_attrs(x))
+
+            if node['type'] == 'dict':
+                node['type'] = 'object'
+                node['cls'] = '{}.{}'.format(
+                    type(x).__module__, type(x).__name__)
+
+            return node
+
+        # JSON-serializable values are stored in header
+        if isinstance(x, (np.ndarray, np.generic)) and x.ndim == 0 \
+                and x.dtype != object:
+            x = x.item()
+
+        try:
+            json.dumps(x)
+            return {'type': 'value', 'value': x}
+        except (TypeError, ValueError):
+            pass
+
+        # fall back to pickling anything else
+        node = {
+            'type': 'pickle',
+            'file': os.path.join(
+                'objects', '{:06d}.npy'.format(self.n_objects)),
+        }
+        self.n_objects += 1
+
+        arr = np.empty(1, dtype=object)
+        arr[0] = x
+
+        np.save(self.path(node['file']), arr)
+
+        return node
+
+
+def get_n(obj, items):
+    """
+    Return number of neurons of the ntwk a saved object (e.g., an
+    NtwkResponse or a dict of its traces) was recorded from.
+    """
+    if not isinstance(obj, dict) and hasattr(type(obj), 'n'):
+        return obj.n
+    
+    for key in ('v_th', 'v_rest'):
+        if np.ndim(items.get(key)) > 0:
+            return len(items[key])
+        
+    # fall back to traces recorded for all neurons
+    rec_nrns = items.get('rec_nrns') or {}
+    
+    for key in NRN_KEYS:
+        x = items.get(key)
+        
+        if key in rec_nrns or x is None or isinstance(x, dict):
+            continue
+        if isinstance(x, SpkEvents):
+            return x.n
+        if np.ndim(x) > 1:
+            return x.shape[1]
+        
+    return None
+
+
+def save(save_file, obj, compress=False, chunk=1000):
+    """
+    Save an object (e.g., an NtwkResponse or a dict of arrays) into a
+    container directory.
+
+    :param save_file: path of container (should have .rslt extension)
+    :param obj: object or dict to save
+    :param compress: whether to compress arrays (in chunks of rows)
+    :param chunk: number of rows per chunk of compressed arrays
+
+    :return: path to saved container
+    """
+    if not save_file.lower().endswith(EXT):
+        raise ValueError('Saved file must end with "{}" extension.'.format(EXT))
+
+    # only ever replace previous containers
+    if os.path.exists(save_file):
+        if not os.path.exists(os.path.join(save_file, 'header.json')):
+            raise ValueError(
+                'Path "{}" exists and is not a result container.'.format(
+                    save_file))
+        shutil.rmtree(save_file)
+
+    writer = Writer(save_file, compress=compress, chunk=chunk)
+
+    if isinstance(obj, dict):
+        items = dict(obj)
+    else:
+        items = public_attrs(obj)
+
+    # get number of time steps and neurons of ntwk
+    n_t = len(items['ts']) if items.get('ts') is not None else None
+    n = get_n(obj, items)
+    
+    # time steps and neurons recorded for each variable (all if not in them)
+    rec_steps = items.get('rec_steps') or {}
+    rec_nrns = items.get('rec_nrns') or {}
+    
+    rec_nodes = {}
+    
+    def rec_node(key, kind, x):
+        # write recorded time steps/neurons of a variable once
+        if (key, kind) not in rec_nodes:
+            rec_nodes[(key, kind)] = writer.array(
+                os.path.join('rec', key, kind), x)
+            
+        return rec_nodes[(key, kind)]
+    
+    def trace(name, key, x):
+        # write trace, marking its time and neuron axes as given by the
+        # variable's recorded time steps and neurons
+        steps = rec_steps.get(key)
+        nrns = rec_nrns.get(key) if key in NRN_KEYS else None
+        
+        if isinstance(x, SpkEvents):
+            node = writer.value(name, x)
+            
+            # spk events are indexed by absolute time step
+            if nrns is not None:
+                node['rec_nrns'] = rec_node(key, 'nrns', nrns)
+                
+            return node
+        
+        shape = getattr(x, 'shape', ())
+        
+        n_t_rec = len(steps) if steps is not None else n_t
+        n_rec = len(nrns) if nrns is not None else n
+        
+        time = n_t_rec is not None and len(shape) > 0 and shape[0] == n_t_rec
+        nrn = key in NRN_KEYS and n_rec is not None and len(shape) > 1 \
+            and shape[1] == n_rec
+        
+        node = writer.value(name, x, time=time, nrn=nrn)
+        
+        if node['type'] == 'array':
+            if time and steps is not None:
+                node['rec_steps'] = rec_node(key, 'steps', steps)
+            if nrn and nrns is not None:
+                node['rec_nrns'] = rec_node(key, 'nrns', nrns)
+            
+        return node
+
+    nodes = {}
+
+    for key, val in items.items():
+        if key in TIME_KEYS and isinstance(val, dict):
+            nodes[key] = {
+                'type': 'dict',
+                'items': {
+                    syn: trace(os.path.join(key, syn), key, x)
+                    for syn, x in val.items()
+                }
+            }
+        elif key in TIME_KEYS:
+            nodes[key] = trace(key, key, val)
+        else:
+            nodes[key] = writer.value(key, val)
+
+    header = {
+        'format': FORMAT,
+        'version': VERSION,
+        'n_t': n_t,
+        'n': n,
+        'root': {
+            'type': 'dict' if isinstance(obj, dict) else 'object',
+            'cls': None if isinstance(obj, dict) else '{}.{}'.format(
+                type(obj).__module__, type(obj).__name__),
+            'items': nodes,
+        },
+    }
+
+    # header is written last, so that incomplete containers have none
+    tmp_file = os.path.join(save_file, 'header.json.tmp')
+
+    with open(tmp_file, 'w') as f:
+        json.dump(header, f, indent=1)
+
+    os.replace(tmp_file, os.path.join(save_file, 'header.json'))
+
+    return save_file
+
+
+class RsltFile(object):
+    """
+    Result container opened for reading.
+
+    :param load_file: path of container
+    """
+
+    def __init__(self, load_file):
+        """Constructor."""
+        header_file = os.path.join(load_file, 'header.json')
+
+        if not os.path.exists(header_file):
+            raise ValueError(
+                'No result container at "{}" (or it was not completely '
+                'saved).'.format(load_file))
+
+        with open(header_file) as f:
+            header = json.load(f)
+
+        if header.get('format') != FORMAT:
+            raise ValueError('File "{}" is not a result container.'.format(
+                load_file))
+        if header['version'] > VERSION:
+            raise ValueError(
+                'Result container version {} is newer than supported '
+                'version {}.'.format(header['version'], VERSION))
+
+        self.root = load_file
+        self.header = header
+
+    @property
+    def n_t(self):
+        return self.header['n_t']
+
+    @property
+    def n(self):
+        return self.header['n']
+
+    def keys(self):
+        """Top-level keys (attributes) of saved object."""
+        return list(self.header['root']['items'])
+
+    def node(self, key):
+        """Return header node of a (possibly nested, "/"-separated) key."""
+        node = self.header['root']
+
+        for part in key.split('/'):
+            node = node['items'][int(part) if node['type'] in (
+                'list', 'tuple') else part]
+
+        return node
+
+    def read_array(self, node, steps=None, nrns=None, mmap=True):
+        """
+        Read array dataset, optionally only rows steps[0] to steps[1] - 1 of
+        time traces and cols nrns of neuron traces.
+        """
+        rows = None
+        cols = None
+        
+        if steps is not None and node['time']:
+            if node.get('rec_steps') is not None:
+                # rows of recorded time steps within window
+                rec_steps = self.read_array(node['rec_steps'], mmap=False)
+                rows = slice(*[
+                    int(idx) for idx in np.searchsorted(
+                        rec_steps, [max(steps[0], 0), steps[1]])])
+            else:
+                rows = slice(*steps)
+                
+        if nrns is not None and node['nrn']:
+            cols = self.rec_cols(node, nrns)
+
+        if 'chunk' in node:
+            n_rows = node['shape'][0] if node['shape'] else 0
+            start, end, _ = (rows or slice(None)).indices(n_rows)
+            chunk = node['chunk']
+
+            # only decompress chunks overlapping rows
+            idxs = range(start // chunk, max((end - 1) // chunk + 1, 0))
+            parts = [
+                np.load(os.path.join(
+                    self.root, node['file'], '{:06d}.npz'.format(idx)))['x']
+                for idx in idxs
+            ]
+
+            if parts:
+                x = np.concatenate(parts)[
+                    start - idxs[0]*chunk:end - idxs[0]*chunk]
+            else:
+                x = np.zeros(
+                    [0] + node['shape'][1:], dtype=np.dtype(node['dtype']))
+        else:
+            x = np.load(
+                os.path.join(self.root, node['file']),
+                mmap_mode='r' if mmap else None)
+
+            if rows is not None:
+                x = x[rows]
+
+        if cols is not None:
+            x = x[:, cols]
+
+        return x
+
+    def rec_cols(self, node, nrns):
+        """
+        Return cols of a trace (or neurons of spk events) holding neurons
+        nrns (idxs or bool mask), skipping neurons that were not recorded.
+        """
+        nrns = np.asarray(nrns)
+        
+        if nrns.dtype == bool:
+            nrns = nrns.nonzero()[0]
+            
+        if node.get('rec_nrns') is None:
+            return nrns
+        
+        rec_nrns = self.read_array(node['rec_nrns'], mmap=False)
+        
+        if not len(rec_nrns):
+            return np.zeros(0, dtype=int)
+        
+        order = np.argsort(rec_nrns, kind='stable')
+        pos = np.minimum(
+            np.searchsorted(rec_nrns[order], nrns), len(rec_nrns) - 1)
+        found = rec_nrns[order][pos] == nrns
+        
+        return order[pos[found]]
+    
+    def read(self, key=None, steps=None, nrns=None, mmap=True, node=None):
+        """
+        Read value of a (possibly nested, "/"-separated) key.
+
+        :param key: key of value (e.g., "vs", "gs/E", or "ntwk/e_l")
+        :param steps: (start, end) time steps to read of time traces
+        :param nrns: idxs of neurons to read of neuron traces
+        :param mmap: whether to memory-map uncompressed arrays (only read
+            from disk as they are accessed) instead of loading them
+        """
+        if node is None:
+            node = self.node(key)
+
+        kind = node['type']
+
+        if kind == 'array':
+            return self.read_array(node, steps, nrns, mmap)
+
+        elif kind == 'events':
+            offsets = self.read_array(node['offsets'], mmap=True)
+
+            if steps is not None:
+                start = max(steps[0], 0)
+                end = min(steps[1], node['n_t'])
+                end = max(end, start)
+            else:
+                start, end = 0, node['n_t']
+
+            # only read events within time window
+            sl = slice(int(offsets[start]), int(offsets[end]))
+
+            t_idxs = self.read_array(node['t_idxs'], mmap=True)[sl] - start
+            spks = SpkEvents(
+                t_idxs, self.read_array(node['nrns'], mmap=True)[sl],
+                end - start, node['n'],
+                offsets=offsets[start:end + 1] - offsets[start])
+
+            return spks.select(self.rec_cols(node, nrns)) \
+                if nrns is not None else spks
+
+        elif kind == 'sparse':
+            rows, cols, data = [
+                self.read_array(node[key], mmap=False)
+                for key in ('rows', 'cols', 'data')
+            ]
+
+            return coo_matrix(
+                (data, (rows, cols)), shape=tuple(node['shape'])
+            ).asformat(node['format'])
+
+        elif kind in ('dict', 'object'):
+            items = {
+                k: self.read(steps=steps, nrns=nrns, mmap=mmap, node=v)
+                for k, v in node['items'].items()
+            }
+
+            if kind == 'object':
+                return make_object(node.get('cls'), items)
+
+            return items
+
+        elif kind in ('list', 'tuple'):
+            items = [
+                self.read(steps=steps, nrns=nrns, mmap=mmap, node=v)
+                for v in node['items']
+            ]
+
+            return tuple(items) if kind == 'tuple' else items
+
+        elif kind == 'value':
+            return node['value']
+
+        elif kind == 'pickle':
+            return np.load(
+                os.path.join(self.root, node['file']), allow_pickle=True)[0]
+
+        raise ValueError('Unknown node type "{}".'.format(kind))
+
+    def load(self, keys=None, steps=None, nrns=None, mmap=True):
+        """
+        Load saved object (as a dict if a dict was saved, otherwise as an
+        object of its class with the saved attributes, see make_object).
+
+        :param keys: keys to load (all if None); nested keys (e.g.,
+            "ntwk/e_l") only load that part of their parents
+        :param steps: (start, end) time steps to read of time traces
+        :param nrns: idxs of neurons to read of neuron traces
+        :param mmap: whether to memory-map uncompressed arrays
+        """
+        if keys is None:
+            keys = self.keys()
+
+        # tree of requested keys
+        tree = {}
+
+        for key in keys:
+            parts = key.split('/')
+            sub = tree
+
+            for part in parts[:-1]:
+                sub = sub.setdefault(part, {})
+
+            sub[parts[-1]] = None
+
+        def build(sub, node, path):
+            items = {}
+
+            for part, children in sub.items():
+                path_ = '/'.join(path + [part])
+
+                if children is None:
+                    items[part] = self.read(
+                        path_, steps=steps, nrns=nrns, mmap=mmap)
+                else:
+                    items[part] = build(
+                        children, self.node(path_), path + [part])
+
+            if node['type'] == 'object':
+                return make_object(node.get('cls'), items)
+
+            return items
+
+        obj = build(tree, self.header['root'], [])
+        
+        # express recorded time steps and neurons relative to window and
+        # selected neurons
+        items = obj if isinstance(obj, dict) else vars(obj)
+        
+        if steps is not None and items.get('rec_steps') is not None:
+            start, end = max(steps[0], 0), steps[1]
+            
+            items['rec_steps'] = {
+                key: rec[(start <= rec) & (rec < end)] - start
+                for key, rec in items['rec_steps'].items()
+            }
+            
+        if nrns is not None and items.get('rec_nrns') is not None:
+            nrns = np.asarray(nrns)
+            
+            if nrns.dtype == bool:
+                nrns = nrns.nonzero()[0]
+                
+            items['rec_nrns'] = {
+                key: np.isin(nrns, rec).nonzero()[0] if key in NRN_KEYS
+                else rec
+                for key, rec in items['rec_nrns'].items()
+            }
+            
+        return obj
+
+
+def load(load_file, keys=None, steps=None, nrns=None, mmap=True):
+    """
+    Load object from result container (see RsltFile.load).
+    """
+    return RsltFile(load_file).load(
+        keys=keys, steps=steps, nrns=nrns, mmap=mmap)
+
+
+def convert(load_file, save_file=None, compress=False, chunk=1000):
+    """
+    Convert a pickled .npy result file (see aux.save) into a result
+    container.
+
+    :param load_file: path of .npy file
+    :param save_file: path of container (defaults to load_file with .rslt
+        extension)
+    :param compress: whether to compress arrays
+    :param chunk: number of rows per chunk of compressed arrays
+
+    :return: path to saved container
+    """
+    if save_file is None:
+        save_file = load_file[:-4] + EXT
+
+    obj = np.load(load_file, allow_pickle=True)[0]
+
+    return save(save_file, obj, compress=compress, chunk=chunk)
@@ -0,0 +1,700 @@
+"""
+Compiled (numba) backend for LIFNtwk.run.
+
+The whole integration step (synaptic decay and input, AHP, membrane update,
+threshold/reset/refractory and spk-ctr plasticity) is fused into a single
+kernel that is compiled once and cached on disk (in this module's
+__pycache__ directory, or in $NUMBA_CACHE_DIR if set), so that worker
+processes load the compiled kernel instead of recompiling it.
+
+For large ntwks, the neurons of each step can be split into blocks that are
+integrated concurrently on numba's thread pool (see make_run_chunk); each
+block owns its rows of the weight operators, so that blocks never write to
+each other's state and results do not depend on the number of threads.
+"""
+import numba
+import numpy as np
+from numba import njit, prange
+
+from ntwk import PhaseTimer, PlasticSyns, count_syns, exp_factors, stack_ws
+from ntwk_inp import DriveSchedule, InpSource
+
+# number of steps integrated per kernel call; recordings are copied
+# out of chunk buffers (of the ntwk's dtype) into their recorders after
+# each call
+CHUNK = 1000
+
+
+def idx_dtype(n):
+    """Smallest int dtype (32 or 64 bit) that can index n elements."""
+    return np.int32 if n < 2**31 else np.int64
+
+
+def static_csc(ws, syns, masks=None, dtype=float):
+    """
+    Stack a syn-dict of weight matrices into a single csc operator whose
+    rows cover all synapse types (row syn_ctr*n + targ), excluding any
+    plastic weights.
+
+    :param ws: syn-dict of (n, n_src) weight matrices
+    :param syns: ordered list of synapse types
+    :param masks: optional syn-dict of boolean masks of plastic weights
+    :param dtype: dtype of weights
+
+    :return: data, indices, indptr arrays of stacked csc matrix (with 32-bit
+        indices where possible)
+    """
+    w, _ = stack_ws(ws, syns, masks, drop_empty=False)
+    w.eliminate_zeros()
+
+    idx = idx_dtype(max(w.nnz, w.shape[0]))
+
+    return w.data.astype(dtype), w.indices.astype(idx), w.indptr.astype(idx)
+
+
+@njit(cache=True)
+def z(c, c_s, b_c):
+    return 1 / (1 + np.exp(-(c - c_s)/b_c))
+
+
+@njit(cache=True)
+def begin_step(
+        step, x, spks, act_up, act_rcr, ie_ptr, ie_idx, ie_val, vf_ptr, vf_idx,
+        vf_val, sf_ptr, sf_idx, i_sch, v_sch, s_sch):
+    """
+    Collect active upstream inputs and spiking neurons (whose spks from the
+    previous step are read by all blocks) and fill in scheduled drive of
+    step; return numbers of active upstream inputs and spiking neurons.
+    """
+    n_act_up = 0
+    for j in range(len(x)):
+        if x[j] != 0:
+            act_up[n_act_up] = j
+            n_act_up += 1
+
+    n_act_rcr = 0
+    for j in range(len(spks)):
+        if spks[j]:
+            act_rcr[n_act_rcr] = j
+            n_act_rcr += 1
+
+    if step + 1 < len(ie_ptr):
+        for k in range(ie_ptr[step], ie_ptr[step+1]):
+            i_sch[ie_idx[k]] += ie_val[k]
+    if step + 1 < len(vf_ptr):
+        for k in range(vf_ptr[step], vf_ptr[step+1]):
+            v_sch[vf_idx[k]] = vf_val[k]
+    if step + 1 < len(sf_ptr):
+        for k in range(sf_ptr[step], sf_ptr[step+1]):
+            s_sch[sf_idx[k]] = True
+
+    return n_act_up, n_act_rcr
+
+
+@njit(cache=True)
+def end_step(
+        step, ie_ptr, ie_idx, vf_ptr, vf_idx, sf_ptr, sf_idx,
+        i_sch, v_sch, s_sch):
+    """Clear scheduled drive of step."""
+    if step + 1 < len(ie_ptr):
+        for k in range(ie_ptr[step], ie_ptr[step+1]):
+            i_sch[ie_idx[k]] = 0.
+    if step + 1 < len(vf_ptr):
+        for k in range(vf_ptr[step], vf_ptr[step+1]):
+            v_sch[vf_idx[k]] = np.nan
+    if step + 1 < len(sf_ptr):
+        for k in range(sf_ptr[step], sf_ptr[step+1]):
+            s_sch[sf_idx[k]] = False
+
+
+@njit(cache=True)
+def step_block(
+        b, step, t, dt, x, act_up, n_act_up, act_rcr, n_act_rcr,
+        i_ext, vs_forced, spks_forced, i_sch, v_sch, s_sch, blocks,
+        up_data, up_indices, up_bptr, rcr_data, rcr_indices, rcr_bptr,
+        t_syn, e_syn, t_m, e_l, v_th, v_reset, t_r, e_ahp, t_ahp, w_ahp,
+        pl_perm, pl_bptr, pl_syn, pl_row, pl_col, pl_w_max, t_c, c_s, b_c,
+        t_w, exp_int, dt_ref, decay_syn, avg_syn, decay_ahp, avg_ahp,
+        decay_c, vs, spks, gs, g_ahp, rp_ctrs, cs, ws_pl, spk_cts, inps,
+        rec_vs, rec_spks, rec_gs, rec_g_ahp, rec_cs, rec_ws_pl):
+    """
+    Integrate one step for the neurons of block b (blocks[b] to
+    blocks[b+1] - 1) and the plastic weights onto them, given the upstream
+    and recurrent spks collected by begin_step.
+
+    Blocks only write to the state of their own neurons (and the rows of
+    inps onto them), so all blocks of a step can run concurrently, and the
+    inputs to each neuron are summed in the same order for any blocking.
+    """
+    n_syn, n = gs.shape
+    plastic = t_w > 0
+
+    lo = blocks[b]
+    hi = blocks[b+1]
+
+    # upstream and recurrent inputs to all synapse types
+    for s in range(n_syn):
+        inps[s*n + lo:s*n + hi] = 0
+
+    for a in range(n_act_up):
+        j = act_up[a]
+        for k in range(up_bptr[b, j], up_bptr[b, j+1]):
+            inps[up_indices[k]] += up_data[k] * x[j]
+
+    for a in range(pl_bptr[b], pl_bptr[b+1]):
+        k = pl_perm[a]
+        if x[pl_col[k]] != 0:
+            inps[pl_syn[k]*n + pl_row[k]] += ws_pl[k] * x[pl_col[k]]
+
+    for a in range(n_act_rcr):
+        j = act_rcr[a]
+        for k in range(rcr_bptr[b, j], rcr_bptr[b, j+1]):
+            inps[rcr_indices[k]] += rcr_data[k]
+
+    for i in range(lo, hi):
+
+        if step >= i_ext.shape[0]:
+            i_ext_i = 0.
+        elif i_ext.shape[1] == 1:
+            i_ext_i = i_ext[step, 0]
+        else:
+            i_ext_i = i_ext[step, i]
+
+        i_ext_i += i_sch[i]
+
+        spk_prev = 1. if spks[i] else 0.
+        t_since_spk = 0.
+
+        if not exp_int:
+
+            # conductances and synaptic currents
+            i_all = 0.
+            for s in range(n_syn):
+                gs[s, i] = gs[s, i] + (
+                    -(dt/t_syn[s, i])*gs[s, i] + inps[s*n + i])
+
+                if s == 0:
+                    i_all = gs[s, i] * (e_syn[s, i] - vs[i])
+                else:
+                    i_all = i_all + gs[s, i] * (e_syn[s, i] - vs[i])
+
+            # AHP conductance and current
+            g_ahp[i] = g_ahp[i] + (
+                (-dt/t_ahp[i])*g_ahp[i] + w_ahp[i]*spk_prev)
+
+            if n_syn > 0:
+                i_all = i_all + g_ahp[i] * (e_ahp[i] - vs[i])
+            else:
+                i_all = g_ahp[i] * (e_ahp[i] - vs[i])
+
+            # membrane potential
+            v = vs[i] + (-(dt/t_m[i])*(vs[i] - e_l[i]) + (i_all + i_ext_i))
+
+            # refractoriness
+            if rp_ctrs[i] > 0:
+                v = v_reset[i]
+
+        else:
+
+            # exactly decayed conductances and their mean rates over step
+            g_tot = 0.
+            g_e_tot = 0.
+            for s in range(n_syn):
+                gs[s, i] = decay_syn[s, i]*gs[s, i] + inps[s*n + i]
+
+                g_avg = avg_syn[s, i] * gs[s, i] / dt_ref
+                g_tot += g_avg
+                g_e_tot += g_avg * e_syn[s, i]
+
+            g_ahp[i] = decay_ahp[i]*g_ahp[i] + w_ahp[i]*spk_prev
+
+            g_avg = avg_ahp[i] * g_ahp[i] / dt_ref
+
+            a_ = 1/t_m[i] + g_tot + g_avg
+            b_ = e_l[i]/t_m[i] + g_e_tot + g_avg*e_ahp[i] + i_ext_i/dt_ref
+            v_inf = b_ / a_
+
+            # relax toward steady state (from reset if leaving
+            # refractory period within step)
+            dt_free = min(max(dt - rp_ctrs[i], 0.), dt)
+            v_start = v_reset[i] if rp_ctrs[i] > 0 else vs[i]
+            v = v_inf + (v_start - v_inf) * np.exp(-a_ * dt_free)
+
+            # time from interpolated threshold crossing to end of step
+            if v >= v_th[i] and v != v_start:
+                frac = min(max((v_th[i] - v_start) / (v - v_start), 0.), 1.)
+                t_since_spk = (1 - frac) * dt_free
+
+        # forced potentials
+        if step < vs_forced.shape[0]:
+            if not np.isnan(vs_forced[step, i]):
+                v = vs_forced[step, i]
+        if not np.isnan(v_sch[i]):
+            v = v_sch[i]
+
+        # spks, forced spks, and reset
+        spk = v >= v_th[i]
+
+        if step < spks_forced.shape[0]:
+            if spks_forced[step, i]:
+                spk = True
+        if s_sch[i]:
+            spk = True
+
+        if not exp_int:
+            if spk:
+                v = v_reset[i]
+                rp_ctrs[i] = t_r[i]
+
+            rp_ctrs[i] -= dt
+            if rp_ctrs[i] < 0:
+                rp_ctrs[i] = 0
+        else:
+            rp_ctrs[i] = max(rp_ctrs[i] - dt, 0.)
+
+            if spk:
+                v = v_reset[i]
+                rp_ctrs[i] = max(t_r[i] - t_since_spk, 0.)
+
+        vs[i] = v
+        spks[i] = spk
+
+        if spk:
+            spk_cts[i] += 1
+
+        # spk-ctr
+        if plastic:
+            if exp_int:
+                cs[i] = decay_c*cs[i] + (1. if spk else 0.)
+            else:
+                cs[i] = cs[i] + (-cs[i]*dt/t_c + (1. if spk else 0.))
+
+    # plastic weights
+    if plastic:
+        for a in range(pl_bptr[b], pl_bptr[b+1]):
+            k = pl_perm[a]
+            if exp_int:
+                ws_pl[k] = pl_w_max[k] - (pl_w_max[k] - ws_pl[k]) * np.exp(
+                    -z(cs[pl_row[k]], c_s, b_c) * dt / t_w)
+            else:
+                ws_pl[k] = ws_pl[k] + (
+                    z(cs[pl_row[k]], c_s, b_c)
+                    * (pl_w_max[k] - ws_pl[k]) * dt / t_w)
+
+    # record
+    if rec_vs.shape[0] > 0:
+        rec_vs[t, lo:hi] = vs[lo:hi]
+    if rec_spks.shape[0] > 0:
+        rec_spks[t, lo:hi] = spks[lo:hi]
+    if rec_gs.shape[0] > 0:
+        rec_gs[t, :, lo:hi] = gs[:, lo:hi]
+    if rec_g_ahp.shape[0] > 0:
+        rec_g_ahp[t, lo:hi] = g_ahp[lo:hi]
+    if rec_cs.shape[0] > 0:
+        rec_cs[t, lo:hi] = cs[lo:hi]
+    if rec_ws_pl.shape[0] > 0:
+        for a in range(pl_bptr[b], pl_bptr[b+1]):
+            rec_ws_pl[t, pl_perm[a]] = ws_pl[pl_perm[a]]
+
+
+def make_run_chunk(parallel):
+    """
+    Make kernel integrating steps start to end - 1, updating state arrays
+    (and spk counts) in place and writing state at each step into rec_*
+    buffers (when nonempty).
+
+    Within each step, blocks of neurons (see step_block) are integrated one
+    after another, or, if parallel, concurrently on numba's thread pool,
+    which synchronizes once per step. Since each block sums its inputs in
+    the same order, the results do not depend on the number of blocks or
+    threads.
+
+    Row 0 of spks_up holds the upstream inputs of time step up_start.
+    External currents, forced potentials, and forced spks may also be given
+    as sparse schedules (ie_*, vf_*, sf_*; CSR arrays over time steps, see
+    ntwk_inp.DriveSchedule), only the entries of which are visited.
+
+    Integration is forward Euler, or exponential Euler if exp_int is True
+    (see LIFNtwk.run).
+
+    If rec_cts is nonempty, the numbers of spks and of synaptic events
+    (given the numbers of synapses n_syns_up and n_syns_rcr from each
+    upstream and recurrent neuron) at each step are written into its cols.
+    """
+    def run_chunk(
+            start, end, dt, spks_up, up_start, i_ext, vs_forced, spks_forced,
+            ie_ptr, ie_idx, ie_val, vf_ptr, vf_idx, vf_val, sf_ptr, sf_idx,
+            blocks, up_data, up_indices, up_bptr, rcr_data, rcr_indices,
+            rcr_bptr, t_syn, e_syn, t_m, e_l, v_th, v_reset, t_r, e_ahp,
+            t_ahp, w_ahp, pl_perm, pl_bptr, pl_syn, pl_row, pl_col, pl_w_max,
+            t_c, c_s, b_c, t_w, exp_int, dt_ref, decay_syn, avg_syn,
+            decay_ahp, avg_ahp, decay_c, vs, spks, gs, g_ahp, rp_ctrs, cs,
+            ws_pl, spk_cts, rec_vs, rec_spks, rec_gs, rec_g_ahp, rec_cs,
+            rec_ws_pl, n_syns_up, n_syns_rcr, rec_cts):
+        n_syn, n = gs.shape
+
+        inps = np.zeros(n_syn*n)
+
+        # active upstream inputs and spiking neurons of current step
+        act_up = np.zeros(spks_up.shape[1], dtype=np.int64)
+        act_rcr = np.zeros(n, dtype=np.int64)
+
+        # scheduled drive of current step
+        i_sch = np.zeros(n)
+        v_sch = np.full(n, np.nan)
+        s_sch = np.zeros(n, dtype=np.bool_)
+
+        for step in range(start, end):
+            x = spks_up[step - up_start]
+
+            n_act_up, n_act_rcr = begin_step(
+                step, x, spks, act_up, act_rcr, ie_ptr, ie_idx, ie_val,
+                vf_ptr, vf_idx, vf_val, sf_ptr, sf_idx, i_sch, v_sch, s_sch)
+
+            if rec_cts.shape[0] > 0:
+                n_events = 0
+                for a in range(n_act_up):
+                    n_events += n_syns_up[act_up[a]] * x[act_up[a]]
+                for a in range(n_act_rcr):
+                    n_events += n_syns_rcr[act_rcr[a]]
+
+                rec_cts[step - start, 1] = n_events
+
+            for b in prange(len(blocks) - 1):
+                step_block(
+                    b, step, step - start, dt, x, act_up, n_act_up, act_rcr,
+                    n_act_rcr, i_ext, vs_forced, spks_forced, i_sch, v_sch,
+                    s_sch, blocks, up_data, up_indices, up_bptr, rcr_data,
+                    rcr_indices, rcr_bptr, t_syn, e_syn, t_m, e_l, v_th,
+                    v_reset, t_r, e_ahp, t_ahp, w_ahp, pl_perm, pl_bptr,
+                    pl_syn, pl_row, pl_col, pl_w_max, t_c, c_s, b_c, t_w,
+                    exp_int, dt_ref, decay_syn, avg_syn, decay_ahp, avg_ahp,
+                    decay_c, vs, spks, gs, g_ahp, rp_ctrs, cs, ws_pl,
+                    spk_cts, inps, rec_vs, rec_spks, rec_gs, rec_g_ahp,
+                    rec_cs, rec_ws_pl)
+
+            if rec_cts.shape[0] > 0:
+                rec_cts[step - start, 0] = spks.sum()
+
+            end_step(
+                step, ie_ptr, ie_idx, vf_ptr, vf_idx, sf_ptr, sf_idx,
+                i_sch, v_sch, s_sch)
+
+    run_chunk.__name__ = run_chunk.__qualname__ = \
+        'run_chunk_par' if parallel else 'run_chunk'
+
+    return njit(cache=True, parallel=parallel)(run_chunk)
+
+
+run_chunk = make_run_chunk(parallel=False)
+run_chunk_par = make_run_chunk(parallel=True)
+
+
+def nrn_blocks(n, n_blocks):
+    """Split neurons 0 to n - 1 into n_blocks contiguous blocks of equal size."""
+    return np.linspace(0, n, max(min(n_blocks, n), 1) + 1).astype(np.int64)
+
+
+def split_csc(data, indices, indptr, n, blocks):
+    """
+    Split a stacked csc operator (rows syn_ctr*n + targ, see static_csc)
+    into one operator per block of targ neurons.
+
+    :return: data and indices of entries ordered by block (then col), and
+        (n_blocks, n_src + 1) array of column pointers of each block
+    """
+    n_src = len(indptr) - 1
+    n_blocks = len(blocks) - 1
+
+    cols = np.repeat(np.arange(n_src), np.diff(indptr))
+    blks = np.searchsorted(blocks, indices % n, 'right') - 1
+
+    # stable, so entries of each col keep their order
+    order = np.argsort(blks*n_src + cols, kind='stable')
+
+    cts = np.bincount(blks*n_src + cols, minlength=n_blocks*n_src)
+    ptr = np.concatenate([[0], np.cumsum(cts)])
+
+    bptr = ptr[np.arange(n_blocks)[:, None]*n_src + np.arange(n_src + 1)]
+
+    return data[order], indices[order], bptr.astype(indptr.dtype)
+
+
+def _per_nrn(x, n, dtype=float):
+    """Broadcast a scalar or 1-D param to a contiguous float array."""
+    return np.ascontiguousarray(np.broadcast_to(np.asarray(x, dtype), (n,)))
+
+
+def run_compiled(
+        ntwk, spks_up, dt, i_ext, vs_forced, spks_forced,
+        vs_prev, spks_prev, gs_prev, g_ahp_prev, rp_ctrs, cs_prev,
+        ws_plastic_prev, vs, spks, gs, g_ahp, cs, ws_plastic, spk_cts,
+        integrator='euler', dt_ref=None, start=1, every=None, threads=None,
+        timer=None, step_spks=None, step_events=None):
+    """
+    Generator running the simulation loop of LIFNtwk.iter_run with the
+    compiled kernel, one chunk at a time.
+
+    After every chunk, state (*_prev, rp_ctrs) is updated in place (syn-dicts
+    are updated with new arrays), recordings are written into the provided
+    recorders (see ntwk_rec.py; which may be None), and the index of the
+    last completed step is yielded.
+
+    :param spk_cts: array of spk counts per neuron, incremented in place
+    :param integrator: 'euler' or 'exp' (see LIFNtwk.run)
+    :param dt_ref: reference time step for 'exp' integrator (see LIFNtwk.run)
+    :param start: first time step to compute
+    :param every: if given, chunks also end after every time step that is a
+        multiple of it
+    :param threads: number of threads to split the neurons of each step
+        across (serial if None or 1; at most numba.config.NUMBA_NUM_THREADS
+        are used, but results are the same for any number)
+    :param timer: ntwk.PhaseTimer to time phases of the smln with
+    :param step_spks: array to write number of spks at each time step into
+    :param step_events: array to write number of synaptic events at each
+        time step into (see ntwk.NtwkProfile)
+    """
+    syns = ntwk.syns
+    n = ntwk.n
+    n_steps = len(spks_up)
+
+    # float dtype of weights, state, and inputs, and int dtype of indices
+    dtype = ntwk.dtype
+    idx = idx_dtype(max(n, ntwk.n_up))
+
+    # stacked weights, excluding plastic entries from upstream matrix
+    if ntwk.plasticity is not None:
+        masks = ntwk.plasticity['masks']
+    else:
+        masks = None
+
+    up_data, up_indices, up_indptr = static_csc(
+        ntwk.ws_up_init, syns, masks, dtype)
+    rcr_data, rcr_indices, rcr_indptr = static_csc(ntwk.ws_rcr, syns, dtype=dtype)
+
+    # blocks of target neurons integrated by each thread, with their parts
+    # of the stacked operators
+    if threads is not None and threads > 1:
+        kernel = run_chunk_par
+        blocks = nrn_blocks(n, threads)
+    else:
+        kernel = run_chunk
+        blocks = nrn_blocks(n, 1)
+
+    up_data, up_indices, up_bptr = split_csc(
+        up_data, up_indices, up_indptr, n, blocks)
+    rcr_data, rcr_indices, rcr_bptr = split_csc(
+        rcr_data, rcr_indices, rcr_indptr, n, blocks)
+
+    # per-neuron params
+    t_syn = np.array([_per_nrn(ntwk.ts_syn[syn], n, dtype) for syn in syns])
+    e_syn = np.array([_per_nrn(ntwk.es_syn[syn], n, dtype) for syn in syns])
+    t_syn = t_syn.reshape((len(syns), n)).astype(dtype)
+    e_syn = e_syn.reshape((len(syns), n)).astype(dtype)
+
+    t_m, e_l, v_th, v_reset, e_ahp, t_ahp, w_ahp = [
+        _per_nrn(x, n, dtype) for x in (
+            ntwk.t_m, ntwk.e_l, ntwk.v_th, ntwk.v_reset,
+            ntwk.e_ahp, ntwk.t_ahp, ntwk.w_ahp)]
+
+    # refractory times and counters are kept in double precision (see
+    # LIFNtwk)
+    t_r = _per_nrn(ntwk.t_r, n)
+
+    # plastic weights, concatenated over synapse types
+    if ntwk.plasticity is not None:
+        plastic = PlasticSyns(masks)
+        pl_syn, pl_row, pl_col, pl_w_max, ws_pl = [], [], [], [], []
+
+        for ctr, syn in enumerate(syns):
+            rows, cols = plastic.targs[syn], plastic.srcs[syn]
+
+            pl_syn.append(np.repeat(ctr, len(rows)))
+            pl_row.append(rows)
+            pl_col.append(cols)
+            pl_w_max.append(_per_nrn(
+                ntwk.plasticity['w_pc_st_maxs'][syn], len(rows), dtype))
+            ws_pl.append(ws_plastic_prev[syn])
+
+        pl_syn, pl_row, pl_col = [
+            np.concatenate(x).astype(idx) for x in (pl_syn, pl_row, pl_col)]
+        pl_w_max, ws_pl = [
+            np.concatenate(x).astype(dtype) for x in (pl_w_max, ws_pl)]
+
+        t_c = float(ntwk.plasticity['T_C'])
+        c_s = float(ntwk.plasticity['C_S'])
+        b_c = float(ntwk.plasticity['B_C'])
+        t_w = float(ntwk.plasticity['T_W'])
+
+        cs_ = cs_prev.astype(dtype)
+        offsets = np.cumsum([0] + [ntwk.ns_plastic[syn] for syn in syns])
+    else:
+        pl_syn = pl_row = pl_col = np.zeros(0, dtype=idx)
+        pl_w_max = ws_pl = np.zeros(0, dtype=dtype)
+        t_c = c_s = b_c = 1.
+        t_w = 0.
+
+        cs_ = np.zeros(n, dtype=dtype)
+
+    # plastic weights grouped by block of their targ neurons
+    pl_blks = np.searchsorted(blocks, pl_row, 'right') - 1
+    pl_perm = np.argsort(pl_blks, kind='stable').astype(idx)
+    pl_bptr = np.searchsorted(
+        pl_blks[pl_perm], np.arange(len(blocks))).astype(idx)
+
+    # exact decay factors
+    if dt_ref is None:
+        dt_ref = dt
+
+    decay_syn, avg_syn = exp_factors(dt, t_syn, dtype)
+    decay_ahp, avg_ahp = exp_factors(dt, t_ahp, dtype)
+    decay_c = float(np.exp(-dt/t_c))
+
+    # inputs (input sources are drawn from one chunk at a time)
+    if isinstance(spks_up, InpSource):
+        src_up = spks_up
+    else:
+        src_up = None
+        spks_up = np.ascontiguousarray(spks_up)
+
+    # external drive, split into dense arrays and sparse schedules (one of
+    # which is empty)
+    def sched(x, shape):
+        if isinstance(x, DriveSchedule):
+            return np.zeros(shape), (
+                x.indptr.astype(np.int64), x.indices.astype(np.int64),
+                x.data.astype(dtype))
+        else:
+            return x, (
+                np.zeros(1, dtype=np.int64), np.zeros(0, dtype=np.int64),
+                np.zeros(0, dtype=dtype))
+
+    i_ext, (ie_ptr, ie_idx, ie_val) = sched(i_ext, (0, 1))
+    vs_forced, (vf_ptr, vf_idx, vf_val) = sched(vs_forced, (0, n))
+    spks_forced, (sf_ptr, sf_idx, sf_val) = sched(spks_forced, (0, n))
+
+    # only nonzero entries of spk schedules are forced spks
+    keep = sf_val != 0
+    sf_ptr = np.concatenate([[0], np.cumsum(keep)]).astype(np.int64)[sf_ptr]
+    sf_idx = sf_idx[keep]
+
+    i_ext = np.asarray(i_ext, dtype=dtype)
+    if i_ext.ndim == 1:
+        i_ext = i_ext[:, None]
+    i_ext = np.ascontiguousarray(i_ext)
+    vs_forced = np.ascontiguousarray(vs_forced, dtype=dtype)
+    spks_forced = np.ascontiguousarray(spks_forced, dtype=bool)
+
+    # state
+    vs_ = vs_prev.astype(dtype)
+    spks_ = spks_prev.astype(bool)
+    gs_ = np.array(
+        [gs_prev[syn] for syn in syns], dtype=dtype).reshape((len(syns), n))
+    g_ahp_ = g_ahp_prev.astype(dtype)
+    rp_ctrs_ = rp_ctrs.astype(float)
+
+    # chunked recording buffers
+    def buf(shape, dtype, on):
+        return np.zeros((CHUNK,) + shape if on else (0,) + shape, dtype=dtype)
+
+    rec_vs = buf((n,), dtype, vs is not None)
+    rec_spks = buf((n,), bool, spks is not None)
+    rec_gs = buf((len(syns), n), dtype, gs is not None)
+    rec_g_ahp = buf((n,), dtype, g_ahp is not None)
+    rec_cs = buf((n,), dtype, cs is not None)
+    rec_ws_pl = buf((len(ws_pl),), dtype, ws_plastic is not None)
+
+    # spk and synaptic event counts
+    rec_cts = buf((2,), np.int64, step_spks is not None)
+
+    if step_spks is not None:
+        n_syns_up = count_syns(ntwk.ws_up_init, syns)
+        n_syns_rcr = count_syns(ntwk.ws_rcr, syns)
+    else:
+        n_syns_up = n_syns_rcr = np.zeros(0, dtype=np.int64)
+
+    def write_state():
+        vs_prev[:] = vs_
+        spks_prev[:] = spks_
+        for ctr, syn in enumerate(syns):
+            gs_prev[syn] = gs_[ctr].copy()
+        g_ahp_prev[:] = g_ahp_
+        rp_ctrs[:] = rp_ctrs_
+
+        if ntwk.plasticity is not None:
+            cs_prev[:] = cs_
+            for ctr, syn in enumerate(syns):
+                ws_plastic_prev[syn] = ws_pl[offsets[ctr]:offsets[ctr+1]].copy()
+
+    spk_cts_ = np.zeros(n)
+
+    if timer is None:
+        timer = PhaseTimer(False)
+
+    timer.lap('setup')
+
+    while start < n_steps:
+        end = min(start + CHUNK, n_steps)
+
+        if every is not None:
+            end = min(end, ((start - 1)//every + 1)*every + 1)
+
+        if src_up is not None:
+            spks_up = np.ascontiguousarray(src_up[start:end])
+            up_start = start
+        else:
+            up_start = 0
+
+        timer.lap('inps_up')
+
+        if kernel is run_chunk_par:
+            numba.set_num_threads(min(threads, numba.config.NUMBA_NUM_THREADS))
+
+        kernel(
+            start, end, dt, spks_up, up_start, i_ext, vs_forced, spks_forced,
+            ie_ptr, ie_idx, ie_val, vf_ptr, vf_idx, vf_val, sf_ptr, sf_idx,
+            blocks, up_data, up_indices, up_bptr, rcr_data, rcr_indices,
+            rcr_bptr, t_syn, e_syn, t_m, e_l, v_th, v_reset, t_r, e_ahp,
+            t_ahp, w_ahp, pl_perm, pl_bptr, pl_syn, pl_row, pl_col, pl_w_max,
+            t_c, c_s, b_c, t_w,
+            integrator == 'exp', dt_ref, decay_syn, avg_syn, decay_ahp,
+            avg_ahp, decay_c, vs_, spks_, gs_, g_ahp_, rp_ctrs_, cs_, ws_pl,
+            spk_cts_, rec_vs, rec_spks, rec_gs, rec_g_ahp, rec_cs, rec_ws_pl,
+            n_syns_up, n_syns_rcr, rec_cts)
+
+        timer.lap('kernel')
+
+        # copy recordings into storage arrays
+        n_rec = end - start
+
+        if vs is not None:
+            vs.write_block(start, rec_vs[:n_rec])
+        if spks is not None:
+            spks.write_block(start, rec_spks[:n_rec])
+        if gs is not None:
+            for ctr, syn in enumerate(syns):
+                gs[syn].write_block(start, rec_gs[:n_rec, ctr])
+        if g_ahp is not None:
+            g_ahp.write_block(start, rec_g_ahp[:n_rec])
+        if ntwk.plasticity is not None:
+            if cs is not None:
+                cs.write_block(start, rec_cs[:n_rec])
+            if ws_plastic is not None:
+                for ctr, syn in enumerate(syns):
+                    ws_plastic[syn].write_block(
+                        start, rec_ws_pl[:n_rec, offsets[ctr]:offsets[ctr+1]])
+        if step_spks is not None:
+            step_spks[start:end] = rec_cts[:n_rec, 0]
+            step_events[start:end] = rec_cts[:n_rec, 1]
+
+        # write state and spk counts back
+        write_state()
+
+        spk_cts += spk_cts_
+        spk_cts_[:] = 0
+
+        timer.lap('record')
+
+        yield end - 1
+
+        start = end
@@ -0,0 +1,523 @@
+"""
+Recorders for state traces produced by LIFNtwk.run.
+
+A recorder receives the state vector of one variable at each step (or a
+block of consecutive steps) and returns the recorded (T, n) trace when the
+smln is finished. Recorder writes the trace into an array held in memory,
+while DiskRecorder streams it in chunks into a .npy file, so that resident
+memory is bounded by the chunk size, and returns it as a read-only
+memory-mapped array that is only loaded from disk as it is accessed.
+SpkRecorder records spks as compact (time step, neuron) event lists
+(SpkEvents) instead of a dense (T, n) boolean raster. SelRecorder passes
+only selected time steps and elements on to one of these, so that
+unselected parts of a trace are never allocated.
+"""
+import numpy as np
+import os
+
+
+class Recorder(object):
+    """
+    Record a time-series of 1-D state vectors into an in-memory array.
+
+    :param n_t: number of time steps
+    :param n: number of elements per time step
+    :param dtype: dtype of recorded trace
+    """
+
+    def __init__(self, n_t, n, dtype):
+        """Constructor."""
+        self.n_t = n_t
+        self.n = n
+        self.dtype = np.dtype(dtype)
+
+        if self.dtype == bool:
+            self.data = np.zeros((n_t, n), dtype=bool)
+        else:
+            self.data = np.nan * np.zeros((n_t, n), dtype=self.dtype)
+
+    def write(self, step, x):
+        """Record state vector x at time step "step"."""
+        self.data[step] = x
+
+    def write_block(self, start, xs):
+        """Record rows of xs at consecutive time steps starting at "start"."""
+        self.data[start:start+len(xs)] = xs
+
+    def finalize(self):
+        """Return recorded trace."""
+        return self.data
+
+
+class DiskRecorder(Recorder):
+    """
+    Record a time-series of 1-D state vectors by streaming it in chunks
+    into a .npy file.
+
+    :param path: path of .npy file to write trace to
+    :param n_t: number of time steps
+    :param n: number of elements per time step
+    :param dtype: dtype of recorded trace
+    :param chunk: number of time steps to buffer in memory between writes
+    """
+
+    def __init__(self, path, n_t, n, dtype, chunk=1000):
+        """Constructor."""
+        self.path = path
+        self.n_t = n_t
+        self.n = n
+        self.dtype = np.dtype(dtype)
+        self.chunk = chunk
+
+        save_dir = os.path.dirname(path)
+        if save_dir and not os.path.exists(save_dir):
+            os.makedirs(save_dir)
+
+        # allocate file (header and data) on disk and get data offset
+        mmap = np.lib.format.open_memmap(
+            path, mode='w+', dtype=self.dtype, shape=(n_t, n))
+        self.offset = mmap.offset
+        del mmap
+
+        self.file = open(path, 'r+b')
+
+        # chunk buffer
+        self.buf = np.zeros((chunk, n), dtype=self.dtype)
+        self.buf_start = 0
+        self.n_buf = 0
+
+    def write(self, step, x):
+        """Record state vector x at time step "step"."""
+        if self.n_buf == self.chunk or (
+                self.n_buf and step != self.buf_start + self.n_buf):
+            self.flush()
+
+        if not self.n_buf:
+            self.buf_start = step
+
+        self.buf[self.n_buf] = x
+        self.n_buf += 1
+
+    def write_block(self, start, xs):
+        """Record rows of xs at consecutive time steps starting at "start"."""
+        self.flush()
+        self._write_rows(start, np.asarray(xs, dtype=self.dtype))
+
+    def flush(self):
+        """Write buffered time steps to disk."""
+        if self.n_buf:
+            self._write_rows(self.buf_start, self.buf[:self.n_buf])
+            self.n_buf = 0
+
+    def _write_rows(self, start, xs):
+        row_size = self.n * self.dtype.itemsize
+
+        self.file.seek(self.offset + start*row_size)
+        self.file.write(np.ascontiguousarray(xs).tobytes())
+
+    def finalize(self):
+        """Flush remaining data and return memory-mapped recorded trace."""
+        self.flush()
+        self.file.close()
+
+        del self.buf
+
+        return np.load(self.path, mmap_mode='r')
+
+
+class SelRecorder(object):
+    """
+    Record selected time steps and elements of a time-series of 1-D state
+    vectors into an inner recorder holding only the selection.
+
+    :param rec: inner recorder (with one row per selected time step and
+        one col per selected element)
+    :param n_t: number of time steps
+    :param steps: sorted idxs of time steps to record (all if None)
+    :param cols: idxs of elements to record (all if None)
+    :param absolute: whether inner recorder has one row per time step
+        (e.g., SpkRecorder, whose events keep their absolute time steps)
+    """
+
+    def __init__(self, rec, n_t, steps=None, cols=None, absolute=False):
+        """Constructor."""
+        self.rec = rec
+        self.steps = steps
+        self.cols = cols
+        self.absolute = absolute
+
+        # row of inner recorder corresponding to each time step (-1 if none)
+        if steps is not None:
+            self.rows = -np.ones(n_t, dtype=int)
+            self.rows[steps] = np.arange(len(steps))
+
+    def write(self, step, x):
+        """Record state vector x at time step "step" (if selected)."""
+        if self.steps is not None:
+            row = self.rows[step]
+
+            if row < 0:
+                return
+                
+        if self.absolute or self.steps is None:
+            row = step
+
+        self.rec.write(row, x if self.cols is None else x[self.cols])
+
+    def write_block(self, start, xs):
+        """Record selected rows of xs at consecutive time steps from "start"."""
+        if self.steps is not None:
+            rows = self.rows[start:start+len(xs)]
+            mask = rows >= 0
+
+            if not mask.any():
+                return
+
+            if self.absolute:
+                xs = np.where(mask[:, None], xs, 0).astype(xs.dtype)
+            else:
+                # selected steps in a block map onto consecutive rows
+                xs = xs[mask]
+                start = rows[mask][0]
+
+        if self.cols is not None:
+            xs = xs[:, self.cols]
+
+        self.rec.write_block(start, xs)
+
+    def finalize(self):
+        """Return recorded selection."""
+        return self.rec.finalize()
+
+
+def get_rec_steps(sel, n_t, dt):
+    """
+    Get idxs of time steps to record from a selection dict.
+
+    :param sel: dict with any of the keys "steps" (time step idxs), "ts"
+        (times), "wdws" (list of (start, end) time windows), and "every"
+        (stride); the union of the steps given by "steps", "ts", and "wdws"
+        (all steps if none are given) is decimated to those that are
+        multiples of "every" (steps outside the smln are ignored)
+    :param n_t: number of time steps
+    :param dt: time step
+
+    :return: sorted array of time step idxs, or None if all are selected
+    """
+    for key in sel:
+        if key not in ('steps', 'ts', 'wdws', 'every'):
+            raise ValueError(
+                'Unrecognized recording selection "{}".'.format(key))
+
+    if not any(key in sel for key in ('steps', 'ts', 'wdws', 'every')):
+        return None
+
+    if any(key in sel for key in ('steps', 'ts', 'wdws')):
+        mask = np.zeros(n_t, dtype=bool)
+
+        steps = []
+        
+        if 'steps' in sel:
+            steps.append(np.asarray(sel['steps'], dtype=int))
+        if 'ts' in sel:
+            steps.append(np.round(np.asarray(sel['ts']) / dt).astype(int))
+            
+        if steps:
+            steps = np.concatenate(steps)
+            mask[steps[(0 <= steps) & (steps < n_t)]] = True
+            
+        if 'wdws' in sel:
+            ts = np.arange(n_t) * dt
+            for start, end in sel['wdws']:
+                mask[(start <= ts) & (ts < end)] = True
+    else:
+        mask = np.ones(n_t, dtype=bool)
+
+    if 'every' in sel:
+        mask[np.arange(n_t) % sel['every'] != 0] = False
+
+    return mask.nonzero()[0]
+
+
+def rec_dtype(dtype):
+    """
+    Return dtype a trace is recorded with as a np.dtype (given, e.g., as a
+    type or a string such as 'float32'), or None or 'events' as given.
+    """
+    if dtype is None or (isinstance(dtype, str) and dtype == 'events'):
+        return dtype
+    
+    return np.dtype(dtype)
+
+
+def make_recorder(
+        name, n_t, n, dtype, rec_dir=None, rec_chunk=1000, steps=None,
+        cols=None):
+    """
+    Make a recorder for a state variable.
+
+    :param name: name of recorded variable (used as file name)
+    :param n_t: number of time steps
+    :param n: number of elements per time step
+    :param dtype: dtype of recorded trace (e.g., np.float32 or 'float32';
+        'events' to record spks as SpkEvents)
+    :param rec_dir: directory to stream trace into (in memory if None)
+    :param rec_chunk: number of time steps to buffer in memory between writes
+    :param steps: sorted idxs of time steps to record (all if None)
+    :param cols: idxs of elements to record (all if None)
+    """
+    dtype = rec_dtype(dtype)
+    
+    n_t_rec = n_t if steps is None else len(steps)
+    n_rec = n if cols is None else len(cols)
+
+    if dtype == 'events':
+        # spk events are always indexed by absolute time step
+        rec = SpkRecorder(n_t, n_rec)
+    elif rec_dir is None:
+        rec = Recorder(n_t_rec, n_rec, dtype)
+    else:
+        path = os.path.join(rec_dir, '{}.npy'.format(name))
+        rec = DiskRecorder(path, n_t_rec, n_rec, dtype, chunk=rec_chunk)
+
+    if steps is None and cols is None:
+        return rec
+    else:
+        return SelRecorder(
+            rec, n_t, steps=steps, cols=cols, absolute=(dtype == 'events'))
+
+
+class SpkEvents(object):
+    """
+    Spks stored as (time step, neuron) event lists sorted by time step,
+    with CSR-style offsets, so that spks at steps start to end - 1 are
+    t_idxs[offsets[start]:offsets[end]], nrns[offsets[start]:offsets[end]].
+
+    Queries over a window of time steps only visit the spks in it. A second
+    index sorted by neuron (see by_nrn) is built on first use by per-neuron
+    queries (see train).
+
+    :param t_idxs: time step idx of each spk (sorted)
+    :param nrns: neuron idx of each spk
+    :param n_t: number of time steps
+    :param n: number of neurons
+    :param offsets: offsets of spks of each time step (computed from t_idxs
+        if None)
+    """
+
+    def __init__(self, t_idxs, nrns, n_t, n, offsets=None):
+        """Constructor."""
+        self.t_idxs = np.asarray(t_idxs, dtype=np.int64)
+        self.nrns = np.asarray(nrns, dtype=np.int64)
+        self.n_t = n_t
+        self.n = n
+
+        if len(self.t_idxs) != len(self.nrns):
+            raise ValueError('Args "t_idxs" and "nrns" must have same length.')
+
+        if offsets is None:
+            offsets = np.concatenate([
+                [0], np.cumsum(np.bincount(self.t_idxs, minlength=n_t))])
+        elif len(offsets) != n_t + 1:
+            raise ValueError('Arg "offsets" must have length n_t + 1.')
+
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+
+        # index sorted by neuron (built on first use)
+        self.nrn_offsets = None
+        self.nrn_t_idxs = None
+
+    @classmethod
+    def from_dense(cls, spks):
+        """Make SpkEvents from dense (time points x neurons) spk array."""
+        t_idxs, nrns = np.asarray(spks).nonzero()
+        return cls(t_idxs, nrns, spks.shape[0], spks.shape[1])
+
+    @property
+    def shape(self):
+        """Shape of dense spk array."""
+        return (self.n_t, self.n)
+
+    def __len__(self):
+        """Number of time steps."""
+        return self.n_t
+
+    def nonzero(self):
+        """Time step and neuron idxs of all spks (as for dense array)."""
+        return self.t_idxs, self.nrns
+
+    def dense(self):
+        """Return dense (time points x neurons) bool spk array."""
+        spks = np.zeros((self.n_t, self.n), dtype=bool)
+        spks[self.t_idxs, self.nrns] = True
+        return spks
+
+    def window(self, start, end):
+        """
+        Return SpkEvents for time steps start to end - 1 (with time step
+        idxs relative to start).
+        """
+        start = max(start, 0)
+        end = max(min(end, self.n_t), start)
+
+        sl = slice(self.offsets[start], self.offsets[end])
+
+        # slice offsets rather than recomputing them from t_idxs
+        return SpkEvents(
+            self.t_idxs[sl] - start, self.nrns[sl], end - start, self.n,
+            offsets=self.offsets[start:end + 1] - self.offsets[start])
+
+    def select(self, nrns):
+        """
+        Return SpkEvents for a subset of neurons, reindexed in the order
+        given (as for dense_spks[:, nrns]; nrns may be a boolean mask and
+        may contain repeats).
+        """
+        nrns = np.asarray(nrns)
+
+        if nrns.dtype == bool:
+            nrns = nrns.nonzero()[0]
+
+        # map each neuron to its position(s) in nrns
+        order = np.argsort(nrns, kind='stable')
+        nrns_sorted = nrns[order]
+
+        los = np.searchsorted(nrns_sorted, self.nrns, 'left')
+        his = np.searchsorted(nrns_sorted, self.nrns, 'right')
+        n_reps = his - los
+
+        idxs = np.repeat(np.arange(len(self.nrns)), n_reps)
+        pos = np.repeat(los - np.cumsum(n_reps) + n_reps, n_reps) \
+            + np.arange(n_reps.sum())
+
+        # sort events by time step, then new neuron idx
+        t_idxs = self.t_idxs[idxs]
+        nrns_new = order[pos]
+
+        sort = np.lexsort([nrns_new, t_idxs])
+
+        return SpkEvents(t_idxs[sort], nrns_new[sort], self.n_t, len(nrns))
+
+    def by_nrn(self):
+        """
+        Return spk time step idxs sorted by neuron (then time step) with
+        CSR-style offsets, so that spks of neuron i are
+        nrn_t_idxs[nrn_offsets[i]:nrn_offsets[i+1]] (built once).
+        """
+        if self.nrn_offsets is None:
+            order = np.argsort(self.nrns, kind='stable')
+
+            self.nrn_t_idxs = self.t_idxs[order]
+            self.nrn_offsets = np.concatenate([
+                [0], np.cumsum(np.bincount(self.nrns, minlength=self.n))])
+
+        return self.nrn_t_idxs, self.nrn_offsets
+
+    def train(self, nrn, start=0, end=None):
+        """
+        Time step idxs of spks of neuron nrn in time steps start to end - 1.
+        """
+        if end is None:
+            end = self.n_t
+
+        t_idxs, offsets = self.by_nrn()
+        t_idxs = t_idxs[offsets[nrn]:offsets[nrn+1]]
+
+        lo, hi = np.searchsorted(t_idxs, [start, end])
+
+        return t_idxs[lo:hi]
+
+    def counts(self, start=0, end=None):
+        """Number of spks per neuron in time steps start to end - 1."""
+        if end is None:
+            end = self.n_t
+
+        return np.bincount(self.window(start, end).nrns, minlength=self.n)
+
+    def first(self, start=0, end=None):
+        """
+        Time step idx (relative to start) of first spk per neuron in time
+        steps start to end - 1 (-1 for neurons that did not spk).
+        """
+        if end is None:
+            end = self.n_t
+
+        wdw = self.window(start, end)
+
+        firsts = -np.ones(self.n, dtype=np.int64)
+        nrns, idxs = np.unique(wdw.nrns, return_index=True)
+        firsts[nrns] = wdw.t_idxs[idxs]
+
+        return firsts
+
+    def binned(self, edges):
+        """
+        Number of spks per neuron in each bin of time steps edges[k] to
+        edges[k+1] - 1.
+
+        :param edges: sorted time step idxs bounding bins
+
+        :return: (n_bins, n) array of spk counts
+        """
+        edges = np.clip(np.asarray(edges, dtype=np.int64), 0, self.n_t)
+        n_bins = max(len(edges) - 1, 0)
+
+        if not n_bins:
+            return np.zeros((0, self.n), dtype=np.int64)
+
+        wdw = self.window(edges[0], edges[-1])
+
+        bins = np.searchsorted(edges - edges[0], wdw.t_idxs, 'right') - 1
+
+        return np.bincount(
+            bins*self.n + wdw.nrns, minlength=n_bins*self.n
+        ).reshape((n_bins, self.n))
+
+
+def to_spk_events(spks):
+    """Return spks as SpkEvents (converting from dense array if needed)."""
+    if isinstance(spks, SpkEvents):
+        return spks
+    else:
+        return SpkEvents.from_dense(spks)
+
+
+class SpkRecorder(object):
+    """
+    Record spks as (time step, neuron) event lists.
+
+    :param n_t: number of time steps
+    :param n: number of neurons
+    """
+
+    def __init__(self, n_t, n):
+        """Constructor."""
+        self.n_t = n_t
+        self.n = n
+
+        self.t_idxs = []
+        self.nrns = []
+
+    def write(self, step, x):
+        """Record spk vector x at time step "step"."""
+        nrns = x.nonzero()[0]
+
+        self.t_idxs.append(np.repeat(step, len(nrns)))
+        self.nrns.append(nrns)
+
+    def write_block(self, start, xs):
+        """Record rows of xs at consecutive time steps starting at "start"."""
+        t_idxs, nrns = np.asarray(xs).nonzero()
+
+        self.t_idxs.append(t_idxs + start)
+        self.nrns.append(nrns)
+
+    def finalize(self):
+        """Return recorded spks as SpkEvents."""
+        if self.t_idxs:
+            t_idxs = np.concatenate(self.t_idxs)
+            nrns = np.concatenate(self.nrns)
+        else:
+            t_idxs = nrns = np.zeros(0, dtype=np.int64)
+
+        return SpkEvents(t_idxs, nrns, self.n_t, self.n)
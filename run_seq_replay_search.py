@@ -3,79 +3,353 @@ Main search code executable.
 
 Call using:
 
-$ python search.py <group_name> <commit id> [<wait_time>]
+$ python search.py <group_name> <commit id> [<wait_time> [<batch_size>]]
+    [-j <workers>] [-n <n_samples>] [-t <budget>] [--seed <seed>]
+    [--queue <queue_size>] [--blas-threads <n>] [--db <url>]
+    [--save-batch <n>] [--save-interval <s>] [-y]
+
+If batch_size > 1, that many param sets are simulated together in one
+shared time loop (see smln.run_batch).
+
+Param sets are simulated by a pool of worker processes fed from a bounded
+queue of sample idxs. Sample k's params are drawn from its own RNG stream,
+seeded by (seed, k), so a search with a given seed simulates the same
+param sets regardless of the number of workers. The search stops after
+n_samples param sets or once budget seconds have passed (it runs until
+interrupted if neither is given); on SIGINT/SIGTERM no new samples are
+started and workers finish their current smlns (a second signal terminates
+them immediately).
+
+Each worker buffers its rslts and writes them to the db in batches (see
+db.RsltWriter), flushing them when idle and the rest before it exits. A
+param set only counts as done once its rslt is in the db; rslts that
+cannot be inserted (twice) are dropped and reported separately from failed
+smlns. The db url defaults
+to the one specified in "LOCAL.py" (see db.db_url); e.g., --db
+sqlite:///rslts.db runs the search against a local file.
 """
 
+import argparse
+import multiprocessing as mp
 import numpy as np
+import os
+import queue
+import signal
 import time
+import traceback
 import sys
 from sys import stdout
 
+from db import RsltWriter
 from seq_replay.p_ranges import p_ranges, STD
 from seq_replay.s_params import s_params
 from seq_replay import smln
 
 
-def search(group, commit, wait=None):
+# env vars limiting BLAS/OpenMP/numba threads of each worker
+THREAD_VARS = [
+    'OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS',
+    'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS', 'NUMBA_NUM_THREADS',
+]
 
-    ctr = 0
-    
-    while True:
-        if ctr % 50 == 0:
-            stdout.write('\n{}'.format(ctr))
+
+def search(
+        group, commit, wait=None, batch=1, workers=1, n_samples=None,
+        budget=None, seed=None, queue_size=None, blas_threads=1,
+        db_url=None, save_batch=20, save_interval=60.):
+    """
+    Run param search on a pool of worker processes.
+
+    :param group: group name smlns are saved under
+    :param commit: commit id smlns are saved with
+    :param wait: time (s) each worker sleeps after each task
+    :param batch: number of param sets per task (see smln.run_batch)
+    :param workers: number of worker processes
+    :param n_samples: number of param sets to simulate (unlimited if None)
+    :param budget: time (s) after which no new tasks are started
+    :param seed: base seed of param sampling (random if None)
+    :param queue_size: max number of tasks waiting for a worker
+        (2*workers if None)
+    :param blas_threads: number of BLAS/OpenMP/numba threads per worker
+    :param db_url: url of db to save rslts to (see db.db_url)
+    :param save_batch: number of rslts each worker writes to the db at once
+    :param save_interval: max time (s) rslts stay buffered while a worker
+        keeps producing them
+
+    :return: number of param sets simulated, number that failed, number
+        whose rslts could not be saved
+    """
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
+
+    if queue_size is None:
+        queue_size = 2 * workers
+
+    # pin threads of workers (spawned processes read these at import)
+    for var in THREAD_VARS:
+        os.environ[var] = str(blas_threads)
+
+    if db_url is not None:
+        os.environ['SMLN_DB_URL'] = db_url
+
+    ctx = mp.get_context('spawn')
+
+    task_q = ctx.Queue(maxsize=queue_size)
+    done_q = ctx.Queue()
+
+    procs = [
+        ctx.Process(
+            target=work,
+            args=(
+                group, commit, seed, wait, task_q, done_q, save_batch,
+                save_interval),
+            daemon=True)
+        for _ in range(workers)
+    ]
+
+    # stop starting new tasks on first signal, terminate workers on second
+    signals = []
+
+    def handle(signum, frame):
+        signals.append(signum)
+
+        if len(signals) == 1:
+            stdout.write('\nStopping after current smlns...\n')
             stdout.flush()
-        
-        np.random.seed()
-        p = sample_params()
-        
-        # run smln
-        rslt = smln.run(p=p, s_params=s_params, apxn=True)
-        smln.save(rslt, group, commit)
-        
+        else:
+            for proc in procs:
+                proc.terminate()
+
+    handlers_prev = {
+        signum: signal.signal(signum, handle)
+        for signum in [signal.SIGINT, signal.SIGTERM]
+    }
+
+    print('Seed: {}'.format(seed))
+
+    for proc in procs:
+        proc.start()
+
+    t_start = time.time()
+    ctrs = {'queued': 0, 'done': 0, 'failed': 0, 'unsaved': 0}
+
+    def collect(timeout=None):
+        # handle one report of saved, failed, or unsaved samples, if any
+        try:
+            kind, idxs, err = done_q.get(timeout=timeout)
+        except queue.Empty:
+            return
+
+        if kind == 'failed':
+            ctrs['failed'] += len(idxs)
+            sys.stderr.write('\nSamples {} failed:\n{}'.format(idxs, err))
+        elif kind == 'unsaved':
+            ctrs['unsaved'] += len(idxs)
+            sys.stderr.write(
+                '\nSaving rslts of samples {} failed:\n{}'.format(idxs, err))
+
+        for _ in idxs:
+            if ctrs['done'] % 50 == 0:
+                stdout.write('\n{}'.format(ctrs['done']))
+
+            ctrs['done'] += 1
+
+            stdout.write({'saved': '.', 'failed': 'x', 'unsaved': 's'}[kind])
+
+        stdout.flush()
+
+    try:
+        # queue tasks
+        while not signals:
+            if budget is not None and time.time() - t_start >= budget:
+                break
+            if n_samples is not None and ctrs['queued'] >= n_samples:
+                break
+            if not any([proc.is_alive() for proc in procs]):
+                raise RuntimeError('All workers exited unexpectedly.')
+
+            end = ctrs['queued'] + batch
+            if n_samples is not None:
+                end = min(end, n_samples)
+
+            idxs = list(range(ctrs['queued'], end))
+
+            try:
+                task_q.put(idxs, timeout=1)
+            except queue.Full:
+                collect(timeout=0)
+                continue
+
+            ctrs['queued'] = end
+
+            collect(timeout=0)
+
+        # drop tasks not yet started if stopping early
+        if signals:
+            while True:
+                try:
+                    idxs = task_q.get(timeout=.1)
+                except queue.Empty:
+                    break
+                ctrs['queued'] -= len(idxs)
+
+        # let workers finish
+        for _ in procs:
+            while any([proc.is_alive() for proc in procs]):
+                try:
+                    task_q.put(None, timeout=1)
+                    break
+                except queue.Full:
+                    collect(timeout=0)
+
+        while ctrs['done'] < ctrs['queued'] \
+                and any([proc.is_alive() for proc in procs]):
+            collect(timeout=1)
+
+        for proc in procs:
+            proc.join()
+
+        while not done_q.empty():
+            collect(timeout=.1)
+
+    finally:
+        for proc in procs:
+            if proc.is_alive():
+                proc.terminate()
+
+        for signum, handler in handlers_prev.items():
+            signal.signal(signum, handler)
+
+    print('\n{} param sets simulated ({} failed, {} not saved) in {:.1f} s.'
+          .format(ctrs['done'], ctrs['failed'], ctrs['unsaved'],
+                  time.time() - t_start))
+
+    return ctrs['done'], ctrs['failed'], ctrs['unsaved']
+
+
+def work(group, commit, seed, wait, task_q, done_q, save_batch, save_interval):
+    """
+    Worker loop: simulate and save the param sets of each task (list of
+    sample idxs) until a None task arrives.
+
+    Reports ('saved', idxs, None) once the rslts of samples idxs are in the
+    db, ('failed', idxs, err) if their smlns failed, and ('unsaved', idxs,
+    err) if their rslts could not be saved.
+    """
+    # signals are handled by the main process (see search)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+    writer = RsltWriter(
+        batch=save_batch, interval=save_interval,
+        on_saved=lambda idx: done_q.put(('saved', [idx], None)),
+        on_failed=lambda idx, err: done_q.put(('unsaved', [idx], err)))
+
+    while True:
+        # flush buffered rslts while idle
+        try:
+            idxs = task_q.get(timeout=save_interval)
+        except queue.Empty:
+            writer.flush()
+            continue
+
+        if idxs is None:
+            break
+
+        ps = [sample_params(np.random.default_rng([seed, idx])) for idx in idxs]
+
+        # run smln(s)
+        try:
+            if len(ps) == 1:
+                rslts = [smln.run(p=ps[0], s_params=s_params, apxn=True)]
+            else:
+                rslts = smln.run_batch(ps=ps, s_params=s_params, apxn=True)
+        except Exception:
+            done_q.put(('failed', idxs, traceback.format_exc()))
+            rslts = []
+
+        for idx, rslt in zip(idxs, rslts):
+            try:
+                smln.save(rslt, group, commit, writer, tag=idx)
+            except Exception:
+                done_q.put(('unsaved', [idx], traceback.format_exc()))
+
         if wait:
             time.sleep(wait)
-            
-        stdout.write('.')
-        stdout.flush()
-        
-        ctr += 1
 
+    # write remaining rslts (atexit handlers do not run in workers)
+    writer.close()
 
-def sample_params():
+
+def sample_params(rng=None):
     # loop over all items in p_ranges, using
-    # params directly if scalars, or sampling if 
-    # [lb, ub] are given
-    
+    # params directly if scalars, or sampling if
+    # [lb, ub] are given (from rng, or the global RNG if None)
+    if rng is None:
+        rng = np.random
+
     p = {}
     for k, v in p_ranges.items():
-        
+
         if not isinstance(v, list):
             p[k] = v
         else:
             # sample from within lb, ub
             lb, ub = v
-            x = np.clip(STD * np.random.randn(), -1, 1)
-            
+            x = np.clip(STD * rng.standard_normal(), -1, 1)
+
             # convert x \in [-1, 1] to param val
             p[k] = ((ub - lb)/2) * x + ((ub + lb)/2)
-            
+
     return p
-        
+
 
 if __name__ == '__main__':
-    args = sys.argv[1:]
-    
-    if not len(args) in [2, 3]:
-        raise Exception('2 or 3 arguments required.')
-        
-    group = args[0]
-    commit = args[1]
-    wait = int(args[2]) if len(args) == 3 else None
-    
-    print('Begin smln in group "{}" with commit "{}..." at {} s wait time?'.format(
-        group, commit[:6], wait))
-    confirm = input('[Y/N] ')
-    
-    if confirm.lower() == 'y':
+    parser = argparse.ArgumentParser(description='Run param search.')
+
+    parser.add_argument('group')
+    parser.add_argument('commit')
+    parser.add_argument('wait', nargs='?', type=int, default=None)
+    parser.add_argument('batch', nargs='?', type=int, default=1)
+    parser.add_argument(
+        '-j', '--workers', type=int, default=1, help='worker processes')
+    parser.add_argument(
+        '-n', '--n-samples', type=int, default=None,
+        help='number of param sets to simulate')
+    parser.add_argument(
+        '-t', '--budget', type=float, default=None,
+        help='time (s) after which no new smlns are started')
+    parser.add_argument(
+        '--seed', type=int, default=None, help='base seed of param sampling')
+    parser.add_argument(
+        '--queue', type=int, default=None,
+        help='max tasks waiting for a worker (default 2*workers)')
+    parser.add_argument(
+        '--blas-threads', type=int, default=1,
+        help='BLAS/OpenMP/numba threads per worker')
+    parser.add_argument(
+        '--db', default=None, help='db url (default from LOCAL.py)')
+    parser.add_argument(
+        '--save-batch', type=int, default=20,
+        help='rslts each worker writes to the db at once')
+    parser.add_argument(
+        '--save-interval', type=float, default=60.,
+        help='max time (s) rslts stay buffered')
+    parser.add_argument(
+        '-y', '--yes', action='store_true', help='skip confirmation')
+
+    args = parser.parse_args()
+
+    print('Begin smln in group "{}" with commit "{}..." at {} s wait time, '
+          'batch size {}, and {} workers?'.format(
+              args.group, args.commit[:6], args.wait, args.batch,
+              args.workers))
+
+    if args.yes or input('[Y/N] ').lower() == 'y':
         print('Commencing parameter search.\n')
-        search(group, commit, wait)
+        search(
+            args.group, args.commit, wait=args.wait, batch=args.batch,
+            workers=args.workers, n_samples=args.n_samples,
+            budget=args.budget, seed=args.seed, queue_size=args.queue,
+            blas_threads=args.blas_threads, db_url=args.db,
+            save_batch=args.save_batch, save_interval=args.save_interval)
@@ -3,11 +3,16 @@ Functions for creating structured synaptic weight matrices
 for sequence replay simulations.
 """
 import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.spatial import cKDTree
 
 from aux import lognormal_mu_sig
 
 cc = np.concatenate
 
+# cxn prb below which pairs of cells are not considered for cxns
+P_MIN = 1e-6
+
 
 def apx_lattice(lb, ub, n, randomize):
     """
@@ -75,99 +80,137 @@ def apx_lattice(lb, ub, n, randomize):
     return xs, ys
 
 
-def make_w_e_pc_pc(pfxs, pfys, p):
+def cutoff(z, l, p_min=None):
     """
-    Make proximally biased PC-PC weight matrix.
+    Distance beyond which a Gaussian cxn prb z*exp(-d**2/(2*l**2)) falls
+    below p_min.
     """
-    # make cxns
-    n_pc = p['N_PC']
+    if p_min is None:
+        p_min = P_MIN
+        
+    if z <= p_min or l <= 0:
+        return 0.
     
-    ## build distance matrix
-    dx = np.tile(pfxs[None, :], (n_pc, 1)) - np.tile(pfxs[:, None], (1, n_pc))
-    dy = np.tile(pfys[None, :], (n_pc, 1)) - np.tile(pfys[:, None], (1, n_pc))
-    d = np.sqrt(dx**2 + dy**2)
+    return l * np.sqrt(2 * np.log(z / p_min))
+
+
+def local_pairs(xs_targ, ys_targ, xs_src, ys_src, r):
+    """
+    Find all (targ, src) pairs of points within distance r of each other
+    using a k-d tree over the src points, so that cost scales with the
+    number of pairs found rather than with n_targ * n_src.
     
-    ## build cxn probability matrix
-    prb = np.clip(p['Z_PC_PC'] * np.exp(-d**2/(2*p['L_PC_PC']**2)), 0, 1)
+    :return: targ idxs, src idxs (sorted by targ, then src), distances
+    """
+    if r <= 0 or not len(xs_targ) or not len(xs_src):
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int), np.zeros(0)
+    
+    tree = cKDTree(np.array([xs_src, ys_src]).T)
+    nbrs = tree.query_ball_point(
+        np.array([xs_targ, ys_targ]).T, r, return_sorted=True)
     
-    ## set diagonals to zero
-    np.fill_diagonal(prb, False)
+    lens = [len(nbrs_) for nbrs_ in nbrs]
     
-    ## build cxn matrix from cxn prb
-    c = np.random.rand(n_pc, n_pc) < prb
+    targs = np.repeat(np.arange(len(xs_targ)), lens)
+    srcs = np.array(cc(nbrs) if sum(lens) else [], dtype=int)
     
-    # assign weights
-    w = np.zeros((n_pc, n_pc))
-    if p['W_E_PC_PC'] > 0:
-        w[c] = np.random.lognormal(
-            *lognormal_mu_sig(p['W_E_PC_PC'], p['S_E_PC_PC']), c.sum())
+    d = np.sqrt((xs_src[srcs] - xs_targ[targs])**2
+                + (ys_src[srcs] - ys_targ[targs])**2)
+    
+    return targs, srcs, d
+
+
+def draw_cxns(targs, srcs, prb, shape, w, s):
+    """
+    Draw cxns between candidate (targ, src) pairs with given prbs and
+    assign lognormal weights with mean w and std s.
+    
+    :return: sparse (csr) weight matrix
+    """
+    c = np.random.rand(len(prb)) < prb
+    
+    if w > 0:
+        ws = np.random.lognormal(*lognormal_mu_sig(w, s), c.sum())
     else:
-        w[c] = np.zeros(c.sum())
+        ws = np.zeros(c.sum())
+    
+    return csr_matrix((ws, (targs[c], srcs[c])), shape=shape)
+
+
+def make_w_e_pc_pc(pfxs, pfys, p, p_min=None):
+    """
+    Make proximally biased PC-PC weight matrix.
+    
+    Only pairs closer than the distance at which the cxn prb falls below
+    p_min (see P_MIN) are considered.
+    
+    :return: sparse (csr) weight matrix
+    """
+    # make cxns
+    n_pc = p['N_PC']
+    
+    ## get nearby pairs (excluding self-cxns)
+    r = cutoff(p['Z_PC_PC'], p['L_PC_PC'], p_min)
+    targs, srcs, d = local_pairs(pfxs, pfys, pfxs, pfys, r)
+    
+    mask = targs != srcs
+    targs, srcs, d = targs[mask], srcs[mask], d[mask]
+    
+    ## get cxn prbs
+    prb = np.clip(p['Z_PC_PC'] * np.exp(-d**2/(2*p['L_PC_PC']**2)), 0, 1)
     
-    return w
+    # draw cxns and assign weights
+    return draw_cxns(
+        targs, srcs, prb, (n_pc, n_pc), p['W_E_PC_PC'], p['S_E_PC_PC'])
 
 
-def make_w_e_inh_pc(pfxs_inh, pfys_inh, pfxs_pc, pfys_pc, p):
+def make_w_e_inh_pc(pfxs_inh, pfys_inh, pfxs_pc, pfys_pc, p, p_min=None):
     """
     Make proximally biased PC->INH weight matrix.
+    
+    Only pairs closer than the distance at which the cxn prb falls below
+    p_min (see P_MIN) are considered.
+    
+    :return: sparse (csr) weight matrix
     """
     # make cxns
     n_inh = p['N_INH']
     n_pc = p['N_PC']
     
-    ## build distance matrix
-    dx = np.tile(pfxs_pc[None, :], (n_inh, 1)) \
-        - np.tile(pfxs_inh[:, None], (1, n_pc))
-    dy = np.tile(pfys_pc[None, :], (n_inh, 1)) \
-        - np.tile(pfys_inh[:, None], (1, n_pc))
-    d = np.sqrt(dx**2 + dy**2)
+    ## get nearby pairs
+    r = cutoff(p['Z_INH_PC'], p['L_INH_PC'], p_min)
+    targs, srcs, d = local_pairs(pfxs_inh, pfys_inh, pfxs_pc, pfys_pc, r)
     
-    ## build cxn probability matrix
+    ## get cxn prbs
     prb = np.clip(p['Z_INH_PC'] * np.exp(-d**2/(2*p['L_INH_PC']**2)), 0, 1)
     
-    ## build cxn matrix
-    c = np.random.rand(n_inh, n_pc) < prb
-    
-    # assign weights
-    w = np.zeros(c.shape)
-    if p['W_E_INH_PC'] > 0:
-        w[c] = np.random.lognormal(
-            *lognormal_mu_sig(p['W_E_INH_PC'], p['S_E_INH_PC']), c.sum())
-    else:
-        w[c] = np.zeros(c.sum())
-    
-    return w
+    # draw cxns and assign weights
+    return draw_cxns(
+        targs, srcs, prb, (n_inh, n_pc), p['W_E_INH_PC'], p['S_E_INH_PC'])
     
     
-def make_w_i_pc_inh(pfxs_pc, pfys_pc, pfxs_inh, pfys_inh, p):
+def make_w_i_pc_inh(pfxs_pc, pfys_pc, pfxs_inh, pfys_inh, p, p_min=None):
     """
     Make center-surround structured INH->PC weight matrix.
+    
+    Only pairs closer than the distance at which the (surround) cxn prb
+    falls below p_min (see P_MIN) are considered.
+    
+    :return: sparse (csr) weight matrix
     """
     # make cxns
     n_pc = p['N_PC']
     n_inh = p['N_INH']
     
-    ## build distance matrix
-    dx = np.tile(pfxs_inh[None, :], (n_pc, 1)) \
-        - np.tile(pfxs_pc[:, None], (1, n_inh))
-    dy = np.tile(pfys_inh[None, :], (n_pc, 1)) \
-        - np.tile(pfys_pc[:, None], (1, n_inh))
-    d = np.sqrt(dx**2 + dy**2)
+    ## get nearby pairs (the center term only lowers cxn prbs)
+    r = cutoff(p['Z_S_PC_INH'], p['L_S_PC_INH'], p_min)
+    targs, srcs, d = local_pairs(pfxs_pc, pfys_pc, pfxs_inh, pfys_inh, r)
     
-    ## build cxn probability matrix
+    ## get cxn prbs
     prb_unclipped = p['Z_S_PC_INH'] * np.exp(-d**2/(2*p['L_S_PC_INH']**2)) \
         - p['Z_C_PC_INH'] * np.exp(-d**2/(2*p['Z_C_PC_INH']**2))
     prb = np.clip(prb_unclipped, 0, 1)
     
-    ## build cxn matrix
-    c = np.random.rand(n_pc, n_inh) < prb
-    
-    # assign weights
-    w = np.zeros(c.shape)
-    if p['W_I_PC_INH'] > 0:
-        w[c] = np.random.lognormal(
-            *lognormal_mu_sig(p['W_I_PC_INH'], p['S_I_PC_INH']), c.sum())
-    else:
-        w[c] = np.zeros(c.sum())
-    
-    return w
+    # draw cxns and assign weights
+    return draw_cxns(
+        targs, srcs, prb, (n_pc, n_inh), p['W_I_PC_INH'], p['S_I_PC_INH'])
@@ -24,10 +24,12 @@ def heat_maps(rslt, epoch=None):
     fig, axs = plt.subplots(1, 2, figsize=(12, 6), tight_layout=True)
 
     ## at start
-    w_e_pc_st_start = np.array(rslt.ws_plastic['E'][0, pcs]).flatten()
+    w_e_pc_st_start = np.array(
+        rslt.ws_plastic['E'][rslt.rec_idx('ws_plastic', 0), pcs]).flatten()
     ## at trigger
-    t_idx_trg = int(rslt.schedule['TRG_START_T'] / rslt.s_params['DT'])
-    w_e_pc_st_trg = np.array(rslt.ws_plastic['E'][t_idx_trg, pcs]).flatten()
+    t_idx_trg = int(round(rslt.schedule['TRG_START_T'] / rslt.s_params['DT']))
+    w_e_pc_st_trg = np.array(
+        rslt.ws_plastic['E'][rslt.rec_idx('ws_plastic', t_idx_trg), pcs]).flatten()
 
     ## get corresponding place fields
     pfxs_plastic = rslt.ntwk.pfxs[pcs]
@@ -89,8 +91,6 @@ def heat_maps(rslt, epoch=None):
         start = epoch[0]
         end = epoch[1]
 
-    t_mask = (start <= rslt.ts) & (rslt.ts < end)
-
     ## PC mask and PFs
     pc_mask = rslt.ntwk.types_rcr == 'PC'
 
@@ -98,8 +98,7 @@ def heat_maps(rslt, epoch=None):
     pfys_pc = rslt.ntwk.pfys[pc_mask]
 
     ## PC spk cts within detection window
-    spks_wdw_pc = rslt.spks[t_mask][:, pc_mask]
-    spk_ct_wdw_pc = spks_wdw_pc.sum(0)
+    spk_ct_wdw_pc = rslt.spk_cts(start, end)[pc_mask]
 
     ## discrete colormap for showing spk cts
     c_map_tmp = plt.cm.jet
@@ -136,7 +135,7 @@ def heat_maps(rslt, epoch=None):
 
         ## color PCs according to timing of first spike
         spk_mask = spk_ct_wdw_pc > 0
-        spk_order = np.argmax(spks_wdw_pc[:, spk_mask], 0)
+        spk_order = rslt.first_spk_ts(start, end)[pc_mask][spk_mask]
         spk_order = np.argsort(spk_order).argsort()
         
         v_min = spk_order.min()
@@ -187,7 +186,7 @@ def raster(rslt, xys, nearest, epoch):
     pc_idxs = get_idxs_nearest(xys, pfxs, pfys, nearest) 
     
     # get all spks for selected PCs
-    spks_pc_chosen = rslt.spks[:, pc_idxs]
+    spks_pc_chosen = rslt.spk_events.select(pc_idxs)
     
     # get desired time window
     if epoch == 'replay':
@@ -206,10 +205,10 @@ def raster(rslt, xys, nearest, epoch):
         start = epoch[0]
         end = epoch[1]
     
-    t_mask = (start <= rslt.ts) & (rslt.ts < end)
-    t_start = rslt.ts[t_mask][0]
+    t_start_idx, t_end_idx = np.searchsorted(rslt.ts, [start, end])
+    t_start = rslt.ts[t_start_idx]
     
-    spk_t_idxs, pcs = spks_pc_chosen[t_mask].nonzero()
+    spk_t_idxs, pcs = spks_pc_chosen.window(t_start_idx, t_end_idx).nonzero()
     spk_ts = spk_t_idxs * rslt.s_params['DT'] + t_start
     
     # make plots
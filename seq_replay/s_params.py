@@ -4,8 +4,32 @@ smln params
 
 s_params = {
     'RNG_SEED': 0,
+    # seed for replay-epoch inputs (None to continue stream of RNG_SEED)
+    'RPL_SEED': None,
     'DT': 0.0005,
     
+    # integrator ('euler' or 'exp'); conductance and current magnitudes
+    # are defined relative to DT_REF, so DT can be raised with 'exp'
+    'INTEGRATOR': 'euler',
+    'DT_REF': 0.0005,
+    
+    # float dtype of ntwk state, weights, and inputs ('float64' or
+    # 'float32', see smln.check_dtype for the accuracy of 'float32')
+    'DTYPE': 'float64',
+    
+    # draw upstream spks block by block during the smln instead of building
+    # them up front (see smln.stim_source; a different random stream)
+    'LAZY_STIM': False,
+    
+    # time phases of LIFNtwk.run and count spks and synaptic events per
+    # time step (see ntwk.NtwkProfile; summary is saved with rslt)
+    'PROFILE': False,
+    
+    # recording overrides (see smln.get_store and LIFNtwk.run; dtypes as
+    # strings so that s_params can be saved as JSON), e.g.
+    # {'vs': {'dtype': 'float32', 'nrns': 'PC', 'every': 10}}
+    'STORE': {},
+    
     # trajectory
     'BOX_W': 2,
     'BOX_H': 2,
@@ -28,6 +52,11 @@ s_params = {
         'TRG_START_T': 21,
     },
     
+    # early termination of smlns every EVERY steps (see smln.get_stop; off
+    # if None, so that rslts cover the full SMLN_DUR), e.g.
+    # {'EVERY': 100, 'AFTER_WDW': True, 'MAX_FR_PC': None, 'SILENT_T': None}
+    'stop': None,
+    
     'metrics': {
         'RADIUS': 0.2,
         'PITCH': 10,
@@ -1,15 +1,21 @@
 from copy import deepcopy
 import numpy as np
-from scipy.sparse import csc_matrix
+from scipy.sparse import diags, identity
+from scipy.spatial import cKDTree
 import time
 
 from aux import lognormal_mu_sig, sgmd
 from seq_replay import cxn
 from db import make_session, d_models
-from ntwk import LIFNtwk, join_w
+from ntwk import (
+    LIFNtwk, LIFNtwkEnsemble, get_masked, join_rsps, join_w, set_masked)
+from ntwk_inp import DriveSchedule, PoissonInps
 
 cc = np.concatenate
 
+# model params that only affect the replay epoch
+RPL_PARAMS = ('FR_RPL_PC_ST', 'A_TR', 'D_T_TR', 'R_TR')
+
 
 def run(p, s_params, apxn):
     """
@@ -21,6 +27,429 @@ def run(p, s_params, apxn):
     """
     # prepare smln
     prep_start = time.time()
+    
+    ntwk, schedule, trj, trj_veil, spks_up, i_ext = prep(p, s_params, apxn)
+    
+    prep_end = time.time()
+    prep_time = prep_end - prep_start
+    
+    # run smln
+    run_start = time.time()
+    
+    stop, stop_every, aborted = get_stop(
+        schedule, s_params, ntwk.types_rcr == 'PC')
+    
+    rslt = ntwk.run(
+        spks_up=spks_up, dt=s_params['DT'], i_ext=i_ext,
+        store=get_store(schedule, s_params),
+        integrator=s_params.get('INTEGRATOR', 'euler'),
+        dt_ref=s_params.get('DT_REF'), callback=stop,
+        callback_every=stop_every, profile=s_params.get('PROFILE', False))
+    run_end = time.time()
+    
+    rslt.aborted = aborted['reason']
+    
+    run_time = run_end - run_start
+    
+    return consolidate(
+        rslt, ntwk, schedule, p, s_params, apxn, trj, trj_veil,
+        prep_time, run_time)
+
+
+def run_batch(ps, s_params, apxn, engine='numpy', threads=None):
+    """
+    Run smlns for a batch of model params in a single shared time loop
+    (see ntwk.LIFNtwkEnsemble) and return list of rslts.
+    
+    The "run_time" of each rslt is the batch run time divided by the
+    number of smlns in the batch.
+    
+    :param ps: list of dicts of model params (with same N_PC and N_INH)
+    :param s_params: dict of smln params
+    :param apxn: dict of apxn params (or None if no apxn)
+    :param engine: engine to run ensemble with (see LIFNtwk.run)
+    :param threads: threads to run 'compiled' engine with (see LIFNtwk.run)
+    """
+    preps = []
+    prep_times = []
+    
+    for p in ps:
+        prep_start = time.time()
+        preps.append(prep(p, s_params, apxn))
+        prep_times.append(time.time() - prep_start)
+        
+    ntwks, schedules, trjs, trj_veils, spks_ups, i_exts = zip(*preps)
+    
+    # run smlns
+    run_start = time.time()
+    
+    ensemble = LIFNtwkEnsemble(ntwks)
+    
+    # members cannot be aborted individually
+    stop, stop_every, _ = get_stop(schedules[0], s_params)
+    
+    rsps = ensemble.run(
+        spks_ups=spks_ups, dt=s_params['DT'], i_exts=i_exts, engine=engine,
+        store=get_store(schedules[0], s_params),
+        integrator=s_params.get('INTEGRATOR', 'euler'),
+        dt_ref=s_params.get('DT_REF'), callback=stop,
+        callback_every=stop_every, threads=threads,
+        profile=s_params.get('PROFILE', False))
+    
+    run_time = (time.time() - run_start) / len(ps)
+    
+    return [
+        consolidate(
+            rsp, ntwk, schedule, p, s_params, apxn, trj, trj_veil,
+            prep_time, run_time)
+        for rsp, ntwk, schedule, p, trj, trj_veil, prep_time in zip(
+            rsps, ntwks, schedules, ps, trjs, trj_veils, prep_times)
+    ]
+
+
+def run_trj(p, s_params):
+    """
+    Simulate the trajectory epoch of a smln (up to the replay epoch or the
+    replay trigger, whichever comes first) and return a snapshot from which
+    replay epochs can be forked with different replay params (see fork).
+    
+    A dense stimulus (s_params['LAZY_STIM'] not set) is built only without
+    its replay-epoch ST inputs. The snapshot keeps it from the snapshot on,
+    along with the random state its replay-epoch ST inputs are drawn from,
+    so that forks only draw these.
+    
+    :param p: dict of model params
+    :param s_params: dict of smln params
+    
+    :return: snapshot dict
+    """
+    prep_start = time.time()
+    
+    t, ntwk, schedule, trj, trj_veil = prep_ntwk(p, s_params, None)
+    
+    # get last time step before any replay epoch inputs
+    step = min(
+        np.searchsorted(t, schedule['REPLAY_EPOCH_START_T'], 'right'),
+        np.searchsorted(t, schedule['TRG_START_T'], 'left')) - 1
+    
+    if s_params.get('LAZY_STIM'):
+        spks_up = stim_source(t, trj, ntwk, p, s_params, schedule)
+        spks_up_trj, rng_rpl = None, None
+    else:
+        spks_up, rng_rpl = spks_up_trj_epoch(
+            t, trj, ntwk, p, s_params, schedule)
+        spks_up_trj = spks_up[step+1:]
+    
+    prep_time = time.time() - prep_start
+    
+    # run smln up to snapshot
+    run_start = time.time()
+    
+    if isinstance(spks_up, PoissonInps):
+        spks_up = spks_up.head(step+1)
+    else:
+        spks_up = spks_up[:step+1]
+        
+    rslt = ntwk.run(
+        spks_up=spks_up, dt=s_params['DT'],
+        i_ext=i_ext_trg(t, ntwk, p, s_params, schedule),
+        store=get_store(schedule, s_params),
+        integrator=s_params.get('INTEGRATOR', 'euler'),
+        dt_ref=s_params.get('DT_REF'), profile=s_params.get('PROFILE', False))
+    
+    run_time = time.time() - run_start
+    
+    return {
+        'p': p,
+        's_params': s_params,
+        'ntwk': ntwk,
+        'schedule': schedule,
+        'trj': trj,
+        'trj_veil': trj_veil,
+        'rslt': rslt,
+        'state': rslt.state,
+        'spks_up_trj': spks_up_trj,
+        'rng_rpl': rng_rpl,
+        'prep_time': prep_time,
+        'run_time': run_time,
+    }
+
+
+def fork(snapshot, p, rpl_seed=None):
+    """
+    Run the replay epoch of a smln from a trajectory-epoch snapshot (see
+    run_trj) and return rslt.
+    
+    The rslt is identical to that of run(p, s_params, apxn=None) (with
+    s_params['RPL_SEED'] set to rpl_seed if given), but only the replay
+    epoch is simulated. Its "prep_time" and "run_time" do not include
+    building the snapshot.
+    
+    :param snapshot: snapshot dict returned by run_trj
+    :param p: dict of model params (may only differ from those of the
+        snapshot in RPL_PARAMS)
+    :param rpl_seed: seed for random replay-epoch inputs (if None, inputs
+        continue the random stream of the trajectory epoch)
+    """
+    p_snap = snapshot['p']
+    
+    for key in set(p) | set(p_snap):
+        if key not in RPL_PARAMS and (p.get(key) != p_snap.get(key)):
+            raise ValueError(
+                'Param "{}" differs from that of snapshot but does not only '
+                'affect the replay epoch.'.format(key))
+    
+    s_params = deepcopy(snapshot['s_params'])
+    
+    if rpl_seed is not None:
+        s_params['RPL_SEED'] = rpl_seed
+        
+    ntwk = snapshot['ntwk']
+    schedule = snapshot['schedule']
+    trj = snapshot['trj']
+    
+    # build stimulus (identical to snapshot's up to snapshot)
+    prep_start = time.time()
+    
+    t = np.arange(0, schedule['SMLN_DUR'], s_params['DT'])
+    
+    if snapshot['spks_up_trj'] is not None:
+        # only draw replay-epoch ST inputs on top of snapshot's stimulus
+        step = snapshot['state'].step
+        
+        spks_up = np.zeros((len(t), 2*p['N_PC']), int)
+        spks_up[step+1:] = snapshot['spks_up_trj']
+        
+        spks_up_from_st_rpl(
+            t, p, s_params, schedule, spks_up, snapshot['rng_rpl'])
+        
+        i_ext = i_ext_trg(t, ntwk, p, s_params, schedule)
+    else:
+        spks_up, i_ext = build_stim(t, trj, ntwk, p, s_params, schedule)
+    
+    prep_time = time.time() - prep_start
+    
+    # resume smln from snapshot
+    run_start = time.time()
+    
+    stop, stop_every, aborted = get_stop(
+        schedule, s_params, ntwk.types_rcr == 'PC')
+    
+    rslt = ntwk.run(
+        spks_up=spks_up, dt=s_params['DT'], i_ext=i_ext,
+        store=get_store(schedule, s_params),
+        integrator=s_params.get('INTEGRATOR', 'euler'),
+        dt_ref=s_params.get('DT_REF'), state_0=snapshot['state'],
+        callback=stop, callback_every=stop_every,
+        profile=s_params.get('PROFILE', False))
+    
+    run_time = time.time() - run_start
+    
+    rslt = join_rsps(snapshot['rslt'], rslt)
+    rslt.aborted = aborted['reason']
+    
+    return consolidate(
+        rslt, ntwk, schedule, p, s_params, None, trj, snapshot['trj_veil'],
+        prep_time, run_time)
+
+
+def run_forks(p, p_rpls, s_params, rpl_seeds=None):
+    """
+    Simulate the trajectory epoch once and fork one replay epoch per set of
+    replay params.
+    
+    :param p: dict of model params
+    :param p_rpls: list of dicts of replay param values (keys in RPL_PARAMS)
+        to update p with for each fork
+    :param s_params: dict of smln params
+    :param rpl_seeds: list of replay-epoch seeds (one per fork, see fork)
+    
+    :return: list of rslts
+    """
+    if rpl_seeds is None:
+        rpl_seeds = [None] * len(p_rpls)
+        
+    if len(rpl_seeds) != len(p_rpls):
+        raise ValueError('Args "p_rpls" and "rpl_seeds" must have same length.')
+        
+    snapshot = run_trj(p, s_params)
+    
+    rslts = []
+    
+    for p_rpl, rpl_seed in zip(p_rpls, rpl_seeds):
+        p_ = deepcopy(p)
+        p_.update(p_rpl)
+        
+        rslts.append(fork(snapshot, p_, rpl_seed))
+        
+    return rslts
+
+
+def check_dt(p, s_params, dts, tol, apxn=True):
+    """
+    Find the largest time step at which exponential-Euler smlns reproduce
+    the metrics of the reference (forward Euler at s_params['DT']) smln.
+    
+    :param p: dict of model params
+    :param s_params: dict of smln params
+    :param dts: candidate time steps
+    :param tol: max abs. difference allowed in each numeric metric
+    :param apxn: dict of apxn params (or None if no apxn)
+    
+    :return: largest dt for which it and all smaller candidate dts are within
+        tol (None if no dt is), dict of max abs. metric error for each dt
+    """
+    dt_ref = s_params.get('DT_REF', s_params['DT'])
+    
+    s_params_ref = deepcopy(s_params)
+    s_params_ref['INTEGRATOR'] = 'euler'
+    
+    metrics_ref = run(p, s_params_ref, apxn).metrics
+    
+    dt_max = None
+    errs = {}
+    stable = True
+    
+    for dt in sorted(dts):
+        s_params_ = deepcopy(s_params)
+        s_params_['DT'] = dt
+        s_params_['INTEGRATOR'] = 'exp'
+        s_params_['DT_REF'] = dt_ref
+        
+        metrics = run(p, s_params_, apxn).metrics
+        
+        # get max abs. error over numeric metrics
+        errs_ = []
+        for key in ['frac_spk_trj', 'frac_spk_non_trj', 'avg_spk_ct_trj']:
+            if np.isnan(metrics[key]) and np.isnan(metrics_ref[key]):
+                errs_.append(0)
+            elif np.isnan(metrics[key]) or np.isnan(metrics_ref[key]):
+                errs_.append(np.inf)
+            else:
+                errs_.append(np.abs(metrics[key] - metrics_ref[key]))
+                
+        errs[dt] = np.max(errs_)
+        
+        stable = stable and (errs[dt] <= tol)
+        
+        if stable:
+            dt_max = dt
+            
+    return dt_max, errs
+
+
+def check_dtype(p, s_params, dtype='float32', apxn=None, tol_steps=1):
+    """
+    Validate smlns at a lower-precision float dtype (see LIFNtwk) against
+    float64 smlns by comparing their spk times and metrics.
+    
+    Rounding errors first shift individual spks by a time step, after which
+    the trajectories of the two smlns diverge, so spk times are only
+    expected to match up to some divergence time, beyond which only
+    metrics (which summarize replay statistics) should agree.
+    
+    :param p: dict of model params
+    :param s_params: dict of smln params
+    :param dtype: float dtype to validate
+    :param apxn: dict of apxn params (or None if no apxn)
+    :param tol_steps: max number of time steps by which a spk may be
+        shifted and still count as matched
+    
+    :return: report dict with the metrics at float64 ("metrics") and at
+        dtype ("metrics_dtype"), the max abs. error over numeric metrics
+        ("err"), the number of spks at float64 and at dtype ("n_spks",
+        "n_spks_dtype"), the fraction of spks with a matching spk of the
+        same neuron in the other smln ("frac_matched"), and the time of the
+        first spk that does not occur at exactly the same time step in both
+        smlns ("t_diverge", None if all spks are identical)
+    """
+    rslts = []
+    
+    for dtype_ in ['float64', dtype]:
+        s_params_ = deepcopy(s_params)
+        s_params_['DTYPE'] = dtype_
+        
+        rslts.append(run(p, s_params_, apxn))
+        
+    metrics, metrics_dtype = [rslt.metrics for rslt in rslts]
+    
+    # get max abs. error over numeric metrics
+    errs = []
+    for key in ['frac_spk_trj', 'frac_spk_non_trj', 'avg_spk_ct_trj']:
+        if np.isnan(metrics[key]) and np.isnan(metrics_dtype[key]):
+            errs.append(0)
+        elif np.isnan(metrics[key]) or np.isnan(metrics_dtype[key]):
+            errs.append(np.inf)
+        else:
+            errs.append(np.abs(metrics[key] - metrics_dtype[key]))
+    
+    # match spks of each neuron across smlns
+    spks = [rslt.spk_events for rslt in rslts]
+    n_t = max([len(spks_) for spks_ in spks])
+    
+    def unmatched(spks_0, spks_1, tol):
+        # encode spks as (neuron, time step) keys spaced so that keys of
+        # different neurons are never within tol of one another
+        stride = n_t + tol + 1
+        
+        keys_0 = spks_0.nrns * stride + spks_0.t_idxs
+        keys_1 = np.sort(spks_1.nrns * stride + spks_1.t_idxs)
+        
+        if not len(keys_1):
+            return np.ones(len(keys_0), dtype=bool)
+        
+        idxs = np.searchsorted(keys_1, keys_0)
+        
+        d_next = np.abs(keys_1[np.minimum(idxs, len(keys_1) - 1)] - keys_0)
+        d_prev = np.abs(keys_1[np.maximum(idxs - 1, 0)] - keys_0)
+        
+        return np.minimum(d_next, d_prev) > tol
+    
+    n_unmatched = unmatched(spks[0], spks[1], tol_steps).sum() \
+        + unmatched(spks[1], spks[0], tol_steps).sum()
+    n_spks = len(spks[0].t_idxs) + len(spks[1].t_idxs)
+    
+    # get first spk that differs
+    t_idxs_diff = np.concatenate([
+        spks[0].t_idxs[unmatched(spks[0], spks[1], 0)],
+        spks[1].t_idxs[unmatched(spks[1], spks[0], 0)],
+    ])
+    
+    if len(t_idxs_diff):
+        t_diverge = t_idxs_diff.min() * s_params['DT']
+    else:
+        t_diverge = None
+    
+    return {
+        'metrics': metrics,
+        'metrics_dtype': metrics_dtype,
+        'err': np.max(errs),
+        'n_spks': len(spks[0].t_idxs),
+        'n_spks_dtype': len(spks[1].t_idxs),
+        'frac_matched': 1 - n_unmatched/n_spks if n_spks else 1.,
+        't_diverge': t_diverge,
+    }
+
+
+def prep(p, s_params, apxn):
+    """
+    Build ntwk, trajectory, and stimulus for a smln.
+    
+    :return: ntwk, schedule, trj, trj_veil, spks_up, i_ext
+    """
+    t, ntwk, schedule, trj, trj_veil = prep_ntwk(p, s_params, apxn)
+    
+    spks_up, i_ext = build_stim(t, trj, ntwk, p, s_params, schedule)
+    
+    return ntwk, schedule, trj, trj_veil, spks_up, i_ext
+
+
+def prep_ntwk(p, s_params, apxn):
+    """
+    Build ntwk and trajectory for a smln.
+    
+    :return: time points, ntwk, schedule, trj, trj_veil
+    """
     schedule = deepcopy(s_params['schedule'])
     
     ## build trajectory
@@ -44,20 +473,105 @@ def run(p, s_params, apxn):
     if apxn:
         ntwk = apx_ws_up(ntwk, trj_veil)
         
-    spks_up, i_ext = build_stim(t, trj, ntwk, p, s_params, schedule)
+    return t, ntwk, schedule, trj, trj_veil
+
+
+def get_store(schedule, s_params):
+    """
+    Get recording spec for LIFNtwk.run: spks as events and plastic weights
+    and spk ctrs only at smln start and replay trigger, updated with any
+    entries in s_params['STORE'].
     
-    prep_end = time.time()
-    prep_time = prep_end - prep_start
+    Since s_params are saved as JSON, dtypes in s_params['STORE'] must be
+    given as strings (e.g., 'float32').
+    """
+    t_trg = schedule['TRG_START_T']
     
-    # run smln
-    run_start = time.time()
+    store = {
+        'spks': 'events',
+        'ws_plastic': {'dtype': 'float64', 'ts': [0, t_trg]},
+        'cs': {'dtype': 'float64', 'ts': [0, t_trg]},
+    }
     
-    rslt = ntwk.run(spks_up=spks_up, dt=s_params['DT'], i_ext=i_ext)
-    run_end = time.time()
+    for key, val in s_params.get('STORE', {}).items():
+        dtype = val.get('dtype') if isinstance(val, dict) else val
+        
+        if dtype is not None and not isinstance(dtype, str):
+            raise TypeError(
+                'Dtype of "{}" in s_params[\'STORE\'] must be a string '
+                '(e.g., \'float32\'), so that s_params can be saved as '
+                'JSON.'.format(key))
+            
+    store.update(s_params.get('STORE', {}))
+    
+    return store
+
+
+def get_stop(schedule, s_params, pc_mask=None):
+    """
+    Make callback for LIFNtwk.run that ends a smln as specified in
+    s_params['stop']: once the detection window has passed (AFTER_WDW),
+    which leaves the metrics unchanged, or, if pc_mask is given, by
+    aborting it when the mean PC firing rate over a check interval exceeds
+    MAX_FR_PC (runaway bursting) or when PCs stay silent for SILENT_T after
+    the replay trigger (either check is skipped if its param is None).
+    
+    :return: callback (None if smlns are never ended early), number of time
+        steps between calls, dict whose "reason" item is set to the reason
+        for aborting a smln (None if it was not aborted)
+    """
+    aborted = {'reason': None}
     
-    run_time = run_end - run_start
+    stop = s_params.get('stop')
+    
+    if not stop:
+        return None, None, aborted
+    
+    dt = s_params['DT']
+    every = stop['EVERY']
+    
+    t = np.arange(0, schedule['SMLN_DUR'], dt)
+    
+    # last time step in detection window and first after trigger
+    t_end = schedule['TRG_START_T'] + s_params['metrics']['WDW']
+    step_end = np.searchsorted(t, t_end) - 1
+    step_trg = np.searchsorted(t, schedule['TRG_START_T'])
     
-    # consolidate smln rslt
+    if stop.get('SILENT_T') is not None:
+        step_silent = np.searchsorted(t, schedule['TRG_START_T'] + stop['SILENT_T'])
+    
+    spk_ct_trg = 0
+    
+    def callback(state):
+        nonlocal spk_ct_trg
+        
+        if pc_mask is not None:
+            spk_ct_pc = state.spk_cts[pc_mask].sum()
+            
+            if stop.get('MAX_FR_PC') is not None:
+                if spk_ct_pc / pc_mask.sum() / (every*dt) > stop['MAX_FR_PC']:
+                    aborted['reason'] = 'bursting'
+                    return True
+                
+            if state.step >= step_trg:
+                spk_ct_trg += spk_ct_pc
+                
+            if stop.get('SILENT_T') is not None:
+                if state.step >= step_silent and not spk_ct_trg:
+                    aborted['reason'] = 'silent'
+                    return True
+        
+        return stop.get('AFTER_WDW', False) and state.step >= step_end
+    
+    return callback, every, aborted
+
+
+def consolidate(
+        rslt, ntwk, schedule, p, s_params, apxn, trj, trj_veil,
+        prep_time, run_time):
+    """
+    Attach smln info and metrics to ntwk response.
+    """
     rslt.ntwk = ntwk
     rslt.schedule = schedule
     
@@ -70,6 +584,12 @@ def run(p, s_params, apxn):
     
     metrics, success = get_metrics(rslt, s_params)
     
+    # aborted smlns are failures
+    if getattr(rslt, 'aborted', None) is not None:
+        metrics['aborted'] = rslt.aborted
+        metrics['success'] = False
+        success = False
+    
     rslt.metrics = metrics
     rslt.success = success
     
@@ -95,11 +615,17 @@ def fix_schedule(schedule):
     return schedule_fixed
 
  
-def build_ntwk(p, s_params):
+def build_ntwk(p, s_params, dtype=None):
     """
     Construct a network object from the model and
     simulation params.
+    
+    :param dtype: float dtype of ntwk (see LIFNtwk; defaults to
+        s_params['DTYPE'], or np.float64 if not given)
     """
+    if dtype is None:
+        dtype = s_params.get('DTYPE', np.float64)
+        
     np.random.seed(s_params['RNG_SEED'])
     
     # set membrane properties
@@ -145,8 +671,8 @@ def build_ntwk(p, s_params):
     
     ws_up_temp = {
         'E': {
-            ('PC', 'PL'): np.diag(w_e_pc_pl_flat),
-            ('PC', 'ST'): np.diag(w_e_init_pc_st_flat),
+            ('PC', 'PL'): diags(w_e_pc_pl_flat, format='csr'),
+            ('PC', 'ST'): diags(w_e_init_pc_st_flat, format='csr'),
         },
     }
     
@@ -188,7 +714,7 @@ def build_ntwk(p, s_params):
     # set plasticity params
     masks_plastic_temp = {
         'E': {
-            ('PC', 'ST'): np.eye(p['N_PC'], dtype=bool),
+            ('PC', 'ST'): identity(p['N_PC'], dtype=bool, format='csr'),
         },
     }
     
@@ -215,7 +741,8 @@ def build_ntwk(p, s_params):
         ts_syn={'E': p['T_E'], 'I': p['T_I']},
         ws_up=ws_up,
         ws_rcr=ws_rcr,
-        plasticity=plasticity)
+        plasticity=plasticity,
+        dtype=dtype)
     
     ntwk.pfxs = pfxs
     ntwk.pfys = pfys
@@ -274,7 +801,26 @@ def build_trj(t, s_params, schedule):
     if np.any(np.isnan(x)) or np.any(np.isnan(y)) or np.any(np.isnan(sp)):
         raise ValueError('NaNs detected in trj.')
     
-    return {'x': x, 'y': y, 'sp': sp}
+    # segments (x_0, y_0, x_1, y_1) covered by the trj samples, so that
+    # distances to the path can be computed in closed form (see dist_to_segs);
+    # resting before/after the legs and legs with one sample are points
+    start = (s_params['START_X'], s_params['START_Y'])
+    turn_0 = (s_params['TURN_X'], s_params['START_Y'])
+    turn_1 = (s_params['TURN_X'], s_params['TURN_Y'])
+    end = (s_params['END_X'], s_params['TURN_Y'])
+    
+    segs = []
+    
+    for mask, (pt_0, pt_1) in zip(
+            [t < t_0, mask_0, mask_1, mask_2, t_3 <= t],
+            [(start, start), (start, turn_0), (turn_0, turn_1),
+             (turn_1, end), (end, end)]):
+        if mask.sum() == 1:
+            segs.append(pt_0 + pt_0)
+        elif mask.sum() > 1:
+            segs.append(pt_0 + pt_1)
+    
+    return {'x': x, 'y': y, 'sp': sp, 'segs': np.array(segs, dtype=float)}
  
     
 def get_trj_veil(trj, ntwk, p, s_params):
@@ -283,8 +829,11 @@ def get_trj_veil(trj, ntwk, p, s_params):
     with place fields along the trajectory path.
     """
     # compute scale factor for all PCs
-    ## get distance to trj
-    d = dist_to_trj(ntwk.pfxs, ntwk.pfys, trj['x'], trj['y'])[0]
+    ## get distance to trj (from its segments if known)
+    if trj.get('segs') is not None:
+        d = dist_to_segs(ntwk.pfxs, ntwk.pfys, trj['segs'])[0]
+    else:
+        d = dist_to_trj(ntwk.pfxs, ntwk.pfys, trj['x'], trj['y'])[0]
     
     ## compute scale factor
     radius = s_params['metrics']['RADIUS']
@@ -297,17 +846,41 @@ def get_trj_veil(trj, ntwk, p, s_params):
     
 def dist_to_trj(pfxs, pfys, x, y):
     """
-    Compute distance of static points (pfxs, pfys) to trajectory (x(t), y(t)).
+    Compute distance of static points (pfxs, pfys) to trajectory (x(t), y(t)),
+    i.e., to its nearest sample, via a k-d tree over the trj samples.
     
     :return: dists to nearest pts, idxs of nearest pts
     """
-    # get dists to all pts along trj
-    dx = np.tile(pfxs[None, :], (len(x), 1)) - np.tile(x[:, None], (1, len(pfxs)))
-    dy = np.tile(pfys[None, :], (len(y), 1)) - np.tile(y[:, None], (1, len(pfys)))
+    tree = cKDTree(np.array([x, y]).T)
     
-    d = np.sqrt(dx**2 + dy**2)
+    return tree.query(np.array([pfxs, pfys]).T)
+
+
+def dist_to_segs(pfxs, pfys, segs):
+    """
+    Compute distance of static points (pfxs, pfys) to a piecewise-linear path
+    given as segments (rows x_0, y_0, x_1, y_1; see build_trj), projecting
+    each point onto each segment in closed form.
+    
+    :return: dists to path, idxs of nearest segments
+    """
+    d = np.full((len(segs), len(pfxs)), np.inf)
     
-    # return dists of cells to nearest pts on trj
+    for ctr, (x_0, y_0, x_1, y_1) in enumerate(segs):
+        dx_seg = x_1 - x_0
+        dy_seg = y_1 - y_0
+        l_sq = dx_seg**2 + dy_seg**2
+        
+        # position of nearest pt along segment (0 = start, 1 = end)
+        if l_sq > 0:
+            u = ((pfxs - x_0)*dx_seg + (pfys - y_0)*dy_seg) / l_sq
+            u = np.clip(u, 0, 1)
+        else:
+            u = 0
+            
+        d[ctr] = np.sqrt(
+            (pfxs - x_0 - u*dx_seg)**2 + (pfys - y_0 - u*dy_seg)**2)
+        
     return np.min(d, 0), np.argmin(d, 0)
 
    
@@ -318,10 +891,10 @@ def apx_ws_up(ntwk, trj_veil):
     """
     scale = trj_veil[ntwk.types_rcr == 'PC'] + 1
     
-    ws_up_init_e_dense = np.array(ntwk.ws_up_init['E'].todense())
-    ws_up_init_e_dense[ntwk.plasticity['masks']['E']] *= scale
+    mask = ntwk.plasticity['masks']['E']
+    ws_plastic = get_masked(ntwk.ws_up_init['E'], mask) * scale
     
-    ntwk.ws_up_init['E'] = csc_matrix(ws_up_init_e_dense)
+    ntwk.ws_up_init['E'] = set_masked(ntwk.ws_up_init['E'], mask, ws_plastic)
     
     return ntwk
 
@@ -330,75 +903,177 @@ def build_stim(t, trj, ntwk, p, s_params, schedule):
     """
     Put together upstream spk and external current inputs
     according to stimulation params and schedule.
+    
+    If s_params['LAZY_STIM'] is set, upstream spks are returned as an
+    input source that draws them during the smln (see stim_source).
     """
-    np.random.seed(s_params['RNG_SEED'])
+    if s_params.get('LAZY_STIM'):
+        spks_up = stim_source(t, trj, ntwk, p, s_params, schedule)
+    else:
+        spks_up, rng_rpl = spks_up_trj_epoch(t, trj, ntwk, p, s_params, schedule)
+        
+        # fill in replay epoch STATE inputs
+        spks_up_from_st_rpl(t, p, s_params, schedule, spks_up, rng_rpl)
     
-    # initialize upstream spks array
-    spks_up = np.zeros((len(t), 2*p['N_PC']), int)
+    # external currents (only the replay trigger)
+    i_ext = i_ext_trg(t, ntwk, p, s_params, schedule)
     
-    # fill in trajectory spks if required
-    if schedule['REPLAY_EPOCH_START_T'] > 0:
-        spks_up += spks_up_from_trj(trj, ntwk, p, s_params)
+    return spks_up, i_ext
+
+
+def stim_source(t, trj, ntwk, p, s_params, schedule):
+    """
+    Return upstream spk inputs (as in build_stim) as an input source that
+    draws them block by block from trajectory-driven and ST rates (see
+    ntwk_inp.PoissonInps), so that neither spks nor rates are ever held in
+    memory for the whole smln.
+    
+    Spks are reproducible given s_params['RNG_SEED'], but are not those of
+    the dense stimulus. Replay-epoch ST spks are drawn from a separate
+    stream (seeded by s_params['RPL_SEED'] if given), so that changing
+    replay params leaves the trajectory epoch unchanged (see fork).
+    """
+    n_pc = p['N_PC']
+    t_rpl = schedule['REPLAY_EPOCH_START_T']
     
-    # fill in replay epoch STATE inputs
-    spks_up += spks_up_from_st(t, ntwk, p, s_params, schedule)
+    def rates_trj(steps):
+        if t_rpl > 0:
+            return trj_rates(trj, steps, ntwk, p)
     
-    # initialize external current array
-    i_ext = np.zeros((len(t), p['N_PC'] + p['N_INH']))
+    def rates_st_trj(steps):
+        mask = t[steps] <= t_rpl
+        if t_rpl > 0 and mask.any():
+            return p['FR_TRJ_PC_ST'] * mask[:, None]
+        
+    def rates_st_rpl(steps):
+        mask = t_rpl < t[steps]
+        if mask.any():
+            return p['FR_RPL_PC_ST'] * mask[:, None]
+        
+    rates = [
+        (slice(0, n_pc), rates_trj),
+        (slice(n_pc, 2*n_pc), rates_st_trj),
+        (slice(n_pc, 2*n_pc), rates_st_rpl),
+    ]
     
-    # add replay trigger
-    i_ext += i_ext_trg(t, ntwk, p, s_params, schedule)
+    if s_params.get('RPL_SEED') is not None:
+        rates[-1] += (s_params['RPL_SEED'],)
     
-    return spks_up, i_ext
+    return PoissonInps(
+        len(t), 2*n_pc, s_params['DT'], rates, seed=s_params['RNG_SEED'])
 
 
-def spks_up_from_trj(trj, ntwk, p, s_params):
+def trj_rates(trj, steps, ntwk, p, cols=None):
     """
-    Generate trajectory-driven upstream spk rates.
+    Get trajectory-driven upstream spk rates onto PCs (or onto PCs cols) at
+    given time steps.
     """
-    n_t = len(trj['x'])
+    if cols is None:
+        cols = slice(0, p['N_PC'])
+        
+    ## dists from x, y to place fields
+    dx = trj['x'][steps, None] - ntwk.pfxs[None, cols]
+    dy = trj['y'][steps, None] - ntwk.pfys[None, cols]
     
-    # get spk rates
+    d = np.sqrt(dx**2 + dy**2)
     
-    ## dists from x, y to place fields
-    x_ = np.tile(trj['x'][:, None], (1, p['N_PC']))
-    y_ = np.tile(trj['y'][:, None], (1, p['N_PC']))
+    ## dist-dependent rates and speed-modulation
+    rs_d = p['R_MAX'] * np.exp(-np.abs(d**2)/(2*p['L_PL']**2))
+    fs = sgmd((trj['sp'][steps, None] - p['S_TH'])/p['B_S'])
     
-    pfxs_ = np.tile(ntwk.pfxs[None, :p['N_PC']], (n_t, 1))
-    pfys_ = np.tile(ntwk.pfys[None, :p['N_PC']], (n_t, 1))
+    return rs_d * fs
+
+
+def spks_up_from_trj(trj, ntwk, p, s_params, spks_up=None, chunk=1000, p_min=None):
+    """
+    Generate trajectory-driven upstream spks onto PCs, adding them to the PL
+    columns of an upstream spk array.
     
-    d = np.sqrt((x_ - pfxs_)**2 + (y_ - pfys_)**2)
+    Time steps are processed in chunks, and in each chunk only PCs whose
+    place fields lie within the distance at which their rates fall below
+    p_min spks per time step (see cxn.cutoff) of the chunk's positions are
+    evaluated. Expected spk counts below p_min are taken as zero.
     
-    ## dist-dependent rates
-    rs_d = p['R_MAX'] * np.exp(-np.abs(d**2)/(2*p['L_PL']**2))
+    :param spks_up: (T, 2*N_PC) upstream spk array (new if None)
+    :param chunk: number of time steps per chunk
+    :param p_min: min expected spk count per time step (cxn.P_MIN if None)
     
-    ## speed-modulation
-    sp_ = np.tile(trj['sp'][:, None], (1, p['N_PC']))
-    fs = sgmd((sp_ - p['S_TH'])/p['B_S'])
+    :return: spks_up
+    """
+    n_t = len(trj['x'])
+    n_pc = p['N_PC']
     
-    ## get spk rates
-    spk_rs = rs_d * fs
+    if spks_up is None:
+        spks_up = np.zeros((n_t, 2*n_pc), int)
+        
+    if p_min is None:
+        p_min = cxn.P_MIN
+        
+    # distance beyond which rates are negligible
+    r = cxn.cutoff(p['R_MAX'] * s_params['DT'], p['L_PL'], p_min)
     
-    # get spks
-    spks_tmp = np.random.poisson(spk_rs * s_params['DT'])
+    pfxs = ntwk.pfxs[:n_pc]
+    pfys = ntwk.pfys[:n_pc]
     
-    # convert to full-sized input upstream input array
-    return cc([spks_tmp, np.zeros(spks_tmp.shape, int)], 1)
+    for start in range(0, n_t, chunk):
+        steps = np.arange(start, min(start + chunk, n_t))
+        xs = trj['x'][steps]
+        ys = trj['y'][steps]
+        
+        ## PCs near the chunk's positions
+        cols = (
+            (xs.min() - r <= pfxs) & (pfxs <= xs.max() + r)
+            & (ys.min() - r <= pfys) & (pfys <= ys.max() + r)).nonzero()[0]
+        
+        if not len(cols):
+            continue
+            
+        ## expected spk counts
+        lams = trj_rates(trj, steps, ntwk, p, cols) * s_params['DT']
+        lams[lams < p_min] = 0
+        
+        # get spks
+        spks_up[steps[0]:steps[-1]+1, cols] += np.random.poisson(lams)
+        
+    return spks_up
 
 
-def spks_up_from_st(t, ntwk, p, s_params, schedule):
+def spks_up_trj_epoch(t, trj, ntwk, p, s_params, schedule):
     """
-    Add ST --> PC spks to upstream spk array.
+    Build dense upstream spks of the trajectory epoch (trajectory spks and
+    ST --> PC spks up to the replay epoch), drawn from s_params['RNG_SEED'].
+    
+    :return: (T, 2*N_PC) upstream spk array, state of np.random after
+        drawing them (see spks_up_from_st_rpl)
     """
+    np.random.seed(s_params['RNG_SEED'])
+    
+    # initialize upstream spks array
     spks_up = np.zeros((len(t), 2*p['N_PC']), int)
     
-    # sens/traj epoch
     if schedule['REPLAY_EPOCH_START_T'] > 0:
+        # fill in trajectory spks
+        spks_up_from_trj(trj, ntwk, p, s_params, spks_up)
+        
+        # sens/traj epoch ST inputs
         mask = t <= schedule['REPLAY_EPOCH_START_T']
         spks_up[mask, -p['N_PC']:] += np.random.poisson(
             p['FR_TRJ_PC_ST'] * s_params['DT'], (mask.sum(), p['N_PC']))
         
-    # replay epoch
+    return spks_up, np.random.get_state()
+
+
+def spks_up_from_st_rpl(t, p, s_params, schedule, spks_up, rng_state=None):
+    """
+    Add replay-epoch ST --> PC spks to upstream spk array, drawn from
+    s_params['RPL_SEED'] if given, otherwise continuing the random stream
+    of the trajectory epoch from rng_state (see spks_up_trj_epoch).
+    """
+    if s_params.get('RPL_SEED') is not None:
+        np.random.seed(s_params['RPL_SEED'])
+    elif rng_state is not None:
+        np.random.set_state(rng_state)
+        
     mask = schedule['REPLAY_EPOCH_START_T'] < t
     spks_up[-mask.sum():, p['N_PC']:] += np.random.poisson(
         p['FR_RPL_PC_ST'] * s_params['DT'], (mask.sum(), p['N_PC']))
@@ -408,22 +1083,18 @@ def spks_up_from_st(t, ntwk, p, s_params, schedule):
 
 def i_ext_trg(t, ntwk, p, s_params, schedule):
     """
-    Add replay trigger to external current stim.
+    Get replay trigger as a sparse external current schedule (see
+    ntwk_inp.DriveSchedule).
     """
-    i_ext = np.zeros((len(t), p['N_PC'] + p['N_INH']))
-    
     # get mask over cells to trigger to induce replay
     ## compute distances to trigger center
     trg_mask = get_trg_mask_pc(ntwk, p, s_params)
     
-    ## get time mask
-    t_mask = (schedule['TRG_START_T'] <= t) \
-        & (t < (schedule['TRG_START_T'] + p['D_T_TR']))
-    
-    ## add in external trigger
-    i_ext[np.outer(t_mask, trg_mask)] = p['A_TR']
+    ## get time itvl
+    itvl = (schedule['TRG_START_T'], schedule['TRG_START_T'] + p['D_T_TR'])
     
-    return i_ext
+    return DriveSchedule.from_itvls(
+        [(itvl, trg_mask, p['A_TR'])], t, p['N_PC'] + p['N_INH'])
 
 
 def get_trg_mask_pc(ntwk, p, s_params):
@@ -447,22 +1118,21 @@ def get_metrics(rslt, s_params):
     trj_mask = (rslt.trj_veil * mask_pc) > (m['MIN_SCALE_TRJ'] - 1)
     non_trj_mask = (~trj_mask) & mask_pc
     
-    # get t_mask for detection window
+    # get detection window
     start = rslt.schedule['TRG_START_T']
     end = start + m['WDW']
-    t_mask = (start <= rslt.ts) & (rslt.ts < end)
     
     # get spk cts for trj/non-trj cells during detection window
-    spks_wdw = rslt.spks[t_mask]
-    spks_trj = spks_wdw[:, trj_mask]
-    spks_non_trj = spks_wdw[:, non_trj_mask]
+    spk_cts = rslt.spk_cts(start, end)
+    spk_cts_trj = spk_cts[trj_mask]
+    spk_cts_non_trj = spk_cts[non_trj_mask]
     
     # get fraction of trj/non-trj cells that spiked
-    frac_spk_trj = np.mean(spks_trj.sum(0) > 0)
-    frac_spk_non_trj = np.mean(spks_non_trj.sum(0) > 0)
+    frac_spk_trj = np.mean(spk_cts_trj > 0)
+    frac_spk_non_trj = np.mean(spk_cts_non_trj > 0)
     
     # get avg spk ct of spiking trj cells
-    avg_spk_ct_trj = spks_trj.sum(0)[spks_trj.sum(0) > 0].mean()
+    avg_spk_ct_trj = spk_cts_trj[spk_cts_trj > 0].mean()
     
     # check conditions for successful replay 
     if (frac_spk_trj >= m['MIN_FRAC_SPK_TRJ']) \
@@ -482,9 +1152,12 @@ def get_metrics(rslt, s_params):
     return metrics, success
 
 
-def save(rslt, group, commit):
-    session = make_session()
-    
+def save(rslt, group, commit, writer=None, tag=None):
+    """
+    Save smln rslt to db, committing it immediately, or, if writer (a
+    db.RsltWriter) is given, buffering it (with tag) until the writer
+    flushes.
+    """
     smln_rslt = d_models.SmlnRslt(
         group=group,
         
@@ -497,12 +1170,20 @@ def save(rslt, group, commit):
         
         prep_time=rslt.prep_time,
         run_time=rslt.run_time,
+        profile=rslt.profile.summary() if rslt.profile is not None else None,
         
         ntwk_file='',
         smln_included=False,
         
         commit=commit)
     
+    if writer is not None:
+        writer.add(smln_rslt, tag=tag)
+        return smln_rslt
+    
+    session = make_session()
+    session.expire_on_commit = False
+    
     session.add(smln_rslt)
     session.commit()
     
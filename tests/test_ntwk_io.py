@@ -0,0 +1,106 @@
+"""
+Round trips of smln rslts through result containers (see ntwk_io.py).
+"""
+from copy import deepcopy
+
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import numpy as np
+import pytest
+
+import aux
+from ntwk import NtwkResponse
+from ntwk_rec import SpkEvents
+from seq_replay import plot, smln
+from seq_replay.p_ranges import p_ranges
+from seq_replay.s_params import s_params as S_PARAMS
+
+
+def small_params():
+    """Small, short smln (params at centers of their search ranges)."""
+    p = {k: (v[0] + v[1])/2 if isinstance(v, list) else v
+         for k, v in p_ranges.items()}
+    p.update(N_PC=200, N_INH=30, L_PC_PC=.2, L_INH_PC=.2, L_S_PC_INH=.2)
+
+    s_params = deepcopy(S_PARAMS)
+    s_params['SPEED'] = 2.
+    s_params['schedule'] = {
+        'SMLN_DUR': 2., 'TRJ_START_T': .2, 'REPLAY_EPOCH_START_T': 1.4,
+        'TRG_START_T': 1.7,
+    }
+
+    return p, s_params
+
+
+@pytest.fixture(scope='module')
+def rslt():
+    p, s_params = small_params()
+    return smln.run(p, s_params, None)
+
+
+def test_rslt_round_trip(rslt, tmp_path):
+    save_file = str(tmp_path / 'rslt.rslt')
+    aux.save(save_file, rslt)
+    loaded = aux.load(save_file)
+
+    assert isinstance(loaded, NtwkResponse)
+    assert isinstance(loaded.spks, SpkEvents)
+    assert loaded.n == rslt.n
+
+    np.testing.assert_array_equal(loaded.spks.dense(), rslt.spks.dense())
+    np.testing.assert_array_equal(loaded.spk_cts(), rslt.spk_cts())
+    np.testing.assert_array_equal(
+        loaded.first_spk_ts(), rslt.first_spk_ts())
+
+    assert smln.get_metrics(loaded, rslt.s_params) \
+        == smln.get_metrics(rslt, rslt.s_params)
+
+    plot.heat_maps(loaded)
+    plot.raster(loaded, [(0, 0)], 10, 'full')
+
+    plt.close('all')
+
+
+def test_partial_load_of_selected_traces(tmp_path):
+    p, s_params = small_params()
+    s_params['STORE'] = {
+        'vs': {'dtype': 'float32', 'nrns': [5, 7, 50, 120], 'every': 10},
+        'gs': {'dtype': 'float64', 'nrns': [3, 5, 60], 'every': 4},
+    }
+    rslt = smln.run(p, s_params, None)
+
+    save_file = str(tmp_path / 'rslt.rslt')
+    aux.save(save_file, rslt)
+
+    steps = (1003, 2507)
+    nrns = [7, 3, 5, 150, 120]
+
+    loaded = aux.load(save_file, steps=steps, nrns=nrns)
+
+    def expected(key, x):
+        # rows recorded within window, cols of requested recorded nrns
+        rec_steps = rslt.rec_steps.get(key, np.arange(len(rslt.ts)))
+        rows = (steps[0] <= rec_steps) & (rec_steps < steps[1])
+        rec_nrns = list(rslt.rec_nrns.get(key, range(rslt.n)))
+        cols = [rec_nrns.index(nrn) for nrn in nrns if nrn in rec_nrns]
+        return x[rows][:, cols]
+
+    np.testing.assert_array_equal(loaded.ts, rslt.ts[steps[0]:steps[1]])
+    np.testing.assert_array_equal(loaded.vs, expected('vs', rslt.vs))
+    assert loaded.vs.shape == (150, 3)
+
+    for syn, gs in rslt.gs.items():
+        np.testing.assert_array_equal(loaded.gs[syn], expected('gs', gs))
+        assert loaded.gs[syn].shape == (376, 2)
+
+    np.testing.assert_array_equal(loaded.cs, expected('cs', rslt.cs))
+    np.testing.assert_array_equal(
+        loaded.spks.dense(),
+        rslt.spks.dense()[steps[0]:steps[1]][:, nrns])
+
+    # recorded steps and nrns are relative to window and requested nrns
+    np.testing.assert_array_equal(
+        loaded.rec_steps['vs'], np.arange(1010, 2507, 10) - steps[0])
+    np.testing.assert_array_equal(loaded.rec_nrns['vs'], [0, 2, 4])
+    np.testing.assert_array_equal(loaded.rec_nrns['gs'], [1, 2])